@@ -2,12 +2,23 @@
 
 # Register your models here.
 from django.contrib import admin
-from .models import Document, ChatMessage, EmbeddingMetadata
+from .models import Document, DocumentContent, ChatMessage, EmbeddingMetadata, UploadSession
 
 @admin.register(Document)
 class DocumentAdmin(admin.ModelAdmin):
-    list_display = ['filename', 'user', 'uploaded_at', 'processed']
-    list_filter = ['processed', 'uploaded_at']
+    list_display = ['filename', 'user', 'uploaded_at', 'status', 'progress', 'processed']
+    list_filter = ['status', 'processed', 'uploaded_at']
+    search_fields = ['filename', 'user__username']
+
+@admin.register(DocumentContent)
+class DocumentContentAdmin(admin.ModelAdmin):
+    list_display = ['content_hash', 'status', 'chunk_count', 'created_at']
+    list_filter = ['status']
+    search_fields = ['content_hash']
+
+@admin.register(UploadSession)
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ['filename', 'user', 'received', 'size', 'completed_at', 'updated_at']
     search_fields = ['filename', 'user__username']
 
 @admin.register(ChatMessage)
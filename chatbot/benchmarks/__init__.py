@@ -0,0 +1,27 @@
+"""Benchmarks runnable with ``python manage.py benchmark <name>``.
+
+Each module exposes ``add_arguments(parser)`` and ``run(options, stdout)``;
+``run`` returns a dict of results that the command prints, and with
+``--output`` saves as JSON together with the commit and the options used.
+``--compare`` prints the change of every number against an earlier file.
+"""
+import importlib
+
+BENCHMARKS = {
+    'backends': 'chatbot.benchmarks.backends',
+    'chat': 'chatbot.benchmarks.chat',
+    'embeddings': 'chatbot.benchmarks.embeddings',
+    'inference': 'chatbot.benchmarks.inference',
+    'ingestion': 'chatbot.benchmarks.ingestion',
+    'lexical': 'chatbot.benchmarks.lexical',
+    'llm': 'chatbot.benchmarks.llm',
+    'quantization': 'chatbot.benchmarks.quantization',
+    'retrieval': 'chatbot.benchmarks.retrieval',
+    'startup': 'chatbot.benchmarks.startup',
+    'suite': 'chatbot.benchmarks.suite',
+    'vector_store': 'chatbot.benchmarks.vector_store',
+}
+
+
+def load(name: str):
+    return importlib.import_module(BENCHMARKS[name])
@@ -0,0 +1,107 @@
+"""Recall and latency of the Chroma and local vector store backends.
+
+Vectors are drawn around random cluster centres so that approximate
+indexes behave as they would on real embeddings. Ground truth comes from
+exact brute-force search over the same vectors.
+"""
+import tempfile
+import time
+
+import numpy as np
+from django.test import override_settings
+
+from chatbot.services.local_index import local_index_pool
+from chatbot.services.vector_store import VectorStoreService, chroma_pool
+
+
+def add_arguments(parser):
+    parser.add_argument('--chunks', type=int, default=50000, help='Vectors per backend')
+    parser.add_argument('--queries', type=int, default=200, help='Queries to time')
+    parser.add_argument('--dim', type=int, default=384, help='Vector dimension')
+    parser.add_argument('--k', type=int, default=10, help='Neighbours per query')
+    parser.add_argument('--backends', nargs='+', default=['chroma', 'local'])
+
+
+def clustered_vectors(count: int, dim: int, clusters: int = 256, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=count)
+    vectors = centres[labels] + 0.35 * rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def nearby_queries(vectors: np.ndarray, count: int, seed: int = 1) -> np.ndarray:
+    """Queries near stored vectors, as real questions are near their answers"""
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.integers(0, len(vectors), size=count)]
+    queries = queries + 0.05 * rng.standard_normal(queries.shape).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def exact_neighbours(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    norms = np.einsum('ij,ij->i', vectors, vectors)
+    neighbours = np.empty((len(queries), k), dtype=np.int64)
+    for i, query in enumerate(queries):
+        distances = norms - 2.0 * (vectors @ query)
+        top = np.argpartition(distances, k - 1)[:k]
+        neighbours[i] = top[np.argsort(distances[top])]
+    return neighbours
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    return {
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 3),
+        'p99_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 3),
+    }
+
+
+def run_backend(backend: str, vectors: np.ndarray, queries: np.ndarray,
+                truth: np.ndarray, k: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory, override_settings(
+            CHROMA_PERSIST_DIRECTORY=f'{directory}/chroma',
+            LOCAL_INDEX_DIRECTORY=f'{directory}/local',
+            HYBRID_SEARCH_ENABLED=False):
+        chroma_pool.reset()
+        store = VectorStoreService(user_id=0, backend=backend)
+
+        start = time.perf_counter()
+        for offset in range(0, len(vectors), 5000):
+            batch = vectors[offset:offset + 5000]
+            store.backend.add(
+                [str(offset + i) for i in range(len(batch))],
+                [f'chunk {offset + i}' for i in range(len(batch))],
+                batch,
+                [{'doc_id': 0} for _ in batch]
+            )
+        build_seconds = time.perf_counter() - start
+
+        # First query pays for mapping the index; keep it out of the timings
+        store.search(queries[0], n_results=k)
+        latencies, hits = [], 0
+        for query, expected in zip(queries, truth):
+            start = time.perf_counter()
+            result = VectorStoreService(user_id=0, backend=backend).search(query, n_results=k)
+            latencies.append(time.perf_counter() - start)
+            hits += len(set(int(i) for i in result['ids'][0]) & set(expected.tolist()))
+
+        chroma_pool.reset()
+        local_index_pool.evict(f'{directory}/local/user_0')
+
+    return {
+        'build_seconds': round(build_seconds, 2),
+        f'recall_at_{k}': round(hits / truth.size, 4),
+        **_percentiles(latencies),
+    }
+
+
+def run(options, stdout):
+    vectors = clustered_vectors(options['chunks'], options['dim'])
+    queries = nearby_queries(vectors, options['queries'])
+    truth = exact_neighbours(vectors, queries, options['k'])
+
+    results = {'chunks': options['chunks'], 'queries': options['queries']}
+    for backend in options['backends']:
+        stdout.write(f'Benchmarking {backend} backend...')
+        results[backend] = run_backend(backend, vectors, queries, truth, options['k'])
+    return results
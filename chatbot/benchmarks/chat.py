@@ -0,0 +1,136 @@
+"""End-to-end send_message throughput under concurrent clients.
+
+Requests go through Django's full stack (middleware, auth, the view, the
+ORM) from ``--clients`` threads, against a throwaway test database and a
+per-user store of ``--chunks`` synthetic chunks. Embeddings come from the
+fake embedder and answers from a stub LLM with ``--llm-latency`` seconds
+of delay, so the numbers isolate the application's own overhead and how
+it behaves while requests wait on the model. With ``--rerank`` the
+retrieved chunks go through the re-ranking stage, scored by a fake
+cross-encoder that takes ``--rerank-latency`` seconds per pair.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import random
+import tempfile
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client, override_settings
+
+from chatbot import views
+from chatbot.models import Document
+from chatbot.services.lexical_index import lexical_index_pool
+from chatbot.services import reranker
+from chatbot.services.local_index import local_index_pool
+from chatbot.services.vector_store import VectorStoreService, chroma_pool
+
+from .backends import _percentiles
+from .fixtures import FakeCrossEncoder, FakeEmbeddingService, StubLLMService, synthetic_words
+
+
+def add_arguments(parser):
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent clients')
+    parser.add_argument('--requests', type=int, default=400, help='Requests in total')
+    parser.add_argument('--chunks', type=int, default=5000, help='Chunks in the user\'s store')
+    parser.add_argument('--llm-latency', type=float, default=0.0, help='Seconds the stub LLM takes to answer')
+    parser.add_argument('--backend', choices=['chroma', 'local'], default='local')
+    parser.add_argument('--response-cache', action='store_true', help='Enable the semantic response cache')
+    parser.add_argument('--rerank', action='store_true', help='Re-rank retrieved chunks with a fake cross-encoder')
+    parser.add_argument('--rerank-latency', type=float, default=0.0005,
+                        help='Seconds the fake cross-encoder takes per (query, chunk) pair')
+
+
+def _populate(user, embedding_service, count: int, backend: str):
+    rng = random.Random(0)
+    document = Document.objects.create(
+        user=user, filename='synthetic.pdf', file='uploads/synthetic.pdf',
+        status=Document.STATUS_COMPLETED, processed=True, chunk_count=count
+    )
+    store = VectorStoreService(user.id, backend=backend)
+    for offset in range(0, count, 1000):
+        texts = [synthetic_words(120, rng) for _ in range(min(1000, count - offset))]
+        store.add_documents(
+            texts, embedding_service.generate_embeddings(texts),
+            [{'doc_id': document.id, 'filename': document.filename} for _ in texts]
+        )
+
+
+def run(options, stdout):
+    embedding_service = FakeEmbeddingService()
+    llm_service = StubLLMService(latency=options['llm_latency'])
+    rng = random.Random(1)
+    queries = [synthetic_words(8, rng) for _ in range(options['requests'])]
+
+    with tempfile.TemporaryDirectory() as directory, override_settings(
+            CHROMA_PERSIST_DIRECTORY=f'{directory}/chroma',
+            LOCAL_INDEX_DIRECTORY=f'{directory}/local',
+            LEXICAL_INDEX_DIRECTORY=f'{directory}/lexical',
+            RESPONSE_CACHE_ENABLED=options['response_cache'],
+            RESPONSE_CACHE_PATH=f'{directory}/response_cache.sqlite3',
+            SHARED_CORPUS_ENABLED=False,
+            RERANK_ENABLED=options['rerank'],
+            VECTOR_STORE_BACKEND=options['backend']):
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = f'{directory}/benchmark.sqlite3'
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        saved_services = views._embedding_service, views._llm_service, reranker._reranker
+        views._embedding_service, views._llm_service = embedding_service, llm_service
+        reranker._reranker = reranker.Reranker('fake')
+        reranker._reranker._model = FakeCrossEncoder(options['rerank_latency'])
+        chroma_pool.reset()
+        user = None
+        try:
+            user = User.objects.create_user('benchmark', password='benchmark')
+            stdout.write(f"Indexing {options['chunks']} chunks...")
+            _populate(user, embedding_service, options['chunks'], options['backend'])
+
+            local = threading.local()
+            latencies, errors = [], 0
+            lock = threading.Lock()
+
+            def send(query):
+                nonlocal errors
+                client = getattr(local, 'client', None)
+                if client is None:
+                    client = local.client = Client()
+                    client.force_login(user)
+                start = time.perf_counter()
+                response = client.post('/chatbot/send-message/', {'message': query})
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    if response.status_code != 200:
+                        errors += 1
+
+            # Warm up each backend cache and the URL resolver
+            send(queries[0])
+            latencies.clear()
+            outcomes = {result: reranker.RERANK_REQUESTS.value(result=result) for result in ('reranked', 'fallback')}
+
+            stdout.write(f"Sending {len(queries)} requests from {options['clients']} clients...")
+            with ThreadPoolExecutor(max_workers=options['clients']) as pool:
+                start = time.perf_counter()
+                list(pool.map(send, queries))
+                elapsed = time.perf_counter() - start
+        finally:
+            views._embedding_service, views._llm_service, reranker._reranker = saved_services
+            chroma_pool.reset()
+            if user is not None:
+                local_index_pool.evict(f'{directory}/local/user_{user.id}')
+                lexical_index_pool.evict(f'{directory}/lexical/user_{user.id}')
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    return {
+        'clients': options['clients'],
+        'requests': len(queries),
+        'errors': errors,
+        'chunks': options['chunks'],
+        'llm_latency': options['llm_latency'],
+        'requests_per_sec': round(len(queries) / elapsed, 1),
+        **_percentiles(latencies),
+        **({
+            f'rerank_{result}': reranker.RERANK_REQUESTS.value(result=result) - before
+            for result, before in outcomes.items()
+        } if options['rerank'] else {}),
+    }
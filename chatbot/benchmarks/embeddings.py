@@ -0,0 +1,63 @@
+"""Throughput of the batched float32 encode path against the legacy path.
+
+The legacy path is the original ``model.encode(texts).tolist()`` call over
+the whole list; the new path is ``EmbeddingService.encode``, which sorts by
+length, encodes in fixed-size batches and keeps vectors as float32 arrays.
+"""
+import random
+import resource
+import time
+
+import numpy as np
+
+from chatbot.services.embeddings import EmbeddingService
+
+WORDS = (
+    'document chunk embedding vector search query model answer context '
+    'retrieval page section policy handbook question summary detail'
+).split()
+
+
+def add_arguments(parser):
+    parser.add_argument('--texts', type=int, default=2000, help='Number of texts to encode')
+    parser.add_argument('--batch-size', type=int, default=None, help='Batch size for the new path')
+
+
+def synthetic_texts(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [
+        ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 300)))
+        for _ in range(count)
+    ]
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def run(options, stdout):
+    service = EmbeddingService()
+    texts = synthetic_texts(options['texts'])
+    # Warm up so model initialisation is not counted
+    service.encode(texts[:8])
+
+    legacy, legacy_seconds = _timed(lambda: service.model.encode(texts).tolist())
+    rss_after_legacy = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    batched, batched_seconds = _timed(
+        lambda: service.encode(texts, batch_size=options['batch_size'])
+    )
+
+    drift = float(np.max(np.abs(np.asarray(legacy, dtype=np.float32) - batched)))
+    return {
+        'texts': len(texts),
+        'legacy_texts_per_sec': round(len(texts) / legacy_seconds, 1),
+        'batched_texts_per_sec': round(len(texts) / batched_seconds, 1),
+        'speedup': round(legacy_seconds / batched_seconds, 2),
+        'max_rss_kb_after_legacy': rss_after_legacy,
+        'max_rss_kb_after_batched': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'max_abs_difference': drift,
+        'output_dtype': str(batched.dtype),
+    }
@@ -0,0 +1,180 @@
+"""Offline stand-ins and synthetic inputs shared by the benchmarks.
+
+FakeEmbeddingService and StubLLMService have the interfaces of the real
+services, so benchmarks measure the pipeline around them without a model
+download or an API key. Both are deterministic: the same input always
+gives the same vectors and answers, so runs are comparable across commits.
+"""
+from typing import AsyncIterator, List
+import asyncio
+import hashlib
+import random
+import time
+import zlib
+
+import numpy as np
+from django.conf import settings
+
+from chatbot.services.llm_service import LLMService
+from chatbot.services.prompt_builder import ESTIMATE, Prompt, PromptBuilder, TokenCounter
+from chatbot.services.query_embeddings import QueryEmbeddingCache, normalize_query
+
+WORDS = (
+    'policy employee travel expense report approval manager department budget '
+    'invoice contract vendor security access network server database backup '
+    'incident response training onboarding leave benefit payroll schedule '
+    'project milestone deadline review audit compliance risk quarterly annual'
+).split()
+
+
+def synthetic_words(count: int, rng: random.Random) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+class FakeEmbeddingService:
+    """Hashed bag-of-words embeddings with EmbeddingService's interface.
+
+    Texts sharing words get similar vectors, so retrieval results are
+    meaningful; encoding costs microseconds rather than milliseconds.
+    """
+
+    model_name = 'fake-hashed-bow'
+
+    def __init__(self, dimension: int = 384, max_seq_length: int = 256):
+        self.dimension = dimension
+        self.max_seq_length = max_seq_length
+        self.cache = None
+        self.queries = QueryEmbeddingCache(settings.QUERY_EMBEDDING_CACHE_SIZE)
+
+    def _bucket(self, word: str) -> int:
+        return zlib.crc32(word.encode('utf-8')) % self.dimension
+
+    def encode(self, texts: List[str], batch_size: int = None) -> np.ndarray:
+        output = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.lower().split():
+                output[i, self._bucket(word)] += 1.0
+        norms = np.linalg.norm(output, axis=1, keepdims=True)
+        return output / np.maximum(norms, 1e-12)
+
+    def generate_embeddings(self, texts: List[str]) -> np.ndarray:
+        return self.encode(texts)
+
+    def generate_embedding(self, text: str) -> np.ndarray:
+        return self.encode([text])[0]
+
+    def embed_query(self, text: str) -> np.ndarray:
+        query = normalize_query(text) or text
+        vector = self.queries.get(query)
+        if vector is None:
+            vector = self.generate_embedding(query)
+            self.queries.put(query, vector)
+        return vector
+
+    @property
+    def max_chunk_tokens(self) -> int:
+        # [CLS] and [SEP], as for the real model
+        return self.max_seq_length - 2
+
+    def count_tokens(self, text: str) -> int:
+        # Word pieces run about 1.3 per English word
+        return int(len(text.split()) * 1.3)
+
+    def warm_up(self):
+        pass
+
+    def cache_stats(self) -> dict:
+        return {'queries': self.queries.stats()}
+
+
+class FakeCrossEncoder:
+    """CrossEncoder.predict scoring pairs by shared words, with a per-pair delay"""
+
+    def __init__(self, latency_per_pair: float = 0.0):
+        self.latency_per_pair = latency_per_pair
+
+    def predict(self, pairs, batch_size: int = 32, convert_to_numpy: bool = True,
+                show_progress_bar: bool = False) -> np.ndarray:
+        if self.latency_per_pair:
+            time.sleep(self.latency_per_pair * len(pairs))
+        return np.array([
+            len(set(query.split()) & set(text.split())) / (1 + len(text.split()) ** 0.5)
+            for query, text in pairs
+        ], dtype=np.float32)
+
+
+class StubLLMService(LLMService):
+    """LLMService that answers after a fixed delay instead of calling Groq"""
+
+    def __init__(self, latency: float = 0.0, tokens: int = 40):
+        self.client = None
+        self.model = 'stub'
+        self.latency = latency
+        self.tokens = tokens
+        self.prompt_builder = PromptBuilder(
+            # Offline: no embedding model to take the tokenizer from
+            TokenCounter(settings.PROMPT_TOKENIZER or ESTIMATE),
+            max_tokens=settings.PROMPT_MAX_TOKENS,
+            history_tokens=settings.PROMPT_HISTORY_TOKENS,
+            history_message_tokens=settings.PROMPT_HISTORY_MESSAGE_TOKENS
+        )
+
+    def _answer(self, prompt: Prompt) -> List[str]:
+        seed = hashlib.sha256(prompt.messages[-1]['content'].encode('utf-8')).digest()
+        rng = random.Random(seed)
+        return [rng.choice(WORDS) for _ in range(self.tokens)]
+
+    def complete(self, prompt: Prompt, user_id: int = None) -> str:
+        if self.latency:
+            time.sleep(self.latency)
+        return ' '.join(self._answer(prompt))
+
+    async def stream_response(self, prompt: Prompt, user_id: int = None) -> AsyncIterator[str]:
+        words = self._answer(prompt)
+        for i, word in enumerate(words):
+            await asyncio.sleep(self.latency / len(words))
+            yield word if i == 0 else ' ' + word
+
+
+def _pdf_string(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def write_synthetic_pdf(path, pages: int, words_per_page: int = 400, seed: int = 0):
+    """Write a text PDF of random words, extractable by pypdf"""
+    rng = random.Random(seed)
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        None,  # page tree, filled in once the page objects are numbered
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    page_ids = []
+    for _ in range(pages):
+        words = synthetic_words(words_per_page, rng).split()
+        lines = [' '.join(words[i:i + 12]) for i in range(0, len(words), 12)]
+        content = 'BT /F1 10 Tf 14 TL 40 780 Td ' + ' '.join(
+            f'({_pdf_string(line)}) Tj T*' for line in lines
+        ) + ' ET'
+        stream = content.encode('latin-1')
+        objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+            b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % content_id
+        )
+        page_ids.append(len(objects))
+    kids = ' '.join(f'{page_id} 0 R' for page_id in page_ids)
+    objects[1] = f'<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>'.encode('latin-1')
+
+    output = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref = len(output)
+    output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for offset in offsets:
+        output += b'%010d 00000 n \n' % offset
+    output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    with open(path, 'wb') as f:
+        f.write(output)
@@ -0,0 +1,75 @@
+"""Embedding throughput, query latency and parity of the inference backends.
+
+Every backend in ``--backends`` (see EMBEDDING_BACKEND) encodes the same
+texts in batches, for sentences/sec, and then the same short queries one
+at a time, for p50/p99 query latency. Each backend's vectors are compared
+with the stock float32 torch model: ``max_cosine_drift`` is the largest
+1 - cosine similarity over the texts, and ``parity_ok`` says whether it
+is within ``--max-drift``. ONNX backends need ``manage.py export_onnx``
+first; a backend that cannot load is reported rather than failing the run.
+"""
+import random
+import time
+
+from django.conf import settings
+
+from chatbot.services.embeddings import INFERENCE_BACKENDS, load_model
+from chatbot.services.onnx_encoder import cosine_drift
+
+from .backends import _percentiles
+from .embeddings import synthetic_texts
+from .fixtures import synthetic_words
+
+
+def add_arguments(parser):
+    parser.add_argument('--backends', nargs='+', choices=INFERENCE_BACKENDS, default=list(INFERENCE_BACKENDS))
+    parser.add_argument('--texts', type=int, default=1000, help='Texts encoded for throughput and parity')
+    parser.add_argument('--queries', type=int, default=200, help='Single queries timed for latency')
+    parser.add_argument('--batch-size', type=int, default=settings.EMBEDDING_BATCH_SIZE)
+    parser.add_argument('--threads', type=int, default=settings.EMBEDDING_THREADS,
+                        help='Intra-op threads (0: library default)')
+    parser.add_argument('--max-drift', type=float, default=0.01, help='Largest 1 - cosine accepted')
+
+
+def run(options, stdout):
+    texts = synthetic_texts(options['texts'])
+    rng = random.Random(1)
+    queries = [synthetic_words(rng.randint(3, 15), rng) for _ in range(options['queries'])]
+    results = {'texts': len(texts), 'queries': len(queries), 'threads': options['threads']}
+
+    reference = None
+    for backend in ['torch'] + [name for name in options['backends'] if name != 'torch']:
+        stdout.write(f'Benchmarking {backend} inference...')
+        try:
+            model = load_model(settings.EMBEDDING_MODEL, backend, options['threads'])
+        except (ImportError, OSError) as e:
+            if backend in options['backends']:
+                results[backend] = {'error': str(e)}
+            stdout.write(f'{backend}: unavailable ({e})')
+            continue
+        # Warm up so initialisation and first-call allocation are not counted
+        model.encode(texts[:8], batch_size=8, convert_to_numpy=True, show_progress_bar=False)
+
+        start = time.perf_counter()
+        vectors = model.encode(texts, batch_size=options['batch_size'], convert_to_numpy=True,
+                               show_progress_bar=False)
+        seconds = time.perf_counter() - start
+
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            model.encode([query], batch_size=1, convert_to_numpy=True, show_progress_bar=False)
+            latencies.append(time.perf_counter() - start)
+
+        if backend == 'torch':
+            reference = vectors
+        result = {'sentences_per_sec': round(len(texts) / seconds, 1), **_percentiles(latencies)}
+        if reference is not None:
+            drift = cosine_drift(reference, vectors)
+            result['max_cosine_drift'] = round(float(drift.max()), 6)
+            result['mean_cosine_drift'] = round(float(drift.mean()), 6)
+            result['parity_ok'] = bool(drift.max() <= options['max_drift'])
+        if backend in options['backends']:
+            results[backend] = result
+        del model
+    return results
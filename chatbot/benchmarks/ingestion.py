@@ -0,0 +1,108 @@
+"""Ingestion throughput: extraction, chunking, embedding and storage.
+
+A synthetic PDF goes through the same components as the ingestion worker
+(DocumentProcessor, the token-limited StreamingChunker, the embedding
+service and VectorStoreService), one stage at a time so each rate is
+measured on its own. ``--embedder fake`` swaps the model for a hashed
+bag-of-words embedder to run offline.
+"""
+import tempfile
+import time
+
+from django.conf import settings
+from django.test import override_settings
+
+from chatbot.services.document_processor import DocumentProcessor
+from chatbot.services.ingestion import IngestionService
+from chatbot.services.lexical_index import lexical_index_pool
+from chatbot.services.local_index import local_index_pool
+from chatbot.services.vector_store import VectorStoreService, chroma_pool
+
+from .fixtures import FakeEmbeddingService, write_synthetic_pdf
+
+
+def add_arguments(parser):
+    parser.add_argument('--pages', type=int, default=200, help='Pages in the synthetic PDF')
+    parser.add_argument('--words-per-page', type=int, default=400)
+    parser.add_argument('--embedder', choices=['fake', 'model'], default='fake',
+                        help='fake: deterministic hashed embeddings; model: the configured SentenceTransformer')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='PDF extraction processes (default PDF_EXTRACTION_WORKERS)')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='Chunks per embed/store call (default INGESTION_BATCH_SIZE)')
+    parser.add_argument('--backend', choices=['chroma', 'local'], default='local')
+
+
+def _rate(count: int, seconds: float) -> float:
+    return round(count / seconds, 1) if seconds else 0.0
+
+
+def run(options, stdout):
+    if options['embedder'] == 'fake':
+        embedding_service = FakeEmbeddingService()
+    else:
+        from chatbot.services.embeddings import EmbeddingService
+        embedding_service = EmbeddingService()
+        embedding_service.warm_up()
+    batch_size = options['batch_size'] or settings.INGESTION_BATCH_SIZE
+    workers = options['workers'] if options['workers'] is not None else settings.PDF_EXTRACTION_WORKERS
+
+    with tempfile.TemporaryDirectory() as directory, override_settings(
+            CHROMA_PERSIST_DIRECTORY=f'{directory}/chroma',
+            LOCAL_INDEX_DIRECTORY=f'{directory}/local',
+            LEXICAL_INDEX_DIRECTORY=f'{directory}/lexical',
+            RESPONSE_CACHE_ENABLED=False):
+        path = f'{directory}/synthetic.pdf'
+        write_synthetic_pdf(path, options['pages'], options['words_per_page'])
+        stdout.write(f"Ingesting a {options['pages']}-page PDF...")
+
+        start = time.perf_counter()
+        pages = [(number, text + '\n') for number, text in DocumentProcessor.iter_pages(path, workers=workers)]
+        extract_seconds = time.perf_counter() - start
+
+        chunker = IngestionService.build_chunker(embedding_service)
+        start = time.perf_counter()
+        chunks = list(chunker.chunks(iter(pages)))
+        chunk_seconds = time.perf_counter() - start
+        texts = [chunk.text for chunk in chunks]
+
+        start = time.perf_counter()
+        embeddings = [
+            embedding_service.generate_embeddings(texts[offset:offset + batch_size])
+            for offset in range(0, len(texts), batch_size)
+        ]
+        embed_seconds = time.perf_counter() - start
+
+        chroma_pool.reset()
+        store = VectorStoreService(user_id=0, backend=options['backend'])
+        start = time.perf_counter()
+        for batch_number, offset in enumerate(range(0, len(texts), batch_size)):
+            store.add_documents(
+                texts[offset:offset + batch_size],
+                embeddings[batch_number],
+                [{'doc_id': 0, **chunk.metadata()} for chunk in chunks[offset:offset + batch_size]]
+            )
+        store_seconds = time.perf_counter() - start
+
+        chroma_pool.reset()
+        local_index_pool.evict(f'{directory}/local/user_0')
+        lexical_index_pool.evict(f'{directory}/lexical/user_0')
+
+    total = extract_seconds + chunk_seconds + embed_seconds + store_seconds
+    return {
+        'pages': len(pages),
+        'chunks': len(chunks),
+        'embedder': getattr(embedding_service, 'model_name', options['embedder']),
+        'extract_pages_per_sec': _rate(len(pages), extract_seconds),
+        'chunk_chunks_per_sec': _rate(len(chunks), chunk_seconds),
+        'embed_chunks_per_sec': _rate(len(chunks), embed_seconds),
+        'store_chunks_per_sec': _rate(len(chunks), store_seconds),
+        'pages_per_sec': _rate(len(pages), total),
+        'chunks_per_sec': _rate(len(chunks), total),
+        'seconds': {
+            'extract': round(extract_seconds, 3),
+            'chunk': round(chunk_seconds, 3),
+            'embed': round(embed_seconds, 3),
+            'store': round(store_seconds, 3),
+        },
+    }
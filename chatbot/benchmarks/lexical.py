@@ -0,0 +1,88 @@
+"""Indexing throughput and query latency of the BM25 lexical index.
+
+Chunks are random words drawn from a Zipf distribution, which gives the
+skewed term frequencies of natural text. Query latency is measured on
+the index alone and on a hybrid VectorStoreService.search(), against
+the vector-only search it adds to.
+"""
+import tempfile
+import time
+
+import numpy as np
+from django.test import override_settings
+
+from chatbot.services.lexical_index import LexicalIndex, lexical_index_pool
+from chatbot.services.local_index import local_index_pool
+from chatbot.services.vector_store import VectorStoreService
+
+from .backends import _percentiles
+
+
+def add_arguments(parser):
+    parser.add_argument('--chunks', type=int, default=20000, help='Chunks to index')
+    parser.add_argument('--words', type=int, default=300, help='Words per chunk')
+    parser.add_argument('--vocabulary', type=int, default=30000, help='Distinct words')
+    parser.add_argument('--batch-size', type=int, default=64, help='Chunks per add() call, as in ingestion')
+    parser.add_argument('--queries', type=int, default=200, help='Queries to time')
+
+
+def zipf_texts(count: int, words: int, vocabulary: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    terms = np.array([f'term{i}' for i in range(vocabulary)])
+    ranks = np.minimum(rng.zipf(1.1, size=(count, words)), vocabulary) - 1
+    return [' '.join(terms[row]) for row in ranks], terms
+
+
+def run(options, stdout):
+    texts, terms = zipf_texts(options['chunks'], options['words'], options['vocabulary'])
+    rng = np.random.default_rng(1)
+    queries = [' '.join(rng.choice(terms[:5000], size=6)) for _ in range(options['queries'])]
+    ids = [str(i) for i in range(len(texts))]
+    batch_size = options['batch_size']
+
+    with tempfile.TemporaryDirectory() as directory, override_settings(
+            LOCAL_INDEX_DIRECTORY=f'{directory}/local',
+            LEXICAL_INDEX_DIRECTORY=f'{directory}/lexical'):
+        stdout.write(f'Indexing {len(texts)} chunks...')
+        index = LexicalIndex(f'{directory}/standalone')
+        start = time.perf_counter()
+        for offset in range(0, len(texts), batch_size):
+            index.add(ids[offset:offset + batch_size], texts[offset:offset + batch_size],
+                      [0] * len(ids[offset:offset + batch_size]))
+        build_seconds = time.perf_counter() - start
+
+        index.search(queries[0])
+        lexical = []
+        for query in queries:
+            start = time.perf_counter()
+            index.search(query, 20)
+            lexical.append(time.perf_counter() - start)
+
+        # Hybrid vs vector-only through the service, on the local backend
+        store = VectorStoreService(user_id=0, backend='local')
+        vectors = rng.standard_normal((len(texts), 384)).astype(np.float32)
+        for offset in range(0, len(texts), 5000):
+            store.add_documents(texts[offset:offset + 5000], vectors[offset:offset + 5000],
+                                [{'doc_id': 0} for _ in range(len(vectors[offset:offset + 5000]))])
+        query_vectors = rng.standard_normal((len(queries), 384)).astype(np.float32)
+        timings = {'vector_only': [], 'hybrid': []}
+        store.search(query_vectors[0], 3, query_text=queries[0])
+        for query, vector in zip(queries, query_vectors):
+            start = time.perf_counter()
+            store.search(vector, 3)
+            timings['vector_only'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            store.search(vector, 3, query_text=query)
+            timings['hybrid'].append(time.perf_counter() - start)
+
+        local_index_pool.evict(f'{directory}/local/user_0')
+        lexical_index_pool.evict(f'{directory}/lexical/user_0')
+
+    return {
+        'chunks': len(texts),
+        'build_seconds': round(build_seconds, 2),
+        'chunks_per_second': round(len(texts) / build_seconds),
+        'bm25': _percentiles(lexical),
+        'vector_only': _percentiles(timings['vector_only']),
+        'hybrid': _percentiles(timings['hybrid']),
+    }
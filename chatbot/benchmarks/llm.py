@@ -0,0 +1,153 @@
+"""LLM admission control against a rate-limited stub provider.
+
+``--clients`` threads (or coroutines, with ``--stream``) send
+``--requests`` prompts through the real LLMService, with its pooled
+client, fair queue, shared rate limiter and retries, to an in-process
+StubLLMServer that allows ``--stub-rpm`` requests per minute and answers
+in ``--latency`` seconds (``--slow-latency`` for ``--slow-fraction`` of
+them). ``--heavy-share`` of the requests come from one user and the rest
+from ``--users`` others, to show whether the burst crowds them out.
+
+Latency is reported for every request, answered or turned away, so p99
+shows how long a user can wait; with the limiter on it should stay under
+``--deadline`` and the stub should see few 429s. ``--no-limiter`` runs the
+same load with only retries between the workers and the provider.
+"""
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import random
+import tempfile
+import threading
+import time
+
+from django.test import override_settings
+
+from chatbot.services.llm_limits import LLMError, LLMOverloaded
+from chatbot.services.llm_service import LLM_ATTEMPTS, LLMService
+
+from .backends import _percentiles
+from .fixtures import synthetic_words
+from .llm_stub import start_stub
+
+
+def add_arguments(parser):
+    parser.add_argument('--clients', type=int, default=32, help='Concurrent clients')
+    parser.add_argument('--requests', type=int, default=400, help='Requests in total')
+    parser.add_argument('--users', type=int, default=8, help='Light users besides the heavy one')
+    parser.add_argument('--heavy-share', type=float, default=0.5, help='Share of requests from the heavy user')
+    parser.add_argument('--stub-rpm', type=int, default=1200, help='Requests per minute the stub allows')
+    parser.add_argument('--latency', type=float, default=0.1, help='Seconds the stub takes to answer')
+    parser.add_argument('--slow-fraction', type=float, default=0.02)
+    parser.add_argument('--slow-latency', type=float, default=2.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests the stub fails with 503')
+    parser.add_argument('--concurrency', type=int, default=8, help='LLM_CONCURRENCY')
+    parser.add_argument('--queue-size', type=int, default=64, help='LLM_QUEUE_SIZE')
+    parser.add_argument('--deadline', type=float, default=5.0, help='LLM_DEADLINE')
+    parser.add_argument('--no-limiter', action='store_true', help='Do not enforce the stub\'s limit client-side')
+    parser.add_argument('--stream', action='store_true', help='Use stream_response instead of complete')
+
+
+def _summary(samples) -> dict:
+    latencies = [seconds for _, seconds in samples]
+    return {
+        'requests': len(samples),
+        'answered': sum(outcome == 'ok' for outcome, _ in samples),
+        **(_percentiles(latencies) if latencies else {}),
+    }
+
+
+def run(options, stdout):
+    rng = random.Random(0)
+    users = [
+        0 if rng.random() < options['heavy_share'] else rng.randint(1, max(1, options['users']))
+        for _ in range(options['requests'])
+    ]
+    server = start_stub(
+        requests_per_minute=options['stub_rpm'],
+        latency=options['latency'],
+        slow_fraction=options['slow_fraction'],
+        slow_latency=options['slow_latency'],
+        error_rate=options['error_rate']
+    )
+    results = []
+    lock = threading.Lock()
+    try:
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+                GROQ_API_KEY='stub',
+                LLM_BASE_URL=server.url,
+                LLM_CONCURRENCY=options['concurrency'],
+                LLM_QUEUE_SIZE=options['queue_size'],
+                LLM_DEADLINE=options['deadline'],
+                LLM_REQUESTS_PER_MINUTE=0 if options['no_limiter'] else options['stub_rpm'],
+                LLM_TOKENS_PER_MINUTE=0,
+                LLM_RATE_LIMIT_PATH=f'{directory}/llm_rate_limit.sqlite3'):
+            service = LLMService()
+            prompts = [
+                service.build_prompt(synthetic_words(10, rng), [synthetic_words(150, rng)])
+                for _ in users
+            ]
+            attempts = {result: LLM_ATTEMPTS.value(result=result)
+                        for result in ('ok', 'rate_limited', 'failed', 'rejected')}
+
+            def record(user_id, outcome, seconds):
+                with lock:
+                    results.append((user_id, outcome, seconds))
+
+            def call(i):
+                start = time.perf_counter()
+                try:
+                    service.complete(prompts[i], user_id=users[i])
+                    outcome = 'ok'
+                except LLMOverloaded:
+                    outcome = 'overloaded'
+                except LLMError:
+                    outcome = 'failed'
+                record(users[i], outcome, time.perf_counter() - start)
+
+            async def stream_all():
+                clients = asyncio.Semaphore(options['clients'])
+
+                async def stream(i):
+                    async with clients:
+                        start = time.perf_counter()
+                        try:
+                            async for _ in service.stream_response(prompts[i], user_id=users[i]):
+                                pass
+                            outcome = 'ok'
+                        except LLMOverloaded:
+                            outcome = 'overloaded'
+                        except LLMError:
+                            outcome = 'failed'
+                        record(users[i], outcome, time.perf_counter() - start)
+
+                await asyncio.gather(*(stream(i) for i in range(len(users))))
+
+            stdout.write(f"Sending {len(users)} requests from {options['clients']} clients to a stub "
+                         f"allowing {options['stub_rpm']} requests/min...")
+            start = time.perf_counter()
+            if options['stream']:
+                asyncio.run(stream_all())
+            else:
+                with ThreadPoolExecutor(max_workers=options['clients']) as pool:
+                    list(pool.map(call, range(len(users))))
+            elapsed = time.perf_counter() - start
+            attempts = {result: LLM_ATTEMPTS.value(result=result) - before for result, before in attempts.items()}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    outcomes = Counter(outcome for _, outcome, _ in results)
+    return {
+        'requests': len(results),
+        'clients': options['clients'],
+        'limiter': not options['no_limiter'],
+        'seconds': round(elapsed, 2),
+        'answered_per_sec': round(outcomes['ok'] / elapsed, 1),
+        'outcomes': dict(outcomes),
+        **_summary([(outcome, seconds) for _, outcome, seconds in results]),
+        'heavy_user': _summary([(outcome, seconds) for user, outcome, seconds in results if user == 0]),
+        'light_users': _summary([(outcome, seconds) for user, outcome, seconds in results if user != 0]),
+        'attempts': attempts,
+        'stub': dict(server.stats),
+    }
@@ -0,0 +1,143 @@
+"""Local stand-in for the Groq chat completions API, for load tests.
+
+Serves ``POST /openai/v1/chat/completions`` (plain and streamed) with
+canned answers after a configurable delay, a share of much slower
+answers, random 503s, and its own requests-per-minute limit answered with
+429 and ``retry-after`` like the real API. ``GET /stats`` returns what it
+has served. Run it with ``manage.py llm_stub_server`` and set
+LLM_BASE_URL to its address, or start it in-process with ``start_stub``.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import Counter
+import json
+import random
+import sys
+import threading
+import time
+
+from .fixtures import WORDS
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, requests_per_minute: int = 0, latency: float = 0.2,
+                 slow_fraction: float = 0.0, slow_latency: float = 5.0, error_rate: float = 0.0,
+                 tokens: int = 40, seed: int = 0):
+        super().__init__(address, _Handler)
+        self.requests_per_minute = requests_per_minute
+        self.latency = latency
+        self.slow_fraction = slow_fraction
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.tokens = tokens
+        self.rng = random.Random(seed)
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self._level = float(requests_per_minute)
+        self._updated = time.monotonic()
+
+    def handle_error(self, request, client_address):
+        # Clients past their deadline hang up on slow answers; that is expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def admit(self) -> tuple:
+        """(outcome, seconds): 'ok' with the answer's delay, 'rate_limited' with retry-after, or 'error'"""
+        with self.lock:
+            self.stats['requests'] += 1
+            if self.requests_per_minute:
+                now = time.monotonic()
+                rate = self.requests_per_minute / 60.0
+                self._level = min(self.requests_per_minute, self._level + (now - self._updated) * rate)
+                self._updated = now
+                if self._level < 1:
+                    self.stats['rate_limited'] += 1
+                    return 'rate_limited', (1 - self._level) / rate
+                self._level -= 1
+            if self.rng.random() < self.error_rate:
+                self.stats['errors'] += 1
+                return 'error', 0.0
+            slow = self.rng.random() < self.slow_fraction
+            self.stats['slow' if slow else 'served'] += 1
+            return 'ok', self.slow_latency if slow else self.latency
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self._json(404, {'error': {'message': 'Not found'}})
+        with self.server.lock:
+            self._json(200, dict(self.server.stats))
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        if self.path != '/openai/v1/chat/completions':
+            return self._json(404, {'error': {'message': 'Not found'}})
+
+        outcome, seconds = self.server.admit()
+        if outcome == 'rate_limited':
+            return self._json(429, {'error': {'message': 'Rate limit reached', 'type': 'requests',
+                                              'code': 'rate_limit_exceeded'}},
+                              {'retry-after': f'{seconds:.3f}'})
+        if outcome == 'error':
+            return self._json(503, {'error': {'message': 'Service unavailable', 'type': 'internal_server_error'}})
+
+        prompt = ' '.join(str(message.get('content', '')) for message in request.get('messages', []))
+        rng = random.Random(prompt)
+        words = [rng.choice(WORDS) for _ in range(min(self.server.tokens, request.get('max_tokens') or 1024))]
+        base = {'id': f'stub-{rng.getrandbits(32):08x}', 'created': int(time.time()), 'model': request.get('model')}
+        usage = {'prompt_tokens': len(prompt.split()), 'completion_tokens': len(words),
+                 'total_tokens': len(prompt.split()) + len(words)}
+
+        if not request.get('stream'):
+            time.sleep(seconds)
+            return self._json(200, {
+                **base, 'object': 'chat.completion',
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': ' '.join(words)}}],
+                'usage': usage,
+            })
+
+        # The first token comes after half the delay, the rest spread over the other half
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        time.sleep(seconds / 2)
+        for i, word in enumerate(words):
+            chunk = {**base, 'object': 'chat.completion.chunk',
+                     'choices': [{'index': 0, 'delta': {'content': word if i == 0 else ' ' + word},
+                                  'finish_reason': None}]}
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+            self.wfile.flush()
+            time.sleep(seconds / 2 / len(words))
+        self.wfile.write(b'data: [DONE]\n\n')
+
+
+def start_stub(port: int = 0, **options) -> StubLLMServer:
+    """A StubLLMServer on 127.0.0.1 serving from a background thread; call shutdown() to stop it"""
+    server = StubLLMServer(('127.0.0.1', port), **options)
+    threading.Thread(target=server.serve_forever, name='llm-stub', daemon=True).start()
+    return server
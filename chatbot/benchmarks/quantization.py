@@ -0,0 +1,100 @@
+"""Memory saved against recall lost by the local index storage modes.
+
+Each mode builds its own local index over the same clustered vectors
+(see the backends benchmark) and answers the same queries. Recall is
+measured against exact float32 search, so the float32 row shows what the
+IVF index alone costs and the other rows add the quantization error.
+"Memory" is the matrix every query scans, which must stay in the page
+cache; "disk" also counts the float32 copy kept for re-ranking, of which
+a query reads only its shortlist.
+"""
+import tempfile
+import time
+from pathlib import Path
+
+from django.test import override_settings
+
+from chatbot.services.local_index import local_index_pool
+from chatbot.services.vector_store import VectorStoreService
+
+from .backends import _percentiles, clustered_vectors, exact_neighbours, nearby_queries
+
+MODES = ['float32', 'float16', 'int8', 'float16+rerank', 'int8+rerank']
+
+
+def add_arguments(parser):
+    parser.add_argument('--chunks', type=int, default=100000, help='Vectors per index')
+    parser.add_argument('--queries', type=int, default=200, help='Queries to time')
+    parser.add_argument('--dim', type=int, default=384, help='Vector dimension')
+    parser.add_argument('--k', type=int, default=10, help='Neighbours per query')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--rerank', type=int, default=4,
+                        help='Shortlist size as a multiple of k for the +rerank modes')
+
+
+def run_mode(mode: str, rerank: int, vectors, queries, truth, k: int) -> dict:
+    storage, _, with_rerank = mode.partition('+')
+    with tempfile.TemporaryDirectory() as directory, override_settings(
+            LOCAL_INDEX_DIRECTORY=f'{directory}/local',
+            LOCAL_INDEX_STORAGE=storage,
+            LOCAL_INDEX_RERANK=rerank if with_rerank else 0,
+            HYBRID_SEARCH_ENABLED=False):
+        store = VectorStoreService(user_id=0, backend='local')
+        start = time.perf_counter()
+        for offset in range(0, len(vectors), 5000):
+            batch = vectors[offset:offset + 5000]
+            store.backend.add(
+                [str(offset + i) for i in range(len(batch))],
+                [f'chunk {offset + i}' for i in range(len(batch))],
+                batch,
+                [{'doc_id': 0} for _ in batch]
+            )
+        build_seconds = time.perf_counter() - start
+
+        index = store.backend.index
+        index.search(queries[0], n_results=k)
+        searched_bytes = index._matrix.nbytes + (index._scales.nbytes if index._scales is not None else 0)
+        disk_bytes = sum(
+            path.stat().st_size for path in Path(index.directory).iterdir()
+            if path.name.startswith(('vectors.', 'scales.'))
+        )
+
+        latencies, hits = [], 0
+        for query, expected in zip(queries, truth):
+            start = time.perf_counter()
+            result = store.search(query, n_results=k)
+            latencies.append(time.perf_counter() - start)
+            hits += len(set(int(i) for i in result['ids'][0]) & set(expected.tolist()))
+        local_index_pool.evict(f'{directory}/local/user_0')
+
+    return {
+        'build_seconds': round(build_seconds, 2),
+        'bytes_per_vector': round(searched_bytes / len(vectors), 1),
+        'memory_mb': round(searched_bytes / 2 ** 20, 1),
+        'disk_mb': round(disk_bytes / 2 ** 20, 1),
+        f'recall_at_{k}': round(hits / truth.size, 4),
+        **_percentiles(latencies),
+    }
+
+
+def run(options, stdout):
+    vectors = clustered_vectors(options['chunks'], options['dim'])
+    queries = nearby_queries(vectors, options['queries'])
+    truth = exact_neighbours(vectors, queries, options['k'])
+    recall_key = f"recall_at_{options['k']}"
+
+    results = {'chunks': options['chunks'], 'queries': options['queries'], 'k': options['k']}
+    for mode in options['modes']:
+        stdout.write(f'Benchmarking {mode} storage...')
+        results[mode] = run_mode(mode, options['rerank'], vectors, queries, truth, options['k'])
+
+    baseline = results.get('float32')
+    if baseline:
+        for mode in options['modes']:
+            results[mode]['memory_saved_pct'] = round(
+                100 * (1 - results[mode]['memory_mb'] / baseline['memory_mb']), 1
+            )
+            results[mode]['recall_lost'] = round(baseline[recall_key] - results[mode][recall_key], 4)
+            stdout.write(f"{mode}: {results[mode]['memory_saved_pct']}% less memory, "
+                         f"recall {results[mode][recall_key]} ({-results[mode]['recall_lost']:+})")
+    return results
@@ -0,0 +1,98 @@
+"""Retrieval latency as one store grows through several corpus sizes.
+
+The store is filled in batches up to each size in turn (1k, 100k and 1M
+chunks by default) and p50/p99 search latency is measured at each step,
+so one run shows how latency scales. Vectors are clustered as in the
+backends benchmark and generated batch by batch, so the 1M step needs
+memory for the index but not for a second copy of the vectors.
+"""
+import tempfile
+import time
+
+import numpy as np
+from django.test import override_settings
+
+from chatbot.services.local_index import local_index_pool
+from chatbot.services.vector_store import VectorStoreService, chroma_pool
+
+from .backends import _percentiles
+
+BATCH_SIZE = 5000
+
+
+def add_arguments(parser):
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000],
+                        help='Corpus sizes to measure at, in chunks')
+    parser.add_argument('--queries', type=int, default=200, help='Queries to time at each size')
+    parser.add_argument('--dim', type=int, default=384, help='Vector dimension')
+    parser.add_argument('--k', type=int, default=3, help='Results per query, as in chat')
+    parser.add_argument('--backends', nargs='+', choices=['chroma', 'local'], default=['local'])
+
+
+class ClusteredVectors:
+    """Deterministic clustered unit vectors, produced in batches"""
+
+    def __init__(self, dim: int, clusters: int = 256, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+        self.seed = seed
+
+    def batch(self, offset: int, count: int) -> np.ndarray:
+        rng = np.random.default_rng((self.seed, offset))
+        labels = rng.integers(0, len(self.centres), size=count)
+        vectors = self.centres[labels] + 0.35 * rng.standard_normal((count, self.centres.shape[1])).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def queries(self, count: int) -> np.ndarray:
+        # Distinct from every batch seed (seed, offset)
+        rng = np.random.default_rng((self.seed + 1, 0, 0))
+        labels = rng.integers(0, len(self.centres), size=count)
+        queries = self.centres[labels] + 0.4 * rng.standard_normal((count, self.centres.shape[1])).astype(np.float32)
+        return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def run_backend(backend: str, vectors: ClusteredVectors, queries: np.ndarray,
+                sizes, k: int, stdout) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as directory, override_settings(
+            CHROMA_PERSIST_DIRECTORY=f'{directory}/chroma',
+            LOCAL_INDEX_DIRECTORY=f'{directory}/local',
+            HYBRID_SEARCH_ENABLED=False):
+        chroma_pool.reset()
+        store = VectorStoreService(user_id=0, backend=backend)
+        stored = 0
+        for size in sorted(sizes):
+            start = time.perf_counter()
+            while stored < size:
+                count = min(BATCH_SIZE, size - stored)
+                store.backend.add(
+                    [str(stored + i) for i in range(count)],
+                    [f'chunk {stored + i}' for i in range(count)],
+                    vectors.batch(stored, count),
+                    [{'doc_id': 0} for _ in range(count)]
+                )
+                stored += count
+            build_seconds = time.perf_counter() - start
+
+            # First query pays for mapping the index; keep it out of the timings
+            store.search(queries[0], n_results=k)
+            latencies = []
+            for query in queries:
+                start = time.perf_counter()
+                store.search(query, n_results=k)
+                latencies.append(time.perf_counter() - start)
+            results[str(size)] = {'build_seconds': round(build_seconds, 2), **_percentiles(latencies)}
+            stdout.write(f"{backend} at {size} chunks: p50 {results[str(size)]['p50_ms']} ms")
+
+        chroma_pool.reset()
+        local_index_pool.evict(f'{directory}/local/user_0')
+    return results
+
+
+def run(options, stdout):
+    vectors = ClusteredVectors(options['dim'])
+    queries = vectors.queries(options['queries'])
+    results = {'sizes': sorted(options['sizes']), 'queries': options['queries'], 'k': options['k']}
+    for backend in options['backends']:
+        results[backend] = run_backend(backend, vectors, queries, options['sizes'], options['k'], stdout)
+    return results
@@ -0,0 +1,65 @@
+"""Import time and first-request latency, with lazy and eager model loading.
+
+Each measurement runs in a fresh interpreter so nothing is already imported.
+"Eager" reproduces the old behaviour of loading the model while importing
+``chatbot.views``; "lazy" is the current behaviour, where the model loads on
+the first embedding call unless it was warmed up beforehand.
+"""
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+
+SCRIPT = '''
+import json, os, sys, time
+sys.path.insert(0, {base_dir!r})
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+start = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter()
+import chatbot.views as views
+imported = time.perf_counter()
+if {eager!r}:
+    views.get_embedding_service().warm_up()
+ready = time.perf_counter()
+views.get_embedding_service().generate_embedding('warm up query for the startup benchmark')
+first = time.perf_counter()
+views.get_embedding_service().generate_embedding('second query for the startup benchmark')
+second = time.perf_counter()
+print(json.dumps({{
+    'django_setup_seconds': setup - start,
+    'views_import_seconds': ready - setup,
+    'first_request_seconds': first - ready,
+    'second_request_seconds': second - first,
+}}))
+'''
+
+
+def add_arguments(parser):
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per mode; the median is reported')
+
+
+def _measure(eager: bool, repeat: int) -> dict:
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', SCRIPT.format(base_dir=str(settings.BASE_DIR), eager=eager)],
+            capture_output=True, text=True, check=True,
+            # Cache hits would hide the model's first forward pass
+            env={**os.environ, 'EMBEDDING_CACHE_ENABLED': 'False'},
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        key: round(sorted(run[key] for run in runs)[len(runs) // 2], 4)
+        for key in runs[0]
+    }
+
+
+def run(options, stdout):
+    return {
+        'eager': _measure(True, options['repeat']),
+        'lazy': _measure(False, options['repeat']),
+    }
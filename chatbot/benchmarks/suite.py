@@ -0,0 +1,27 @@
+"""Ingestion, retrieval and chat benchmarks in one run, with their defaults.
+
+Meant to be run with ``--output`` on every commit worth comparing, e.g.
+``python manage.py benchmark suite --output bench/$(git rev-parse --short HEAD).json``
+and then ``--compare`` against an earlier file. Everything runs offline
+with the fake embedder and the stub LLM.
+"""
+import argparse
+
+from . import load
+
+PARTS = ['ingestion', 'retrieval', 'chat']
+
+
+def add_arguments(parser):
+    parser.add_argument('--only', nargs='+', choices=PARTS, default=PARTS, help='Benchmarks to run')
+
+
+def run(options, stdout):
+    results = {}
+    for name in options['only']:
+        parser = argparse.ArgumentParser()
+        module = load(name)
+        module.add_arguments(parser)
+        stdout.write(f'== {name}')
+        results[name] = module.run(vars(parser.parse_args([])), stdout)
+    return results
@@ -0,0 +1,65 @@
+"""Per-request cost of opening the vector store and running a search.
+
+"per_request_client" reproduces the old behaviour: a new PersistentClient
+and get_or_create_collection for every request. "pooled" goes through
+VectorStoreService, which reuses the process-wide client and collection.
+"""
+import tempfile
+import time
+
+import numpy as np
+from django.test import override_settings
+
+from chatbot.services.vector_store import VectorStoreService, chroma_pool
+
+
+def add_arguments(parser):
+    parser.add_argument('--requests', type=int, default=200, help='Simulated chat requests')
+    parser.add_argument('--chunks', type=int, default=1000, help='Vectors in the collection')
+    parser.add_argument('--dim', type=int, default=384, help='Vector dimension')
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    return {
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 3),
+        'p99_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 3),
+    }
+
+
+def run(options, stdout):
+    import chromadb
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((options['chunks'], options['dim'])).astype(np.float32)
+    queries = rng.standard_normal((options['requests'], options['dim'])).astype(np.float32)
+
+    with tempfile.TemporaryDirectory() as directory, \
+            override_settings(CHROMA_PERSIST_DIRECTORY=directory, HYBRID_SEARCH_ENABLED=False):
+        chroma_pool.reset()
+        store = VectorStoreService(user_id=0, backend='chroma')
+        for start in range(0, len(vectors), 500):
+            batch = vectors[start:start + 500]
+            store.add_documents([f'chunk {start + i}' for i in range(len(batch))], batch)
+
+        per_request = []
+        for query in queries:
+            start = time.perf_counter()
+            client = chromadb.PersistentClient(path=directory)
+            collection = client.get_or_create_collection(name='user_0_docs')
+            collection.query(query_embeddings=[query], n_results=3)
+            per_request.append(time.perf_counter() - start)
+
+        pooled = []
+        for query in queries:
+            start = time.perf_counter()
+            VectorStoreService(user_id=0, backend='chroma').search(query, n_results=3)
+            pooled.append(time.perf_counter() - start)
+        chroma_pool.reset()
+
+    return {
+        'requests': options['requests'],
+        'chunks': options['chunks'],
+        'per_request_client': _percentiles(per_request),
+        'pooled': _percentiles(pooled),
+    }
@@ -0,0 +1,88 @@
+from django.core.management.base import BaseCommand, CommandError
+from datetime import datetime, timezone
+from pathlib import Path
+import json
+import platform
+import subprocess
+
+from chatbot import benchmarks
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).resolve().parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def _numbers(results, prefix=''):
+    """Flatten nested results into {'a.b.c': number}"""
+    flat = {}
+    for key, value in results.items():
+        path = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(_numbers(value, f'{path}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+class Command(BaseCommand):
+    help = 'Run a performance benchmark (see chatbot/benchmarks/)'
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='benchmark', required=True)
+        self.benchmark_options = {}
+        for name in benchmarks.BENCHMARKS:
+            subparser = subparsers.add_parser(name)
+            benchmarks.load(name).add_arguments(subparser)
+            self.benchmark_options[name] = [action.dest for action in subparser._actions if action.dest != 'help']
+            subparser.add_argument('--output', help='Save the results as JSON to this path')
+            subparser.add_argument('--compare', help='Results JSON of an earlier run to compare against')
+
+    def handle(self, *args, **options):
+        name = options['benchmark']
+        if name not in benchmarks.BENCHMARKS:
+            raise CommandError(f'Unknown benchmark: {name}')
+        baseline = None
+        if options['compare']:
+            try:
+                baseline = json.loads(Path(options['compare']).read_text())
+            except (OSError, ValueError) as e:
+                raise CommandError(f'Cannot read {options["compare"]}: {e}')
+
+        results = benchmarks.load(name).run(options, self.stdout)
+        self.stdout.write(json.dumps(results, indent=2))
+
+        if options['output']:
+            record = {
+                'benchmark': name,
+                'commit': _git_commit(),
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'options': {key: options[key] for key in self.benchmark_options.get(name, [])},
+                'results': results,
+            }
+            path = Path(options['output'])
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps(record, indent=2) + '\n')
+            self.stdout.write(f'Saved results to {path}')
+
+        if baseline is not None:
+            self.compare(baseline, results)
+
+    def compare(self, baseline: dict, results: dict):
+        before = _numbers(baseline.get('results', baseline))
+        after = _numbers(results)
+        commit = baseline.get('commit', '')[:10] or 'baseline'
+        self.stdout.write(f'Change against {commit}:')
+        for key, value in after.items():
+            if key not in before:
+                continue
+            old = before[key]
+            change = f'{(value - old) / old * 100:+.1f}%' if old else 'n/a'
+            self.stdout.write(f'  {key}: {old} -> {value} ({change})')
@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.services.embeddings import EmbeddingService
+from chatbot.services.embedding_server import EmbeddingServer
+
+
+class Command(BaseCommand):
+    help = 'Serve embeddings to all workers on this host over a Unix socket'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--socket', default=settings.EMBEDDING_SERVER_SOCKET,
+            help='Unix socket path (default: EMBEDDING_SERVER_SOCKET)'
+        )
+        parser.add_argument(
+            '--max-batch-size', type=int, default=settings.EMBEDDING_SERVER_MAX_BATCH,
+            help='Maximum texts per forward pass'
+        )
+        parser.add_argument(
+            '--max-wait-ms', type=float, default=settings.EMBEDDING_SERVER_MAX_WAIT_MS,
+            help='How long the first request of a batch waits for others'
+        )
+
+    def handle(self, *args, **options):
+        socket_path = options['socket']
+        if not socket_path:
+            raise CommandError('Set EMBEDDING_SERVER_SOCKET or pass --socket')
+
+        # This process owns the model, so it must not try to connect to itself
+        service = EmbeddingService(use_server=False)
+        server = EmbeddingServer(
+            socket_path,
+            service,
+            max_batch_size=options['max_batch_size'],
+            max_wait_ms=options['max_wait_ms']
+        )
+        self.stdout.write(f'Embedding server listening on {socket_path}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,17 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chatbot.services.uploads import expire_sessions
+
+
+class Command(BaseCommand):
+    help = 'Delete resumable upload sessions idle for longer than UPLOAD_SESSION_TTL, with their partial files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=settings.UPLOAD_SESSION_TTL,
+                            help='Idle seconds after which a session is removed')
+
+    def handle(self, *args, **options):
+        expired = expire_sessions(timedelta(seconds=options['max_age']))
+        self.stdout.write(f'Removed {expired} upload sessions')
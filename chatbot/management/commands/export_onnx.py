@@ -0,0 +1,85 @@
+from pathlib import Path
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.services.onnx_encoder import ENCODER_CONFIG, OnnxEncoder, cosine_drift, parity_sentences
+
+
+class Command(BaseCommand):
+    help = ('Export the embedding model to ONNX (float32 and dynamic int8) for '
+            'EMBEDDING_BACKEND=onnx / onnx-int8, and check both against the float model')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default=settings.EMBEDDING_MODEL)
+        parser.add_argument('--output', help='Directory (default: EMBEDDING_ONNX_DIRECTORY/<model>)')
+        parser.add_argument('--opset', type=int, default=14)
+        parser.add_argument('--max-drift', type=float, default=0.01,
+                            help='Largest 1 - cosine similarity to the float model accepted for int8')
+        parser.add_argument('--samples', type=int, default=200, help='Sentences used for the parity check')
+
+    def handle(self, *args, **options):
+        try:
+            import torch
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            from sentence_transformers import SentenceTransformer
+            from sentence_transformers.models import Normalize, Pooling
+        except ImportError as e:
+            # Only needed to export; serving needs onnxruntime and tokenizers
+            raise CommandError(f'Exporting needs torch, sentence-transformers and onnx: {e}')
+
+        output = Path(options['output'] or Path(settings.EMBEDDING_ONNX_DIRECTORY) / options['model'])
+        output.mkdir(parents=True, exist_ok=True)
+        model = SentenceTransformer(options['model'], device='cpu')
+        transformer = model[0]
+        pooling = next((module for module in model if isinstance(module, Pooling)), None)
+        if pooling is None:
+            raise CommandError(f"{options['model']} has no pooling layer")
+        modes = [mode for mode, enabled in (
+            ('mean', pooling.pooling_mode_mean_tokens),
+            ('cls', pooling.pooling_mode_cls_token),
+            ('max', pooling.pooling_mode_max_tokens),
+        ) if enabled]
+        if len(modes) != 1 or pooling.pooling_mode_mean_sqrt_len_tokens:
+            raise CommandError(f'Unsupported pooling configuration: {pooling.get_config_dict()}')
+
+        tokenizer = transformer.tokenizer
+        if not tokenizer.is_fast:
+            raise CommandError('The model needs a fast (Rust) tokenizer to run without transformers')
+        sample = tokenizer(['an example sentence'], return_tensors='pt')
+        input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in sample]
+        axes = {0: 'batch', 1: 'sequence'}
+        transformer.auto_model.eval()
+        with torch.no_grad():
+            torch.onnx.export(
+                transformer.auto_model,
+                tuple(sample[name] for name in input_names),
+                str(output / 'model.onnx'),
+                input_names=input_names,
+                output_names=['last_hidden_state'],
+                dynamic_axes={name: axes for name in input_names + ['last_hidden_state']},
+                opset_version=options['opset']
+            )
+        quantize_dynamic(str(output / 'model.onnx'), str(output / 'model.int8.onnx'), weight_type=QuantType.QInt8)
+        tokenizer.backend_tokenizer.save(str(output / 'tokenizer.json'))
+        (output / ENCODER_CONFIG).write_text(json.dumps({
+            'model_name': options['model'],
+            'max_seq_length': model.max_seq_length,
+            'pooling': modes[0],
+            'normalize': any(isinstance(module, Normalize) for module in model),
+            'dimension': model.get_sentence_embedding_dimension(),
+            'pad_token': tokenizer.pad_token,
+            'pad_token_id': tokenizer.pad_token_id,
+        }, indent=2) + '\n')
+        self.stdout.write(f'Exported {options["model"]} to {output}')
+
+        sentences = parity_sentences(options['samples'])
+        reference = model.encode(sentences, convert_to_numpy=True, show_progress_bar=False)
+        for quantized, limit in ((False, 1e-4), (True, options['max_drift'])):
+            drift = cosine_drift(reference, OnnxEncoder(output, quantized=quantized).encode(sentences))
+            name = 'onnx-int8' if quantized else 'onnx'
+            self.stdout.write(f'{name}: max cosine drift {drift.max():.6f}, mean {drift.mean():.6f}')
+            if drift.max() > limit:
+                raise CommandError(f'{name} drifts from the float model by up to {drift.max():.6f} '
+                                   f'(limit {limit}); do not use it')
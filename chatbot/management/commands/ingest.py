@@ -0,0 +1,47 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+import os
+
+from chatbot.services.bulk_ingestion import BulkIngestion, collect_files
+
+
+class Command(BaseCommand):
+    help = ('Ingest a directory or manifest of PDF/TXT files for a user in bulk. '
+            'Files already ingested are skipped, so an interrupted run resumes when run again')
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='Directory to scan, or a manifest file with one path per line')
+        parser.add_argument('--user', required=True, help='Username the documents belong to')
+        parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1),
+                            help='Processes extracting and chunking files')
+        parser.add_argument('--batch-size', type=int, default=1024,
+                            help='Chunks embedded and stored per batch')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"No user named {options['user']}")
+        try:
+            paths = collect_files(options['source'])
+        except OSError as e:
+            raise CommandError(f"Cannot read {options['source']}: {e}")
+        if not paths:
+            raise CommandError(f"No PDF or TXT files in {options['source']}")
+
+        self.stdout.write(f"Ingesting {len(paths)} files for {user.username} with {options['workers']} workers...")
+        try:
+            report = BulkIngestion(user, workers=options['workers'], batch_size=options['batch_size']).run(paths)
+        except KeyboardInterrupt:
+            raise CommandError('Interrupted; run the command again to resume')
+
+        for name, stage in report['stages'].items():
+            rate = f"{stage['chunks_per_sec']:>10.1f} chunks/s" if stage['chunks_per_sec'] else ''
+            note = f" (summed over {report['workers']} workers)" if name == 'extract' else ''
+            self.stdout.write(f"{name:<8}{stage['seconds']:>9.2f}s{rate}{note}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Ingested {report['chunks']} chunks ({report['pages']} pages) into {report['documents']} documents "
+            f"in {report['seconds']:.2f}s ({report['chunks_per_sec'] or 0:.1f} chunks/s); "
+            f"skipped {report['skipped']} already ingested, {report['duplicates']} duplicates, "
+            f"{report['deduplicated']} shared with other users, {report['failed']} failed"
+        ))
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+import multiprocessing
+import signal
+
+from chatbot.services.ingestion import IngestionService
+
+
+def _worker_main(stop_event, drain):
+    # Each worker opens its own database connections after the fork.
+    connections.close_all()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    IngestionService().run_forever(stop_event=stop_event, drain=drain)
+
+
+class Command(BaseCommand):
+    help = 'Run background worker processes that ingest uploaded documents'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of worker processes (default: 1)'
+        )
+        parser.add_argument(
+            '--drain', action='store_true',
+            help='Exit once the queue is empty instead of polling forever'
+        )
+
+    def handle(self, *args, **options):
+        workers = max(1, options['workers'])
+        drain = options['drain']
+
+        if workers == 1:
+            self.stdout.write('Starting ingestion worker')
+            IngestionService().run_forever(drain=drain)
+            return
+
+        stop_event = multiprocessing.Event()
+
+        def _stop(signum, frame):
+            stop_event.set()
+
+        signal.signal(signal.SIGTERM, _stop)
+        signal.signal(signal.SIGINT, _stop)
+
+        connections.close_all()
+        processes = [
+            # Not daemonic: workers start their own pools for large PDFs
+            multiprocessing.Process(target=_worker_main, args=(stop_event, drain))
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        self.stdout.write(f'Started {workers} ingestion workers')
+
+        for process in processes:
+            process.join()
+        self.stdout.write('Ingestion workers stopped')
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from chatbot.benchmarks.llm_stub import StubLLMServer
+
+
+class Command(BaseCommand):
+    help = ('Serve a local stand-in for the Groq chat API that simulates rate limits, '
+            'slow answers and errors; point LLM_BASE_URL at it for load tests')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8090)
+        parser.add_argument('--rpm', type=int, default=60,
+                            help='Requests per minute before answering 429 (0: unlimited)')
+        parser.add_argument('--latency', type=float, default=0.2, help='Seconds to answer')
+        parser.add_argument('--slow-fraction', type=float, default=0.05, help='Share of answers that are slow')
+        parser.add_argument('--slow-latency', type=float, default=5.0, help='Seconds a slow answer takes')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with 503')
+        parser.add_argument('--tokens', type=int, default=40, help='Words per answer')
+
+    def handle(self, *args, **options):
+        server = StubLLMServer(
+            (options['host'], options['port']),
+            requests_per_minute=options['rpm'],
+            latency=options['latency'],
+            slow_fraction=options['slow_fraction'],
+            slow_latency=options['slow_latency'],
+            error_rate=options['error_rate'],
+            tokens=options['tokens']
+        )
+        self.stdout.write(f'Stub LLM API listening on {server.url} (set LLM_BASE_URL={server.url})')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f'Served: {dict(server.stats)}')
@@ -0,0 +1,58 @@
+from collections import Counter
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from chatbot.models import ChatMessage
+from chatbot.services.embeddings import EmbeddingService
+from chatbot.services.query_embeddings import QueryEmbeddingCache, normalize_query
+
+
+class Command(BaseCommand):
+    help = ('Embed suggested and frequent chat queries into the table workers load at startup, '
+            'so those queries skip the model')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', action='append', dest='files', default=[],
+                            help='Text file with one query per line (repeatable)')
+        parser.add_argument('--top', type=int, default=0,
+                            help='Also include the N most frequent questions from chat history')
+        parser.add_argument('--days', type=int, default=30, help='History window for --top')
+        parser.add_argument('--min-count', type=int, default=2,
+                            help='Times a question must have been asked to count for --top')
+        parser.add_argument('--max-words', type=int, default=12,
+                            help='Ignore longer history questions; they rarely repeat')
+        parser.add_argument('--output', default=str(settings.QUERY_EMBEDDINGS_PATH))
+
+    def handle(self, *args, **options):
+        queries = []
+        for path in options['files']:
+            try:
+                with open(path, encoding='utf-8') as f:
+                    queries.extend(normalize_query(line) for line in f)
+            except OSError as e:
+                raise CommandError(f'Cannot read {path}: {e}')
+
+        if options['top']:
+            since = timezone.now() - timedelta(days=options['days'])
+            counts = Counter()
+            for message in ChatMessage.objects.filter(timestamp__gte=since).values_list(
+                    'message', flat=True).iterator():
+                query = normalize_query(message)
+                if query and len(query.split()) <= options['max_words']:
+                    counts[query] += 1
+            queries.extend(
+                query for query, count in counts.most_common(options['top'])
+                if count >= options['min_count']
+            )
+
+        queries = list(dict.fromkeys(query for query in queries if query))
+        if not queries:
+            raise CommandError('No queries to precompute; pass --file and/or --top')
+
+        service = EmbeddingService()
+        vectors = service.generate_embeddings(queries)
+        QueryEmbeddingCache.save(options['output'], queries, vectors, service.model_id)
+        self.stdout.write(f"Saved {len(queries)} query embeddings to {options['output']}; "
+                          f"workers load them on restart")
@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.services.vector_store import BACKENDS, VectorStoreService
+
+
+class Command(BaseCommand):
+    help = 'Vector store maintenance: prune orphaned chunks, compact, reindex documents or rebuild the BM25 index'
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='action', required=True)
+
+        prune = subparsers.add_parser('prune', help='Remove chunks whose document no longer exists')
+        prune.add_argument('--dry-run', action='store_true', help='Only report orphaned chunks')
+        prune.add_argument('--compact', action='store_true', help='Compact each store after pruning')
+
+        subparsers.add_parser('compact', help='Reclaim the space of deleted chunks')
+        subparsers.add_parser('rebuild-lexical', help='Rebuild the BM25 index from stored chunks')
+
+        reindex = subparsers.add_parser('reindex', help='Drop and re-ingest documents')
+        reindex.add_argument('--document', type=int, action='append', dest='documents',
+                             help='Document id (repeatable); defaults to all of the user\'s documents. '
+                                  'With the shared corpus enabled, their shared content is re-embedded '
+                                  'and other documents sharing it are queued until it is done')
+
+        for subparser in subparsers.choices.values():
+            subparser.add_argument('--user', type=int, action='append', dest='users',
+                                   help='User id (repeatable); defaults to every user with a store')
+            subparser.add_argument('--backend', choices=sorted(BACKENDS),
+                                   default=settings.VECTOR_STORE_BACKEND)
+
+    def handle(self, *args, **options):
+        action = options['action']
+        backend = options['backend']
+        if action == 'reindex' and not options['users']:
+            raise CommandError('reindex requires --user')
+        user_ids = options['users'] or BACKENDS[backend].user_ids()
+
+        stores = [(f'User {user_id}', VectorStoreService(user_id, backend=backend)) for user_id in user_ids]
+        if settings.SHARED_CORPUS_ENABLED and not options['users'] and action != 'reindex':
+            stores.append(('Shared corpus', VectorStoreService.shared(backend=backend)))
+
+        for label, vector_store in stores:
+            if action == 'prune':
+                if options['dry_run']:
+                    orphans = vector_store.find_orphans()
+                    self.stdout.write(f'{label}: {len(orphans)} orphaned chunks')
+                    continue
+                pruned = vector_store.prune_orphans()
+                line = f'{label}: pruned {pruned} orphaned chunks'
+                if options['compact']:
+                    line += f', reclaimed {vector_store.compact()}'
+                self.stdout.write(line)
+            elif action == 'compact':
+                self.stdout.write(f'{label}: reclaimed {vector_store.compact()} chunks')
+            elif action == 'rebuild-lexical':
+                self.stdout.write(f'{label}: indexed {vector_store.rebuild_lexical_index()} chunks')
+            else:
+                queued = vector_store.reindex(options['documents'])
+                self.stdout.write(f'{label}: queued {queued} documents for ingestion')
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.9 on 2026-10-17 17:30
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def mark_processed_documents_completed(apps, schema_editor):
+    Document = apps.get_model('chatbot', 'Document')
+    Document.objects.filter(processed=True).update(status='completed', progress=100)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='chunk_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='error_message',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='progress',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('completed', 'Completed'), ('failed', 'Failed')], default='pending', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['status', 'uploaded_at'], name='chatbot_doc_status_b7e6aa_idx'),
+        ),
+        migrations.RunPython(mark_processed_documents_completed, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.9 on 2026-10-17 17:47
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0002_document_ingestion_status'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['user', 'timestamp', 'id'], name='chatbot_cha_user_id_f865bc_idx'),
+        ),
+    ]
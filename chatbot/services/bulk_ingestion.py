@@ -0,0 +1,444 @@
+"""Bulk ingestion of many files for one user (``manage.py ingest``).
+
+A process pool hashes, extracts and chunks files a bounded window ahead
+of the main process, which embeds the chunks of many files together in
+batches of ``batch_size`` and writes each batch to the vector store with
+a single add. The Document rows opened by a batch are inserted together,
+and its EmbeddingMetadata rows and document updates are written in one
+transaction.
+
+Document rows are the checkpoint. A file whose content the user already
+has as a completed or queued document is skipped before extraction, so a
+rerun only does what an interrupted run left. Documents in flight when a
+run fails or is interrupted are marked failed with their chunks removed,
+and the next run redoes them. After a hard kill they stay 'processing'
+until INGESTION_STALE_SECONDS have passed; then the next run takes them
+over (or an ingest_worker requeues them).
+"""
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import timedelta
+from django.apps import apps
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+import django
+import multiprocessing
+import hashlib
+import logging
+import signal
+import time
+
+if not apps.ready and not apps.loading:
+    # Spawned pool workers import this module for init_bulk_worker and
+    # extract_chunks before anything has set Django up
+    django.setup()
+
+from ..models import Document, DocumentContent, EmbeddingMetadata
+from .chunker import StreamingChunker
+from .corpus import content_for_hash, stored_file_name
+from .document_processor import TXT_BLOCK_SIZE, DocumentProcessor
+from .embeddings import EmbeddingService
+from .metrics import INGESTED_CHUNKS, Trace
+from .response_cache import get_response_cache
+from .uploads import ALLOWED_EXTENSIONS
+from .vector_store import VectorStoreService
+
+logger = logging.getLogger(__name__)
+
+# Document fields written as chunks are stored
+DOCUMENT_FIELDS = ['status', 'processed', 'progress', 'chunk_count', 'updated_at']
+
+# Per-process state of the pool's workers, set by init_bulk_worker
+_bulk_chunker = None
+_bulk_skip_hashes = frozenset()
+
+
+def init_bulk_worker(chunk_size: int, overlap: int, max_tokens: int, tokenizer, skip_hashes: frozenset):
+    """Pool initializer for extract_chunks.
+
+    tokenizer is the embedding model's (picklable) tokenizer, so chunks are
+    token-limited exactly as in the ingestion worker without loading the
+    model in every process.
+    """
+    global _bulk_chunker, _bulk_skip_hashes
+    # Ctrl-C is handled by the parent, which stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    token_counter = (lambda text: len(tokenizer.tokenize(text))) if tokenizer is not None else None
+    _bulk_chunker = StreamingChunker(
+        chunk_size=chunk_size, overlap=overlap, max_tokens=max_tokens, token_counter=token_counter
+    )
+    _bulk_skip_hashes = skip_hashes
+
+
+def extract_chunks(file_path: str) -> dict:
+    """Hash, extract and chunk one file; runs inside a bulk ingestion worker.
+
+    Files whose hash is in the worker's skip set are only hashed. Errors are
+    returned rather than raised so one bad file does not stop the run.
+    """
+    start = time.perf_counter()
+    result = {'path': file_path, 'content_hash': '', 'size': 0, 'pages': 0, 'chunks': []}
+    try:
+        hasher = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(TXT_BLOCK_SIZE), b''):
+                hasher.update(block)
+                result['size'] += len(block)
+        result['content_hash'] = hasher.hexdigest()
+        if result['content_hash'] in _bulk_skip_hashes:
+            result['skipped'] = True
+        else:
+            is_pdf = file_path.lower().endswith('.pdf')
+
+            def pieces():
+                # Already inside a pool worker: no nested pool for large PDFs
+                for page_number, text in DocumentProcessor.iter_pages(file_path, workers=1):
+                    result['pages'] = page_number
+                    # Same page numbering as IngestionService.process
+                    yield (page_number, text + '\n') if is_pdf else (1, text)
+
+            result['chunks'] = [(chunk.text, chunk.metadata()) for chunk in _bulk_chunker.chunks(pieces())]
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def collect_files(source) -> List[Path]:
+    """PDF and TXT files under a directory, or listed in a manifest.
+
+    A manifest has one path per line, relative to the manifest's directory;
+    blank lines and lines starting with '#' are ignored.
+    """
+    source = Path(source)
+    if source.is_dir():
+        paths = sorted(path for path in source.rglob('*') if path.is_file())
+    else:
+        with open(source, encoding='utf-8') as f:
+            lines = [line.strip() for line in f]
+        paths = [source.parent / line for line in lines if line and not line.startswith('#')]
+    return [path for path in paths if path.suffix.lower().lstrip('.') in ALLOWED_EXTENSIONS]
+
+
+@dataclass
+class _File:
+    """A file accepted for ingestion and how many of its chunks are stored"""
+    path: str
+    content_hash: str
+    size: int
+    chunk_total: int
+    # Status its Document is opened with; only 'processing' files are indexed here
+    status: str = Document.STATUS_PROCESSING
+    doc: Optional[Document] = None
+    content: Optional[DocumentContent] = None
+    stored: int = 0
+
+    @property
+    def chunk_key(self) -> int:
+        # Chunks are stored under the content id in the shared corpus
+        return self.content.id if self.content is not None else self.doc.id
+
+
+class BulkIngestion:
+    def __init__(self, user, workers: int = 4, batch_size: int = 1024):
+        self.user = user
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.shared = settings.SHARED_CORPUS_ENABLED
+        self.vector_store = VectorStoreService.shared() if self.shared else VectorStoreService(user.id)
+        self.embedding_service = EmbeddingService()
+        self.trace = Trace('bulk_ingest', user_id=user.id)
+        self.stats = Counter()
+        self._seen = set()
+        # Files waiting for their Document row, files being indexed, and
+        # the chunks still to be embedded as (file, text, metadata)
+        self._unopened: List[_File] = []
+        self._open: List[_File] = []
+        self._chunks = deque()
+
+    def _checkpoint(self) -> Tuple[set, Dict[str, Document]]:
+        """(hashes to skip, documents to take over by hash) left by earlier runs"""
+        cutoff = timezone.now() - timedelta(seconds=settings.INGESTION_STALE_SECONDS)
+        skip, takeover = set(), {}
+        for doc in Document.objects.filter(user=self.user).exclude(content_hash='').order_by('id'):
+            stale = doc.status == Document.STATUS_PROCESSING and doc.updated_at < cutoff
+            if doc.status == Document.STATUS_FAILED or stale:
+                takeover.setdefault(doc.content_hash, doc)
+            else:
+                skip.add(doc.content_hash)
+        return skip, {content_hash: doc for content_hash, doc in takeover.items() if content_hash not in skip}
+
+    def run(self, paths: Iterable) -> dict:
+        """Ingest the files at paths; returns counts and per-stage throughput"""
+        skip, takeover = self._checkpoint()
+        max_tokens = settings.CHUNK_MAX_TOKENS or self.embedding_service.max_chunk_tokens
+        initargs = (settings.CHUNK_SIZE, settings.CHUNK_OVERLAP, max_tokens,
+                    self.embedding_service.tokenizer, frozenset(skip))
+        # spawn: the parent holds torch/BLAS threads that are not fork-safe
+        context = multiprocessing.get_context('spawn')
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                     initializer=init_bulk_worker, initargs=initargs) as executor:
+                paths = iter(paths)
+                pending = deque()
+                try:
+                    while True:
+                        # A bounded window of files is extracted ahead of the embedder
+                        while len(pending) < self.workers * 2:
+                            path = next(paths, None)
+                            if path is None:
+                                break
+                            pending.append(executor.submit(extract_chunks, str(path)))
+                        if not pending:
+                            break
+                        with self.trace.stage('wait'):
+                            result = pending.popleft().result()
+                        self._accept(result, takeover)
+                        while len(self._chunks) >= self.batch_size:
+                            self._flush()
+                except BaseException:
+                    for future in pending:
+                        future.cancel()
+                    raise
+            while self._unopened or self._chunks:
+                self._flush()
+        except BaseException as e:
+            self._abort(e)
+            self.trace.finish('error', error=type(e).__name__, **self.stats)
+            raise
+
+        response_cache = get_response_cache()
+        if response_cache is not None and self.stats['documents']:
+            response_cache.invalidate(self.user.id)
+        if settings.METRICS_ENABLED:
+            INGESTED_CHUNKS.inc(self.stats['chunks'])
+        self.trace.finish(**self.stats)
+        return self.report()
+
+    def _accept(self, result: dict, takeover: Dict[str, Document]):
+        """Queue a file extracted by a worker"""
+        self.stats['files'] += 1
+        self.trace.add('extract', result['seconds'])
+        if result.get('skipped'):
+            self.stats['skipped'] += 1
+            return
+        if result.get('error'):
+            # No row is written, so the next run tries the file again
+            self.stats['failed'] += 1
+            logger.error(f"Could not extract {result['path']}: {result['error']}")
+            return
+        content_hash = result['content_hash']
+        if content_hash in self._seen:
+            self.stats['duplicates'] += 1
+            return
+        self._seen.add(content_hash)
+
+        file = _File(result['path'], content_hash, result['size'], len(result['chunks']),
+                     doc=takeover.get(content_hash))
+        self._unopened.append(file)
+        if self.shared:
+            file.content = content_for_hash(content_hash)
+            if not self._claim(file):
+                self.stats['deduplicated'] += 1
+                return
+        self.stats['pages'] += result['pages']
+        self.stats['chunks'] += file.chunk_total
+        self._chunks.extend((file, text, metadata) for text, metadata in result['chunks'])
+
+    def _claim(self, file: _File) -> bool:
+        """Claim the file's content for indexing in this run.
+
+        Otherwise the content is already indexed, and the file's document
+        opens completed, or a worker is indexing it, and it opens queued to
+        complete from that content like any duplicate upload.
+        """
+        claimed = DocumentContent.objects.filter(
+            id=file.content.id,
+            status__in=[DocumentContent.STATUS_PENDING, DocumentContent.STATUS_FAILED]
+        ).update(status=DocumentContent.STATUS_PROCESSING, updated_at=timezone.now())
+        if claimed:
+            file.content.status = DocumentContent.STATUS_PROCESSING
+            return True
+        file.content.refresh_from_db()
+        file.status = (Document.STATUS_COMPLETED
+                       if file.content.status == DocumentContent.STATUS_COMPLETED
+                       else Document.STATUS_PENDING)
+        return False
+
+    def _recheck_contents(self, files: List[_File]):
+        """Lock the files' contents until their documents are saved.
+
+        A content with no document yet can be released by a user deleting
+        their last document of it after _accept looked it up. Such files
+        move to a fresh content: files indexed here claim it again, others
+        open queued so an ingestion worker completes or indexes them.
+        """
+        present = set(DocumentContent.objects.select_for_update().filter(
+            id__in=[file.content.id for file in files]
+        ).values_list('id', flat=True))
+        for file in files:
+            if file.content.id in present:
+                continue
+            file.content = content_for_hash(file.content_hash)
+            if file.status != Document.STATUS_PROCESSING:
+                file.status = Document.STATUS_PENDING
+            elif not self._claim(file):
+                # None of its chunks are stored yet: they are opened with the document
+                self._chunks = deque(item for item in self._chunks if item[0] is not file)
+                self.stats['chunks'] -= file.chunk_total
+                self.stats['deduplicated'] += 1
+
+    def _store_file(self, file: _File) -> str:
+        """Name of the file's copy in storage, stored as the upload view would"""
+        if self.shared:
+            stored = stored_file_name(file.content_hash)
+            if stored:
+                return stored
+        # save() picks a free name atomically and shortens long ones to fit Document.file
+        with open(file.path, 'rb') as f:
+            return default_storage.save(
+                f'uploads/{get_valid_filename(Path(file.path).name)}', File(f),
+                max_length=Document._meta.get_field('file').max_length
+            )
+
+    def _open_documents(self):
+        """Write the Document rows of files accepted since the last batch"""
+        files, self._unopened = self._unopened, []
+        if not files:
+            return
+        now = timezone.now()
+        with self.trace.stage('record'):
+            for file in files:
+                if file.doc is None:
+                    file.doc = Document(
+                        user=self.user,
+                        filename=Path(file.path).name,
+                        file=self._store_file(file),
+                        file_size=file.size,
+                        content_hash=file.content_hash
+                    )
+            taken_over = [file.doc for file in files if file.doc.pk is not None]
+            with transaction.atomic():
+                if self.shared:
+                    self._recheck_contents(files)
+                for file in files:
+                    completed = file.status == Document.STATUS_COMPLETED
+                    file.doc.content = file.content
+                    file.doc.status = file.status
+                    file.doc.processed = completed
+                    file.doc.progress = 100 if completed else 0
+                    file.doc.chunk_count = file.content.chunk_count if completed else 0
+                    file.doc.attempts += 1
+                    file.doc.error_message = ''
+                    file.doc.updated_at = now
+                Document.objects.bulk_create([file.doc for file in files if file.doc.pk is None])
+                Document.objects.bulk_update(taken_over, DOCUMENT_FIELDS + ['content', 'attempts', 'error_message'])
+        self.stats['documents'] += len(files)
+
+        indexing = [file for file in files if file.status == Document.STATUS_PROCESSING]
+        taken_over_ids = {doc.id for doc in taken_over}
+        with self.trace.stage('store'):
+            # Chunks left behind by an earlier, interrupted attempt
+            self.vector_store.delete_documents([
+                file.chunk_key for file in indexing
+                if file.content is not None or file.doc.id in taken_over_ids
+            ])
+        self._open.extend(indexing)
+
+    def _flush(self):
+        """Embed and store up to batch_size queued chunks, and record them"""
+        self._open_documents()
+        batch = [self._chunks.popleft() for _ in range(min(self.batch_size, len(self._chunks)))]
+        chunk_ids = []
+        if batch:
+            texts = [text for _, text, _ in batch]
+            metadatas = [
+                {'filename': file.doc.filename, 'doc_id': file.chunk_key, **metadata}
+                for file, _, metadata in batch
+            ]
+            with self.trace.stage('embed'):
+                embeddings = self.embedding_service.generate_embeddings(texts)
+            with self.trace.stage('store'):
+                chunk_ids = self.vector_store.add_documents(texts, embeddings, metadatas)
+            for file, _, _ in batch:
+                file.stored += 1
+
+        now = timezone.now()
+        for file in self._open:
+            finished = file.stored == file.chunk_total
+            if finished:
+                file.doc.status = Document.STATUS_COMPLETED
+                file.doc.processed = True
+                file.doc.chunk_count = file.chunk_total
+                if file.content is not None:
+                    file.content.status = DocumentContent.STATUS_COMPLETED
+                    file.content.chunk_count = file.chunk_total
+            file.doc.progress = 100 if finished else min(99, file.stored * 100 // file.chunk_total)
+            # Also the heartbeat that keeps requeue_stale off these rows
+            file.doc.updated_at = now
+            if file.content is not None:
+                file.content.updated_at = now
+
+        with self.trace.stage('record'), transaction.atomic():
+            if not self.shared:
+                EmbeddingMetadata.objects.bulk_create([
+                    EmbeddingMetadata(user=self.user, document=file.doc, chunk_id=chunk_id)
+                    for (file, _, _), chunk_id in zip(batch, chunk_ids)
+                ], batch_size=1000)
+            Document.objects.bulk_update([file.doc for file in self._open], DOCUMENT_FIELDS, batch_size=500)
+            DocumentContent.objects.bulk_update(
+                [file.content for file in self._open if file.content is not None],
+                ['status', 'chunk_count', 'updated_at'], batch_size=500
+            )
+        self._open = [file for file in self._open if file.stored < file.chunk_total]
+
+    def _abort(self, error: BaseException):
+        """Fail the documents in flight and drop their chunks, so the next run redoes them"""
+        files = self._open + [file for file in self._unopened if file.status == Document.STATUS_PROCESSING]
+        message = f'Bulk ingestion interrupted: {type(error).__name__}: {error}'.rstrip(': ')
+        try:
+            self.vector_store.delete_documents([
+                file.chunk_key for file in files if file.doc is not None or file.content is not None
+            ])
+            Document.objects.filter(id__in=[file.doc.id for file in files if file.doc is not None]).update(
+                status=Document.STATUS_FAILED, error_message=message, updated_at=timezone.now()
+            )
+            DocumentContent.objects.filter(id__in=[file.content.id for file in files if file.content is not None]).update(
+                status=DocumentContent.STATUS_FAILED, updated_at=timezone.now()
+            )
+        except Exception as e:
+            logger.error(f"Could not clean up after bulk ingestion stopped: {e}")
+        if files:
+            logger.warning(f"Bulk ingestion stopped with {len(files)} documents in flight; rerun to resume")
+
+    def report(self) -> dict:
+        """Counts of the run, and seconds and chunks/sec of each stage.
+
+        Extraction time is summed over the pool's workers; 'wait' is the time
+        the embedder spent waiting for them.
+        """
+        chunks = self.stats['chunks']
+        stages = {}
+        for name in ('extract', 'wait', 'embed', 'store', 'record'):
+            seconds = self.trace.stages.get(name, 0.0)
+            stages[name] = {
+                'seconds': round(seconds, 2),
+                'chunks_per_sec': round(chunks / seconds, 1) if seconds and name != 'wait' else None,
+            }
+        seconds = self.trace.elapsed()
+        return {
+            **{key: self.stats[key] for key in (
+                'files', 'documents', 'skipped', 'duplicates', 'deduplicated', 'failed', 'pages', 'chunks'
+            )},
+            'workers': self.workers,
+            'seconds': round(seconds, 2),
+            'chunks_per_sec': round(chunks / seconds, 1) if seconds else None,
+            'stages': stages,
+        }
@@ -0,0 +1,165 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r'\S+')
+SENTENCE_END_RE = re.compile(r'[.!?]["\')\]]*$')
+
+
+@dataclass
+class Chunk:
+    """A chunk of text with its position in the source document"""
+    index: int
+    text: str
+    start: int          # character offset of the first word in the source stream
+    end: int            # character offset just past the last word
+    page_start: int
+    page_end: int
+    token_count: int = 0
+
+    def metadata(self) -> dict:
+        return {
+            'chunk_index': self.index,
+            'start': self.start,
+            'end': self.end,
+            'page_start': self.page_start,
+            'page_end': self.page_end,
+        }
+
+
+class StreamingChunker:
+    """Split a stream of (page_number, text) pieces into overlapping chunks.
+
+    Only the words of the chunk being built are held in memory, so the
+    chunker runs in linear time and bounded memory regardless of document
+    size. Chunks are limited to ``chunk_size`` words and, when a
+    ``token_counter`` is given, to ``max_tokens`` tokens; within those
+    limits a chunk ends at a sentence boundary when one falls in its second
+    half. Consecutive chunks share ``overlap`` words, or half of the earlier
+    chunk when that is shorter.
+
+    Pieces may end mid-word (e.g. fixed-size blocks of a TXT file); the
+    partial word is joined with the start of the next piece.
+    """
+
+    def __init__(self, chunk_size: int = 500, overlap: int = 50,
+                 max_tokens: int = None,
+                 token_counter: Optional[Callable[[str], int]] = None):
+        if overlap >= chunk_size:
+            raise ValueError('Chunk overlap must be smaller than chunk size')
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.max_tokens = max_tokens if token_counter else None
+        # WordPiece/BPE tokenizers split on whitespace first, so summing the
+        # per-word counts matches counting the joined chunk
+        self.count_tokens = lru_cache(maxsize=65536)(token_counter) if token_counter else None
+
+    def _cut_point(self, window: List[tuple]) -> int:
+        """Number of leading words of the window to emit as the next chunk"""
+        limit = min(len(window), self.chunk_size)
+        if self.max_tokens:
+            tokens = 0
+            for i in range(limit):
+                tokens += window[i][4]
+                if tokens > self.max_tokens:
+                    limit = max(1, i)
+                    break
+
+        for i in range(limit - 1, limit // 2 - 1, -1):
+            if window[i][3]:
+                return i + 1
+        return limit
+
+    def _keep(self, cut: int) -> int:
+        """Words of a chunk of cut words to repeat at the start of the next one"""
+        # A token-limited chunk can be shorter than the overlap; every chunk
+        # still advances by at least half its length
+        return min(self.overlap, cut // 2)
+
+    def _make_chunk(self, index: int, words: List[tuple]) -> Chunk:
+        return Chunk(
+            index=index,
+            text=' '.join(w[0] for w in words),
+            start=words[0][1],
+            end=words[-1][2],
+            page_start=words[0][5],
+            page_end=words[-1][5],
+            token_count=sum(w[4] for w in words),
+        )
+
+    def _is_full(self, window: List[tuple], tokens: int) -> bool:
+        return len(window) >= self.chunk_size or (
+            self.max_tokens is not None and tokens > self.max_tokens
+        )
+
+    def chunks(self, pieces: Iterable[Tuple[int, str]]) -> Iterator[Chunk]:
+        """Yield Chunk records for a stream of (page_number, text) pieces"""
+        # window entries: (word, start, end, sentence_end, tokens, page)
+        window: List[tuple] = []
+        window_tokens = 0
+        index = 0
+        offset = 0                      # stream offset of the current piece
+        carry = ''
+        carry_start = 0
+        carry_page = 0
+        emitted_until = 0               # words of the window already emitted
+
+        def add_word(word, start, page):
+            nonlocal window_tokens
+            tokens = self.count_tokens(word) if self.count_tokens else 0
+            window.append((word, start, start + len(word),
+                           bool(SENTENCE_END_RE.search(word)), tokens, page))
+            window_tokens += tokens
+
+        for page, text in pieces:
+            if not text:
+                continue
+            base = offset - len(carry)
+            buffer = carry + text
+            offset += len(text)
+
+            matches = list(WORD_RE.finditer(buffer))
+            next_carry = ''
+            next_carry_page = page
+            if matches and matches[-1].end() == len(buffer):
+                last = matches.pop()
+                next_carry = last.group()
+                carry_start = base + last.start()
+                # A word that began in the previous piece keeps its page
+                if carry and last.start() == 0:
+                    next_carry_page = carry_page
+
+            for match in matches:
+                word_page = carry_page if carry and match.start() == 0 else page
+                add_word(match.group(), base + match.start(), word_page)
+
+                while self._is_full(window, window_tokens):
+                    cut = self._cut_point(window)
+                    yield self._make_chunk(index, window[:cut])
+                    index += 1
+                    keep = self._keep(cut)
+                    drop = cut - keep
+                    window_tokens -= sum(w[4] for w in window[:drop])
+                    del window[:drop]
+                    emitted_until = keep
+            carry = next_carry
+            carry_page = next_carry_page
+
+        if carry:
+            add_word(carry, carry_start, carry_page)
+
+        while window and len(window) > emitted_until:
+            cut = self._cut_point(window) if self._is_full(window, window_tokens) else len(window)
+            yield self._make_chunk(index, window[:cut])
+            index += 1
+            if cut == len(window):
+                break
+            keep = self._keep(cut)
+            drop = cut - keep
+            window_tokens -= sum(w[4] for w in window[:drop])
+            del window[:drop]
+            emitted_until = keep
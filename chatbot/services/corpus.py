@@ -0,0 +1,129 @@
+"""Content-addressed sharing of ingested documents between users.
+
+With ``SHARED_CORPUS_ENABLED``, an uploaded file is identified by the
+sha256 of its bytes. Every Document with the same hash points at one
+DocumentContent, whose chunks are stored once in the shared vector store
+(namespace ``shared``) with ``doc_id`` set to the content id. A user can
+read a content's chunks while they own a completed Document for it, so
+retrieval filters the shared store by those content ids. The chunks are
+deleted when the last Document referencing them is.
+"""
+from django.conf import settings
+from django.db import transaction
+from typing import List, Optional, Tuple
+import hashlib
+import logging
+
+from ..models import Document, DocumentContent
+from .response_cache import get_response_cache
+from .vector_store import VectorStoreService
+
+logger = logging.getLogger(__name__)
+
+
+def file_hash(file) -> str:
+    """sha256 hex digest of an uploaded file or an open binary file"""
+    hasher = hashlib.sha256()
+    if hasattr(file, 'chunks'):
+        for block in file.chunks():
+            hasher.update(block)
+    else:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def content_for_hash(content_hash: str) -> DocumentContent:
+    """The DocumentContent for a hash, created on first sight.
+
+    The row is locked until the caller's transaction ends: save the
+    Document referencing it in that transaction, so release_content cannot
+    drop the content in between.
+    """
+    with transaction.atomic():
+        content, _ = DocumentContent.objects.select_for_update().get_or_create(content_hash=content_hash)
+    return content
+
+
+def attach_content(doc: Document) -> DocumentContent:
+    """Link a document to its content, hashing the stored file if needed"""
+    if not doc.content_hash:
+        with doc.file.open('rb') as f:
+            doc.content_hash = file_hash(f)
+    with transaction.atomic():
+        doc.content = content_for_hash(doc.content_hash)
+        Document.objects.filter(id=doc.id).update(content_hash=doc.content_hash, content=doc.content)
+    return doc.content
+
+
+def stored_file_name(content_hash: str) -> Optional[str]:
+    """Name of an already stored file with this content, so it is kept once on disk"""
+    return Document.objects.filter(content_hash=content_hash).exclude(
+        file=''
+    ).values_list('file', flat=True).first()
+
+
+def deduplicate(content_hash: str, file):
+    """(content, file to store) for a new upload.
+
+    With the shared corpus, an identical file that is already stored is
+    reused by name, so each content is kept once on disk. Call it in the
+    transaction that creates the Document (see content_for_hash).
+    """
+    if not settings.SHARED_CORPUS_ENABLED:
+        return None, file
+    return content_for_hash(content_hash), stored_file_name(content_hash) or file
+
+
+def accessible_content_ids(user_id: int) -> List[int]:
+    """Contents whose chunks the user may retrieve"""
+    return list(Document.objects.filter(
+        user_id=user_id,
+        status=Document.STATUS_COMPLETED,
+        content__isnull=False
+    ).values_list('content_id', flat=True).distinct())
+
+
+def search_scope(user_id: int) -> Tuple[VectorStoreService, Optional[List[int]]]:
+    """Vector store to search for a user and the doc_ids to restrict it to"""
+    if settings.SHARED_CORPUS_ENABLED:
+        return VectorStoreService.shared(), accessible_content_ids(user_id)
+    return VectorStoreService(user_id), None
+
+
+def remove_document(doc: Document):
+    """Delete a document and its chunks, keeping chunks other documents share"""
+    content_id = doc.content_id
+    user_id = doc.user_id
+    if content_id is None or not settings.SHARED_CORPUS_ENABLED:
+        try:
+            VectorStoreService(user_id).delete_document(doc.id)
+        except Exception as e:
+            logger.warning(f"Could not delete from vector store: {e}")
+        doc.delete()
+        return
+
+    doc.delete()
+    response_cache = get_response_cache()
+    if response_cache is not None:
+        response_cache.invalidate(user_id)
+    release_content(content_id)
+
+
+def release_content(content_id: int) -> bool:
+    """Drop a content and its shared chunks once no document references it"""
+    with transaction.atomic():
+        # The lock orders this against content_for_hash: a document saved
+        # first keeps the content, and an upload after the delete commits
+        # creates a fresh content instead of attaching to this one
+        content = DocumentContent.objects.select_for_update().filter(id=content_id).first()
+        if content is None or Document.objects.filter(content_id=content_id).exists():
+            return False
+        content.delete()
+    try:
+        removed = VectorStoreService.shared().delete_document(content_id)
+        logger.info(f"Released content {content_id} ({removed} shared chunks)")
+    except Exception as e:
+        # Left for manage.py vector_store prune
+        logger.warning(f"Could not delete shared chunks of content {content_id}: {e}")
+    return True
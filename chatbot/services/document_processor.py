@@ -1,43 +1,130 @@
 from pypdf import PdfReader
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from typing import Iterator, List, Tuple
+import multiprocessing
 import logging
+import os
+
+from .chunker import StreamingChunker
 
 logger = logging.getLogger(__name__)
 
+# PDFs with at least this many pages are extracted across a process pool
+PARALLEL_MIN_PAGES = 50
+# Pages handed to a pool worker per task
+PAGE_BATCH_SIZE = 8
+# Characters read per block when streaming a TXT file
+TXT_BLOCK_SIZE = 1024 * 1024
+
+
+# Per-process reader of PDF extraction workers, set by _init_pdf_worker
+_pdf_reader = None
+
+
+def _init_pdf_worker(file_path: str):
+    """Pool initializer: parse the PDF once per worker rather than once per page batch"""
+    global _pdf_reader
+    _pdf_reader = PdfReader(file_path)
+
+
+def _extract_page_range(start: int, end: int) -> List[str]:
+    """Extract pages [start, end) of the worker's PDF; runs inside a pool worker"""
+    return [_pdf_reader.pages[i].extract_text() or '' for i in range(start, end)]
+
+
 class DocumentProcessor:
     @staticmethod
     def extract_text_from_pdf(file_path: str) -> str:
         """Extract text from PDF file"""
+        return '\n'.join(text for _, text in DocumentProcessor.iter_pdf_pages(file_path))
+
+    @staticmethod
+    def extract_text_from_txt(file_path: str) -> str:
+        """Extract text from TXT file"""
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except Exception as e:
+            logger.error(f"Error extracting TXT text: {e}")
+            raise
+
+    @staticmethod
+    def count_pages(file_path: str) -> int:
+        """Number of pages (PDF) or read blocks (TXT) the page iterator yields"""
+        if file_path.lower().endswith('.pdf'):
+            return len(PdfReader(file_path).pages)
+        return max(1, -(-os.path.getsize(file_path) // TXT_BLOCK_SIZE))
+
+    @staticmethod
+    def iter_pages(file_path: str, workers: int = None) -> Iterator[Tuple[int, str]]:
+        """Yield (page_number, text) for a PDF or TXT file"""
+        if file_path.lower().endswith('.pdf'):
+            return DocumentProcessor.iter_pdf_pages(file_path, workers=workers)
+        return DocumentProcessor.iter_txt_blocks(file_path)
+
+    @staticmethod
+    def iter_pdf_pages(file_path: str, workers: int = None) -> Iterator[Tuple[int, str]]:
+        """Yield (page_number, text) for each PDF page, in order.
+
+        Large PDFs are extracted by a process pool with a bounded window of
+        in-flight page batches, so memory stays proportional to the window
+        rather than to the document.
+        """
         try:
             reader = PdfReader(file_path)
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text()
-            return text
+            page_count = len(reader.pages)
+            if workers is None:
+                workers = min(4, os.cpu_count() or 1)
+
+            if workers <= 1 or page_count < PARALLEL_MIN_PAGES:
+                for i, page in enumerate(reader.pages):
+                    yield i + 1, page.extract_text() or ''
+                return
+
+            del reader
+            ranges = [
+                (start, min(start + PAGE_BATCH_SIZE, page_count))
+                for start in range(0, page_count, PAGE_BATCH_SIZE)
+            ]
+            # spawn: the parent may hold torch/BLAS threads that are not fork-safe
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                     initializer=_init_pdf_worker, initargs=(file_path,)) as executor:
+                pending = deque()
+                next_range = 0
+                while next_range < len(ranges) or pending:
+                    while next_range < len(ranges) and len(pending) < workers * 2:
+                        start, end = ranges[next_range]
+                        pending.append((start, executor.submit(_extract_page_range, start, end)))
+                        next_range += 1
+                    start, future = pending.popleft()
+                    for offset, text in enumerate(future.result()):
+                        yield start + offset + 1, text
         except Exception as e:
             logger.error(f"Error extracting PDF text: {e}")
             raise
-    
+
     @staticmethod
-    def extract_text_from_txt(file_path: str) -> str:
-        """Extract text from TXT file"""
+    def iter_txt_blocks(file_path: str) -> Iterator[Tuple[int, str]]:
+        """Yield (block_number, text) blocks of a TXT file"""
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
+                block_number = 0
+                while True:
+                    block = f.read(TXT_BLOCK_SIZE)
+                    if not block:
+                        break
+                    block_number += 1
+                    yield block_number, block
         except Exception as e:
             logger.error(f"Error extracting TXT text: {e}")
             raise
-    
+
     @staticmethod
     def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
         """Split text into chunks"""
-        words = text.split()
-        chunks = []
-        
-        for i in range(0, len(words), chunk_size - overlap):
-            chunk = ' '.join(words[i:i + chunk_size])
-            if chunk:
-                chunks.append(chunk)
-        
+        chunker = StreamingChunker(chunk_size=chunk_size, overlap=overlap)
+        chunks = [chunk.text for chunk in chunker.chunks([(1, text)])]
         logger.info(f"Created {len(chunks)} chunks from text")
-        return chunks
\ No newline at end of file
+        return chunks
@@ -0,0 +1,210 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+import numpy as np
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """Thread-safe, size-bounded LRU mapping"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class EmbeddingCache:
+    """Content-addressed embedding cache.
+
+    Vectors are keyed by sha256(model name, normalized text) and stored as
+    float32 blobs in a SQLite table shared by every process on the host,
+    with an in-process LRU in front of it. Identical chunks uploaded by
+    different users, and repeated queries, are embedded only once.
+
+    Beyond ``max_entries`` rows the least recently used ones are evicted;
+    use is recorded when a vector is stored or read from disk.
+    """
+
+    def __init__(self, path: str, model_name: str, lru_size: int = 10000,
+                 max_entries: int = 200000):
+        self.path = str(path)
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.memory = LRUCache(lru_size)
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.encode_seconds = 0.0
+        self.encoded_texts = 0
+        self._puts = 0
+
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connection()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            ' key BLOB PRIMARY KEY,'
+            ' dim INTEGER NOT NULL,'
+            ' vector BLOB NOT NULL,'
+            ' last_used REAL NOT NULL DEFAULT 0)'
+        )
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(embeddings)')]
+        if 'last_used' not in columns:
+            # Caches written before eviction; their rows count as least recently used
+            conn.execute('ALTER TABLE embeddings ADD COLUMN last_used REAL NOT NULL DEFAULT 0')
+        conn.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections cannot be shared between threads, nor with
+        # processes forked after they were opened (gunicorn preload)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Unicode- and whitespace-normalize text before hashing"""
+        return ' '.join(unicodedata.normalize('NFC', text).split())
+
+    def key(self, text: str) -> bytes:
+        payload = f"{self.model_name}\0{self.normalize(text)}".encode('utf-8')
+        return hashlib.sha256(payload).digest()
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Cached vectors for texts, None where missing"""
+        keys = [self.key(text) for text in texts]
+        results: List[Optional[np.ndarray]] = [self.memory.get(key) for key in keys]
+        memory_hits = sum(1 for vector in results if vector is not None)
+
+        missing: Dict[bytes, List[int]] = {}
+        for i, vector in enumerate(results):
+            if vector is None:
+                missing.setdefault(keys[i], []).append(i)
+
+        disk_hits = 0
+        if missing:
+            missing_keys = list(missing)
+            conn = self._connection()
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(missing_keys), 500):
+                batch = missing_keys[start:start + 500]
+                placeholders = ','.join('?' * len(batch))
+                rows = conn.execute(
+                    f'SELECT key, vector FROM embeddings WHERE key IN ({placeholders})',
+                    batch
+                ).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    self.memory.put(key, vector)
+                    for i in missing[key]:
+                        results[i] = vector
+                        disk_hits += 1
+                if rows:
+                    now = time.time()
+                    conn.executemany('UPDATE embeddings SET last_used = ? WHERE key = ?',
+                                     [(now, key) for key, _ in rows])
+
+        with self._stats_lock:
+            self.memory_hits += memory_hits
+            self.disk_hits += disk_hits
+            self.misses += len(texts) - memory_hits - disk_hits
+        return results
+
+    def put_many(self, texts: List[str], vectors: np.ndarray):
+        """Store freshly computed vectors"""
+        rows = []
+        now = time.time()
+        for text, vector in zip(texts, vectors):
+            # A copy: a row view would keep the whole encoded batch alive in the LRU
+            vector = np.array(vector, dtype=np.float32, copy=True)
+            key = self.key(text)
+            self.memory.put(key, vector)
+            rows.append((key, vector.shape[0], vector.tobytes(), now))
+        if not rows:
+            return
+        self._connection().executemany(
+            'INSERT OR IGNORE INTO embeddings (key, dim, vector, last_used) VALUES (?, ?, ?, ?)',
+            rows
+        )
+        with self._stats_lock:
+            # Counting the table is not free; trim every 1000 stored vectors
+            evict = self._puts // 1000 != (self._puts + len(rows)) // 1000
+            self._puts += len(rows)
+        if evict:
+            self.evict()
+
+    def evict(self) -> int:
+        """Trim the table to max_entries, dropping the least recently used rows"""
+        conn = self._connection()
+        excess = conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0] - self.max_entries
+        if excess <= 0:
+            return 0
+        return conn.execute(
+            'DELETE FROM embeddings WHERE key IN'
+            ' (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)',
+            (excess,)
+        ).rowcount
+
+    def record_encode(self, count: int, seconds: float):
+        """Record model time spent on cache misses, to estimate time saved"""
+        with self._stats_lock:
+            self.encoded_texts += count
+            self.encode_seconds += seconds
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            per_text = self.encode_seconds / self.encoded_texts if self.encoded_texts else 0.0
+            return {
+                'model': self.model_name,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'memory_entries': len(self.memory),
+                'encode_seconds': round(self.encode_seconds, 3),
+                'estimated_seconds_saved': round(hits * per_text, 3),
+            }
+
+    def clear(self):
+        self.memory.clear()
+        self._connection().execute('DELETE FROM embeddings')
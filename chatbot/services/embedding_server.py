@@ -0,0 +1,216 @@
+"""Local embedding server shared by all gunicorn workers on a host.
+
+One process (``manage.py embedding_server``) holds the model and listens on
+a Unix socket. Concurrent requests from different workers are coalesced
+into micro-batches: the batcher waits at most ``max_wait_ms`` after the
+first request, or until ``max_batch_size`` texts are queued, and then runs
+one forward pass for all of them.
+
+Wire format, both directions: a 4-byte big-endian length followed by a JSON
+header. Replies to ``encode`` are followed by the float32 matrix bytes
+described by ``header['shape']``.
+"""
+from concurrent.futures import Future
+from typing import Callable, List
+import numpy as np
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+_LENGTH = struct.Struct('>I')
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError('Embedding server connection closed')
+        received += n
+    return bytes(buffer)
+
+
+def _send_message(sock: socket.socket, header: dict, payload: bytes = b''):
+    encoded = json.dumps(header).encode('utf-8')
+    sock.sendall(_LENGTH.pack(len(encoded)) + encoded + payload)
+
+
+def _recv_header(sock: socket.socket) -> dict:
+    (length,) = _LENGTH.unpack(_recv_exact(sock, _LENGTH.size))
+    return json.loads(_recv_exact(sock, length))
+
+
+class MicroBatcher:
+    """Coalesce concurrent encode calls into batched forward passes"""
+
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray],
+                 max_batch_size: int = 64, max_wait_ms: float = 5.0):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self.batches = 0
+        self.requests = 0
+        self._thread = threading.Thread(target=self._run, name='embedding-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, texts: List[str]) -> Future:
+        future = Future()
+        self._queue.put((texts, future))
+        return future
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            count = len(items[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while count < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                items.append(item)
+                count += len(item[0])
+
+            texts = [text for item_texts, _ in items for text in item_texts]
+            try:
+                vectors = self.encode_fn(texts)
+            except Exception as e:
+                logger.error(f"Embedding batch of {len(texts)} texts failed: {e}")
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.requests += len(items)
+            offset = 0
+            for item_texts, future in items:
+                future.set_result(vectors[offset:offset + len(item_texts)])
+                offset += len(item_texts)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                request = _recv_header(self.request)
+            except (ConnectionError, OSError):
+                return
+
+            try:
+                op = request.get('op')
+                if op == 'encode':
+                    vectors = server.batcher.submit(request['texts']).result()
+                    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+                    _send_message(self.request, {'shape': list(vectors.shape)}, vectors.tobytes())
+                elif op == 'count_tokens':
+                    counts = [server.service.count_tokens(text) for text in request['texts']]
+                    _send_message(self.request, {'counts': counts})
+                elif op == 'tokenizer':
+                    # Clients count tokens locally rather than one call per word
+                    tokenizer = server.service.model.tokenizer.backend_tokenizer
+                    _send_message(self.request, {'tokenizer': tokenizer.to_str()})
+                elif op == 'info':
+                    _send_message(self.request, {
+                        'model': server.service.model_name,
+                        'dim': server.service.dimension,
+                        'max_seq_length': server.service.max_seq_length,
+                        'batches': server.batcher.batches,
+                        'requests': server.batcher.requests,
+                    })
+                else:
+                    _send_message(self.request, {'error': f'Unknown op: {op}'})
+            except Exception as e:
+                logger.error(f"Embedding server request failed: {e}")
+                _send_message(self.request, {'error': str(e)})
+
+
+class EmbeddingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    # Every worker thread holds its own connection
+    request_queue_size = 128
+
+    def __init__(self, socket_path: str, service, max_batch_size: int = 64,
+                 max_wait_ms: float = 5.0):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.service = service
+        # Vectors are returned unnormalized; clients normalize if configured to
+        self.batcher = MicroBatcher(
+            lambda texts: service.encode(texts, normalize=False),
+            max_batch_size, max_wait_ms
+        )
+        super().__init__(socket_path, _Handler)
+        os.chmod(socket_path, 0o660)
+
+
+class EmbeddingClient:
+    """Client for EmbeddingServer; keeps one connection per thread"""
+
+    def __init__(self, socket_path: str, timeout: float = 30.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _socket(self) -> socket.socket:
+        sock = getattr(self._local, 'sock', None)
+        # A connection inherited across fork would be shared with the parent
+        if sock is None or self._local.pid != os.getpid():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+            self._local.pid = os.getpid()
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def _call(self, request: dict):
+        # Retry once on a fresh connection, e.g. after the server restarted
+        for attempt in range(2):
+            try:
+                sock = self._socket()
+                _send_message(sock, request)
+                header = _recv_header(sock)
+                if 'error' in header:
+                    raise RuntimeError(f"Embedding server error: {header['error']}")
+                if 'shape' in header:
+                    rows, dim = header['shape']
+                    payload = _recv_exact(sock, rows * dim * 4)
+                    return np.frombuffer(payload, dtype=np.float32).reshape(rows, dim)
+                return header
+            except (ConnectionError, OSError):
+                self._close()
+                if attempt:
+                    raise
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        return self._call({'op': 'encode', 'texts': texts})
+
+    def count_tokens(self, texts: List[str]) -> List[int]:
+        return self._call({'op': 'count_tokens', 'texts': texts})['counts']
+
+    def tokenizer(self) -> str:
+        """The model's fast tokenizer, serialized as tokenizer.json"""
+        return self._call({'op': 'tokenizer'})['tokenizer']
+
+    def info(self) -> dict:
+        return self._call({'op': 'info'})
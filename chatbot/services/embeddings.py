@@ -1,23 +1,226 @@
-from sentence_transformers import SentenceTransformer
+from django.conf import settings
+from pathlib import Path
 from typing import List
+import numpy as np
 import logging
+import threading
+import time
+
+from .embedding_cache import EmbeddingCache
+from .embedding_server import EmbeddingClient
+from .onnx_encoder import FastTokenizer
+from .query_embeddings import QueryEmbeddingCache, normalize_query
 
 logger = logging.getLogger(__name__)
 
+# torch: stock SentenceTransformer. -int8: weights quantized to int8 with
+# float activations, which changes the vectors slightly
+INFERENCE_BACKENDS = ('torch', 'torch-int8', 'onnx', 'onnx-int8')
+
+
+def load_model(model_name: str, backend: str = 'torch', threads: int = 0):
+    """The embedding model on an inference backend, with SentenceTransformer's interface"""
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    if backend.startswith('onnx'):
+        from .onnx_encoder import OnnxEncoder
+        return OnnxEncoder(
+            Path(settings.EMBEDDING_ONNX_DIRECTORY) / model_name,
+            quantized=backend == 'onnx-int8',
+            threads=threads
+        )
+
+    # Deferred: importing torch/transformers takes seconds and is
+    # not needed by migrate, collectstatic or non-chat requests
+    import torch
+    from sentence_transformers import SentenceTransformer
+    if threads:
+        torch.set_num_threads(threads)
+    model = SentenceTransformer(model_name)
+    if backend == 'torch-int8':
+        # The linear layers hold nearly all of the weights and compute
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def model_id(model_name: str, backend: str) -> str:
+    """Name for cached vectors: quantized backends do not share them with float ones"""
+    return f"{model_name}@{backend}" if backend.endswith('-int8') else model_name
+
+
 class EmbeddingService:
     _instance = None
-    
-    def __new__(cls, model_name: str = "all-MiniLM-L6-v2"):
+    _model_lock = threading.Lock()
+
+    def __new__(cls, model_name: str = "all-MiniLM-L6-v2", use_server: bool = True):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
-            cls._instance.model = SentenceTransformer(model_name)
-            logger.info(f"Loaded embedding model: {model_name}")
+            cls._instance.model_name = model_name
+            cls._instance.backend = settings.EMBEDDING_BACKEND
+            cls._instance.model_id = model_id(model_name, settings.EMBEDDING_BACKEND)
+            cls._instance._model = None
+            cls._instance.client = None
+            cls._instance._server_info = None
+            cls._instance._tokenizer = None
+            cls._instance.cache = None
+            if settings.EMBEDDING_CACHE_ENABLED:
+                cls._instance.cache = EmbeddingCache(
+                    settings.EMBEDDING_CACHE_PATH,
+                    cls._instance.model_id,
+                    lru_size=settings.EMBEDDING_CACHE_LRU_SIZE,
+                    max_entries=settings.EMBEDDING_CACHE_MAX_ENTRIES
+                )
+            # Chat queries: precomputed table plus LRU, ahead of the cache above
+            cls._instance.queries = QueryEmbeddingCache(settings.QUERY_EMBEDDING_CACHE_SIZE)
+            cls._instance.queries.load(settings.QUERY_EMBEDDINGS_PATH, cls._instance.model_id)
+            if use_server and settings.EMBEDDING_SERVER_SOCKET:
+                # Workers share the model held by `manage.py embedding_server`
+                cls._instance.client = EmbeddingClient(settings.EMBEDDING_SERVER_SOCKET)
+                logger.info(f"Using embedding server at {settings.EMBEDDING_SERVER_SOCKET}")
         return cls._instance
-    
-    def generate_embeddings(self, texts: List[str]) -> List[List[float]]:
-        """Generate embeddings for a list of texts"""
-        return self.model.encode(texts).tolist()
-    
-    def generate_embedding(self, text: str) -> List[float]:
+
+    @property
+    def model(self):
+        """The model on EMBEDDING_BACKEND, loaded on first use"""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    self._model = load_model(self.model_name, self.backend, settings.EMBEDDING_THREADS)
+                    logger.info(f"Loaded embedding model: {self.model_name} ({self.backend})")
+        return self._model
+
+    def warm_up(self):
+        """Load the model (or connect to the embedding server) ahead of the first request"""
+        if self.client is not None and self._info():
+            return
+        self.model
+
+    def _remote(self, call, *args):
+        """Call the embedding server, falling back to a local model if it is down"""
+        if self.client is not None:
+            try:
+                return call(*args)
+            except (ConnectionError, OSError) as e:
+                logger.warning(f"Embedding server unavailable, using local model: {e}")
+        return None
+
+    def encode(self, texts: List[str], batch_size: int = None,
+               normalize: bool = None) -> np.ndarray:
+        """Encode texts into a contiguous (len(texts), dim) float32 array.
+
+        Inputs are sorted by length so each batch pads to similar lengths,
+        and encoded batch_size at a time into a preallocated output array,
+        so memory stays bounded however many texts are passed.
+        """
+        batch_size = batch_size or settings.EMBEDDING_BATCH_SIZE
+        if normalize is None:
+            normalize = settings.EMBEDDING_NORMALIZE
+
+        start = time.monotonic()
+        output = self._remote(self.client.encode, texts) if self.client else None
+        if output is not None:
+            if normalize:
+                output = output / np.linalg.norm(output, axis=1, keepdims=True).clip(min=1e-12)
+        else:
+            output = np.empty((len(texts), self.dimension), dtype=np.float32)
+            order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+            for offset in range(0, len(order), batch_size):
+                indexes = order[offset:offset + batch_size]
+                output[indexes] = self.model.encode(
+                    [texts[i] for i in indexes],
+                    batch_size=len(indexes),
+                    convert_to_numpy=True,
+                    normalize_embeddings=normalize,
+                    show_progress_bar=False
+                )
+        if self.cache is not None:
+            self.cache.record_encode(len(texts), time.monotonic() - start)
+        return output
+
+    def generate_embeddings(self, texts: List[str]) -> np.ndarray:
+        """Generate float32 embeddings for a list of texts"""
+        if self.cache is None:
+            return self.encode(texts)
+
+        cached = self.cache.get_many(texts)
+        missing = {}
+        for i, vector in enumerate(cached):
+            if vector is None:
+                missing.setdefault(self.cache.normalize(texts[i]), []).append(i)
+
+        output = np.empty((len(texts), self.dimension), dtype=np.float32)
+        for i, vector in enumerate(cached):
+            if vector is not None:
+                output[i] = vector
+
+        if missing:
+            # Encode each distinct missing text once
+            first = [indexes[0] for indexes in missing.values()]
+            encoded = self.encode([texts[i] for i in first])
+            self.cache.put_many([texts[i] for i in first], encoded)
+            for indexes, vector in zip(missing.values(), encoded):
+                output[indexes] = vector
+
+        return output
+
+    def _info(self) -> dict:
+        if self._server_info is None:
+            self._server_info = self._remote(self.client.info)
+        return self._server_info
+
+    @property
+    def dimension(self) -> int:
+        """Size of the embedding vectors"""
+        if self._model is None and self.client is not None and self._info():
+            return self._info()['dim']
+        return self.model.get_sentence_embedding_dimension()
+
+    @property
+    def max_seq_length(self) -> int:
+        """Maximum number of tokens the model embeds; longer input is truncated"""
+        if self._model is None and self.client is not None and self._info():
+            return self._info()['max_seq_length']
+        return self.model.max_seq_length
+
+    @property
+    def max_chunk_tokens(self) -> int:
+        """Tokens of text embedded without truncation: the special tokens around it count too"""
+        return self.max_seq_length - self.tokenizer.num_special_tokens_to_add()
+
+    @property
+    def tokenizer(self):
+        """The model's tokenizer; with an embedding server it is fetched from it instead of loading the model"""
+        if self._model is None and self.client is not None:
+            if self._tokenizer is None:
+                try:
+                    serialized = self._remote(self.client.tokenizer)
+                except RuntimeError as e:
+                    logger.warning(f"Embedding server has no fast tokenizer, using local model: {e}")
+                    serialized = None
+                if serialized is not None:
+                    self._tokenizer = FastTokenizer.from_str(serialized)
+            if self._tokenizer is not None:
+                return self._tokenizer
+        return self.model.tokenizer
+
+    def count_tokens(self, text: str) -> int:
+        """Number of tokenizer tokens in text, excluding special tokens"""
+        return len(self.tokenizer.tokenize(text))
+
+    def generate_embedding(self, text: str) -> np.ndarray:
         """Generate embedding for a single text"""
-        return self.model.encode([text])[0].tolist()
\ No newline at end of file
+        return self.generate_embeddings([text])[0]
+
+    def embed_query(self, text: str) -> np.ndarray:
+        """Embedding of a chat query, served from the query caches when possible"""
+        query = normalize_query(text) or text
+        vector = self.queries.get(query)
+        if vector is None:
+            vector = self.generate_embedding(query)
+            self.queries.put(query, vector)
+        return vector
+
+    def cache_stats(self) -> dict:
+        """Hit/miss counters of the embedding caches for this process"""
+        stats = self.cache.stats() if self.cache is not None else {}
+        return {**stats, 'queries': self.queries.stats()}
@@ -0,0 +1,296 @@
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+from datetime import timedelta
+from typing import List, Optional
+import logging
+import time
+
+from ..models import Document, DocumentContent
+from .corpus import attach_content
+from .chunker import Chunk, StreamingChunker
+from .document_processor import DocumentProcessor
+from .embeddings import EmbeddingService
+from .metrics import INGESTED_CHUNKS, Trace
+from .response_cache import get_response_cache
+from .vector_store import VectorStoreService
+
+logger = logging.getLogger(__name__)
+
+
+class IngestionService:
+    """Database-backed ingestion queue.
+
+    Uploaded documents are stored with ``status='pending'``; worker processes
+    (``manage.py ingest_worker``) claim them one at a time, extract, chunk,
+    embed and index them, and record progress on the ``Document`` row so the
+    upload page can poll it.
+
+    With the shared corpus enabled, a document whose content is already
+    indexed completes without any work; documents whose content another
+    worker is indexing wait in the queue until it is done.
+    """
+
+    def __init__(self, poll_interval: float = None, stale_seconds: int = None,
+                 max_attempts: int = None):
+        self.poll_interval = poll_interval or settings.INGESTION_POLL_INTERVAL
+        self.stale_seconds = stale_seconds or settings.INGESTION_STALE_SECONDS
+        self.max_attempts = max_attempts or settings.INGESTION_MAX_ATTEMPTS
+
+    def requeue_stale(self) -> int:
+        """Return jobs whose worker died mid-processing to the queue"""
+        cutoff = timezone.now() - timedelta(seconds=self.stale_seconds)
+        stale = Document.objects.filter(
+            status=Document.STATUS_PROCESSING, updated_at__lt=cutoff
+        )
+        failed = stale.filter(attempts__gte=self.max_attempts).update(
+            status=Document.STATUS_FAILED,
+            error_message='Processing did not finish after repeated attempts.',
+            updated_at=timezone.now()
+        )
+        requeued = stale.update(status=Document.STATUS_PENDING, updated_at=timezone.now())
+        # Contents are heartbeated with their document, see _set_progress
+        DocumentContent.objects.filter(
+            status=DocumentContent.STATUS_PROCESSING, updated_at__lt=cutoff
+        ).update(status=DocumentContent.STATUS_PENDING, updated_at=timezone.now())
+        if failed or requeued:
+            logger.warning(f"Requeued {requeued} stale ingestion jobs, failed {failed}")
+        return requeued
+
+    def claim_next(self) -> Optional[Document]:
+        """Atomically claim the oldest pending document, if any"""
+        candidates = Document.objects.filter(
+            status=Document.STATUS_PENDING
+        ).exclude(
+            # Waits for the worker indexing the same content
+            content__status=DocumentContent.STATUS_PROCESSING
+        ).order_by('uploaded_at').values_list('id', flat=True)[:10]
+
+        for doc_id in candidates:
+            # Conditional UPDATE is the claim: only one worker can move a row
+            # out of 'pending', on SQLite as well as PostgreSQL.
+            claimed = Document.objects.filter(
+                id=doc_id, status=Document.STATUS_PENDING
+            ).update(
+                status=Document.STATUS_PROCESSING,
+                progress=0,
+                attempts=F('attempts') + 1,
+                error_message='',
+                updated_at=timezone.now()
+            )
+            if claimed:
+                return Document.objects.select_related('user').get(id=doc_id)
+        return None
+
+    def _set_progress(self, doc: Document, progress: int):
+        doc.progress = progress
+        Document.objects.filter(id=doc.id).update(progress=progress, updated_at=timezone.now())
+        if doc.content_id is not None and settings.SHARED_CORPUS_ENABLED:
+            DocumentContent.objects.filter(id=doc.content_id).update(updated_at=timezone.now())
+
+    def _complete(self, doc: Document, chunk_count: int):
+        Document.objects.filter(id=doc.id).update(
+            status=Document.STATUS_COMPLETED,
+            processed=True,
+            progress=100,
+            chunk_count=chunk_count,
+            updated_at=timezone.now()
+        )
+
+    def _claim_content(self, doc: Document, trace: Trace) -> Optional[DocumentContent]:
+        """Claim the document's content for indexing.
+
+        Returns None when there is nothing to index: the document was
+        completed from already indexed content, or put back in the queue
+        because another worker is indexing it.
+        """
+        content = doc.content or attach_content(doc)
+        claimed = DocumentContent.objects.filter(
+            id=content.id,
+            status__in=[DocumentContent.STATUS_PENDING, DocumentContent.STATUS_FAILED]
+        ).update(status=DocumentContent.STATUS_PROCESSING, updated_at=timezone.now())
+        if claimed:
+            return content
+
+        content.refresh_from_db()
+        if content.status == DocumentContent.STATUS_COMPLETED:
+            self._complete(doc, content.chunk_count)
+            response_cache = get_response_cache()
+            if response_cache is not None:
+                response_cache.invalidate(doc.user_id)
+            logger.info(f"Document {doc.id} shares indexed content {content.id}, skipped ingestion")
+            trace.finish('deduplicated', chunks=content.chunk_count)
+        else:
+            Document.objects.filter(id=doc.id).update(
+                status=Document.STATUS_PENDING,
+                attempts=F('attempts') - 1,
+                updated_at=timezone.now()
+            )
+            trace.finish('deferred')
+        return None
+
+    @staticmethod
+    def build_chunker(embedding_service: EmbeddingService) -> StreamingChunker:
+        """Chunker configured from settings, token-limited to the embedding model"""
+        max_tokens = settings.CHUNK_MAX_TOKENS or embedding_service.max_chunk_tokens
+        return StreamingChunker(
+            chunk_size=settings.CHUNK_SIZE,
+            overlap=settings.CHUNK_OVERLAP,
+            max_tokens=max_tokens,
+            token_counter=embedding_service.count_tokens
+        )
+
+    def process(self, doc: Document):
+        """Extract, chunk, embed and index a claimed document.
+
+        Pages stream through the chunker and chunks are embedded and stored
+        in batches, so memory is bounded by the batch size rather than by
+        the size of the document.
+        """
+        start = time.monotonic()
+        trace = Trace('ingest', document_id=doc.id, user_id=doc.user_id)
+        vector_store = None
+        content = None
+        try:
+            if settings.SHARED_CORPUS_ENABLED:
+                content = self._claim_content(doc, trace)
+                if content is None:
+                    return
+                # Chunks are stored once, under the content id
+                vector_store = VectorStoreService.shared()
+                chunk_key, tracked = content.id, None
+            else:
+                vector_store = VectorStoreService(doc.user_id)
+                chunk_key, tracked = doc.id, doc
+
+            processor = DocumentProcessor()
+            file_path = doc.file.path
+            total_pages = processor.count_pages(file_path)
+            pages_done = 0
+
+            is_pdf = file_path.lower().endswith('.pdf')
+            last_heartbeat = time.monotonic()
+
+            def heartbeat():
+                # Extraction can run long before the first batch is stored;
+                # without this the job would look stale and be requeued
+                nonlocal last_heartbeat
+                if time.monotonic() - last_heartbeat >= settings.INGESTION_HEARTBEAT_SECONDS:
+                    self._set_progress(doc, min(99, pages_done * 100 // total_pages))
+                    last_heartbeat = time.monotonic()
+
+            def pieces():
+                nonlocal pages_done
+                pages = processor.iter_pages(file_path, workers=settings.PDF_EXTRACTION_WORKERS)
+                while True:
+                    with trace.stage('extract'):
+                        page = next(pages, None)
+                    if page is None:
+                        return
+                    page_number, text = page
+                    pages_done = page_number
+                    heartbeat()
+                    # PDF pages are separate; TXT blocks continue mid-word
+                    # and all belong to "page" 1
+                    if is_pdf:
+                        yield page_number, text + '\n'
+                    else:
+                        yield 1, text
+
+            # Chunks left behind by an earlier, interrupted attempt
+            vector_store.delete_document(chunk_key)
+            embedding_service = EmbeddingService()
+            chunker = self.build_chunker(embedding_service)
+            chunk_count = 0
+            batch: List[Chunk] = []
+
+            def flush():
+                nonlocal chunk_count, last_heartbeat
+                texts = [chunk.text for chunk in batch]
+                metadatas = [
+                    {'filename': doc.filename, 'doc_id': chunk_key, **chunk.metadata()}
+                    for chunk in batch
+                ]
+                with trace.stage('embed'):
+                    embeddings = embedding_service.generate_embeddings(texts)
+                with trace.stage('store'):
+                    vector_store.add_documents(texts, embeddings, metadatas, document=tracked)
+                chunk_count += len(batch)
+                batch.clear()
+                self._set_progress(doc, min(99, pages_done * 100 // total_pages))
+                last_heartbeat = time.monotonic()
+
+            pipeline_start = time.perf_counter()
+            for chunk in chunker.chunks(pieces()):
+                batch.append(chunk)
+                if len(batch) >= settings.INGESTION_BATCH_SIZE:
+                    flush()
+            if batch:
+                flush()
+            # Chunking is interleaved with the other stages; it is what is left
+            trace.add('chunk', max(0.0, time.perf_counter() - pipeline_start - sum(
+                trace.stages.get(name, 0.0) for name in ('extract', 'embed', 'store')
+            )))
+
+            if content is not None:
+                DocumentContent.objects.filter(id=content.id).update(
+                    status=DocumentContent.STATUS_COMPLETED,
+                    chunk_count=chunk_count,
+                    updated_at=timezone.now()
+                )
+                response_cache = get_response_cache()
+                if response_cache is not None:
+                    response_cache.invalidate(doc.user_id)
+            self._complete(doc, chunk_count)
+            if settings.METRICS_ENABLED:
+                INGESTED_CHUNKS.inc(chunk_count)
+            trace.finish(pages=total_pages, chunks=chunk_count)
+            logger.info(
+                f"Ingested document {doc.id} ({total_pages} pages, {chunk_count} chunks) "
+                f"in {time.monotonic() - start:.2f}s"
+            )
+        except Exception as e:
+            logger.error(f"Error processing document {doc.id}: {e}")
+            if vector_store is not None:
+                # Don't leave a partially indexed document searchable
+                try:
+                    vector_store.delete_document(chunk_key)
+                except Exception as cleanup_error:
+                    logger.warning(f"Could not remove chunks of document {doc.id}: {cleanup_error}")
+            if content is not None:
+                DocumentContent.objects.filter(id=content.id).update(
+                    status=DocumentContent.STATUS_FAILED, updated_at=timezone.now()
+                )
+            Document.objects.filter(id=doc.id).update(
+                status=Document.STATUS_FAILED,
+                error_message=str(e),
+                updated_at=timezone.now()
+            )
+            trace.finish('error', error=type(e).__name__)
+
+    def run_once(self) -> bool:
+        """Process a single job; returns False when the queue is empty"""
+        doc = self.claim_next()
+        if doc is None:
+            return False
+        self.process(doc)
+        return True
+
+    def run_forever(self, stop_event=None, drain: bool = False):
+        """Worker loop: poll the queue until stopped (or empty when draining)"""
+        last_stale_check = 0.0
+        while stop_event is None or not stop_event.is_set():
+            close_old_connections()
+            if time.monotonic() - last_stale_check > self.poll_interval * 10:
+                self.requeue_stale()
+                last_stale_check = time.monotonic()
+
+            if self.run_once():
+                continue
+            if drain:
+                break
+            if stop_event is not None:
+                stop_event.wait(self.poll_interval)
+            else:
+                time.sleep(self.poll_interval)
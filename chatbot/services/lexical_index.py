@@ -0,0 +1,408 @@
+"""Per-user BM25 inverted index stored as immutable NumPy segments.
+
+Layout of an index directory (one per user):
+
+- ``meta.sqlite3``: chunk ordinal -> (id, doc_id, length, deleted), the
+  list of live segments and index info; ``deleted`` is 0 for live chunks,
+  else the generation that deleted them
+- ``seg_<n>.npz``: one segment per add() call, holding the sorted term
+  array, posting offsets, and the chunk ordinals and term frequencies of
+  every posting
+
+Each ingestion batch becomes a new segment, so indexing is incremental.
+Once more than ``max_segments`` exist, the newest run of similarly sized
+segments is merged (a tiered policy, so each posting is rewritten a
+logarithmic number of times), dropping postings of deleted chunks.
+Queries look terms up with a binary search per segment and score
+postings with vectorized BM25.
+
+Readers notice changes through a generation counter and read only what
+changed since the generation they loaded: chunks with new ordinals and
+chunks deleted by later generations. A merge that purges deleted chunks
+starts a new epoch, after which readers reload the chunk table once.
+"""
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import math
+import os
+import re
+import sqlite3
+import threading
+import logging
+
+from .local_index import LocalIndexPool
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r'\w+(?:[-./:]\w+)*')
+PART_RE = re.compile(r'[-./:_]')
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased terms; compound terms (ERR-1234, v1.2) also yield their parts"""
+    terms = TOKEN_RE.findall(text.lower())
+    for term in [term for term in terms if not term.isalnum()]:
+        terms.extend(part for part in PART_RE.split(term) if part)
+    return terms
+
+
+def _build_segment(vocabulary: np.ndarray, term_ids: np.ndarray, ords: np.ndarray,
+                   freqs: np.ndarray) -> Dict[str, np.ndarray]:
+    """Segment arrays from parallel (term id, ordinal, frequency) postings.
+
+    vocabulary is sorted and term_ids index into it; terms without
+    postings are dropped.
+    """
+    used, term_ids = np.unique(term_ids, return_inverse=True)
+    vocabulary = vocabulary[used]
+    # One integer sort key (term, then ordinal); much faster than lexsort
+    order = np.argsort(term_ids.astype(np.int64) * (int(ords.max()) + 1) + ords) if len(ords) else ords
+    counts = np.bincount(term_ids, minlength=len(vocabulary))
+    offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return {
+        'terms': vocabulary,
+        'offsets': offsets,
+        'ords': ords[order].astype(np.int64),
+        'freqs': freqs[order].astype(np.float32),
+    }
+
+
+class LexicalIndex:
+    def __init__(self, directory, k1: float = 1.2, b: float = 0.75, max_segments: int = 8):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.k1 = k1
+        self.b = b
+        self.max_segments = max_segments
+
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._generation = None
+        self._epoch = None
+        self._segments: Dict[str, Dict[str, np.ndarray]] = {}
+        self._lengths = np.empty(0, dtype=np.float32)
+        self._live = np.empty(0, dtype=bool)
+        self._doc_ids = np.empty(0, dtype=np.int64)
+        self._avg_length = 0.0
+        self._live_count = 0
+
+        conn = self._conn()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS chunks ('
+            ' ord INTEGER PRIMARY KEY,'
+            ' id TEXT NOT NULL UNIQUE,'
+            ' doc_id TEXT,'
+            ' length INTEGER NOT NULL,'
+            ' deleted INTEGER NOT NULL DEFAULT 0)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS chunks_doc_id ON chunks (doc_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS chunks_deleted ON chunks (deleted)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS segments ('
+            ' name TEXT PRIMARY KEY,'
+            ' seq INTEGER NOT NULL,'
+            ' postings INTEGER NOT NULL)'
+        )
+        conn.execute('CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    # -- storage helpers ------------------------------------------------
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.directory / 'meta.sqlite3', timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _get_info(conn, key: str, default=None):
+        row = conn.execute('SELECT value FROM info WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    @staticmethod
+    def _set_info(conn, key: str, value):
+        conn.execute('INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def _next_value(self, conn, key: str, step: int = 1) -> int:
+        value = int(self._get_info(conn, key, 0))
+        self._set_info(conn, key, value + step)
+        return value
+
+    def _write_segment(self, conn, segment: Dict[str, np.ndarray], seq: int = None) -> str:
+        # Names are never reused: readers cache segments by name
+        number = self._next_value(conn, 'segment_seq')
+        seq = number if seq is None else seq
+        name = f"seg_{number}.npz"
+        tmp_path = self.directory / f'{name}.tmp.npz'
+        np.savez(tmp_path, **segment)
+        os.replace(tmp_path, self.directory / name)
+        conn.execute('INSERT OR REPLACE INTO segments (name, seq, postings) VALUES (?, ?, ?)',
+                     (name, seq, len(segment['ords'])))
+        return name
+
+    def _load_segment(self, name: str) -> Dict[str, np.ndarray]:
+        with np.load(self.directory / name) as data:
+            return {key: data[key] for key in data.files}
+
+    # -- reader state -----------------------------------------------------
+
+    def _refresh(self):
+        """Reload segments and chunk statistics if a writer changed them"""
+        conn = self._conn()
+        generation = int(self._get_info(conn, 'generation', 0))
+        if generation == self._generation:
+            return
+
+        with self._lock:
+            for attempt in range(2):
+                names = [name for (name,) in conn.execute('SELECT name FROM segments')]
+                try:
+                    segments = {
+                        name: self._segments.get(name) or self._load_segment(name)
+                        for name in names
+                    }
+                    break
+                except FileNotFoundError:
+                    # A merge replaced the segment list while we read it
+                    if attempt:
+                        raise
+
+            size = int(self._get_info(conn, 'next_ord', 0))
+            # Purged chunks lose their rows, so deletions a reader has not
+            # seen yet can only be found again by reading every row
+            epoch = int(self._get_info(conn, 'epoch', 0))
+            reusable = epoch == self._epoch and self._generation is not None
+            old_size = min(len(self._lengths), size) if reusable else 0
+            lengths = np.zeros(size, dtype=np.float32)
+            live = np.zeros(size, dtype=bool)
+            doc_ids = np.full(size, -1, dtype=np.int64)
+            lengths[:old_size] = self._lengths[:old_size]
+            live[:old_size] = self._live[:old_size]
+            doc_ids[:old_size] = self._doc_ids[:old_size]
+            # Chunks added since the last load; ordinals are never reused
+            rows = conn.execute(
+                'SELECT ord, length, deleted, COALESCE(CAST(doc_id AS INTEGER), -1) FROM chunks'
+                ' WHERE ord >= ? AND ord < ?', (old_size, size)
+            ).fetchall()
+            if rows:
+                table = np.asarray(rows, dtype=np.int64)
+                lengths[table[:, 0]] = table[:, 1]
+                live[table[:, 0]] = table[:, 2] == 0
+                doc_ids[table[:, 0]] = table[:, 3]
+            if reusable:
+                deleted = np.fromiter(
+                    (o for (o,) in conn.execute(
+                        'SELECT ord FROM chunks WHERE deleted > ? AND ord < ?', (self._generation, old_size)
+                    )),
+                    dtype=np.int64
+                )
+                live[deleted] = False
+
+            self._segments = segments
+            self._lengths, self._live, self._doc_ids = lengths, live, doc_ids
+            self._live_count = int(live.sum())
+            self._avg_length = float(lengths[live].mean()) if self._live_count else 0.0
+            self._generation, self._epoch = generation, epoch
+
+    # -- writes ---------------------------------------------------------
+
+    def add(self, ids: List[str], texts: List[str], doc_ids: List = None):
+        """Index a batch of chunks as a new segment"""
+        if not ids:
+            return
+        doc_ids = doc_ids or [None] * len(ids)
+        counters = [Counter(tokenize(text)) for text in texts]
+
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            first = self._next_value(conn, 'next_ord', len(ids))
+            conn.executemany(
+                'INSERT INTO chunks (ord, id, doc_id, length) VALUES (?, ?, ?, ?)',
+                [
+                    (first + i, ids[i], str(doc_ids[i]) if doc_ids[i] is not None else None,
+                     sum(counter.values()))
+                    for i, counter in enumerate(counters)
+                ]
+            )
+            terms = [term for counter in counters for term in counter]
+            if terms:
+                ords = np.fromiter(
+                    (first + i for i, counter in enumerate(counters) for _ in counter),
+                    dtype=np.int64, count=len(terms)
+                )
+                freqs = np.fromiter(
+                    (freq for counter in counters for freq in counter.values()),
+                    dtype=np.float32, count=len(terms)
+                )
+                vocabulary, term_ids = np.unique(np.array(terms), return_inverse=True)
+                self._write_segment(conn, _build_segment(vocabulary, term_ids, ords, freqs))
+            self._next_value(conn, 'generation')
+            sizes = conn.execute('SELECT name, postings FROM segments ORDER BY seq').fetchall()
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if len(sizes) > self.max_segments:
+            self.merge(self._merge_candidates(sizes))
+
+    @staticmethod
+    def _merge_candidates(sizes: List[Tuple[str, int]]) -> List[str]:
+        """Newest run of segments each at most twice the size of those after it"""
+        start = len(sizes) - 1
+        total = sizes[start][1]
+        while start > 0 and sizes[start - 1][1] <= 2 * total:
+            start -= 1
+            total += sizes[start][1]
+        start = min(start, len(sizes) - 2)
+        return [name for name, _ in sizes[start:]]
+
+    def _mark_deleted(self, column: str, values: List[str]) -> int:
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Chunks are marked with the generation that deletes them, so
+            # readers fetch only deletions newer than what they loaded
+            generation = int(self._get_info(conn, 'generation', 0)) + 1
+            deleted = 0
+            for start in range(0, len(values), 500):
+                batch = values[start:start + 500]
+                placeholders = ','.join('?' * len(batch))
+                deleted += conn.execute(
+                    f'UPDATE chunks SET deleted = ? WHERE deleted = 0 AND {column} IN ({placeholders})',
+                    [generation, *batch]
+                ).rowcount
+            if deleted:
+                self._set_info(conn, 'generation', generation)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return deleted
+
+    def delete(self, ids: List[str]) -> int:
+        return self._mark_deleted('id', list(ids))
+
+    def delete_documents(self, doc_ids: List[int]) -> int:
+        return self._mark_deleted('doc_id', [str(int(doc_id)) for doc_id in doc_ids])
+
+    def merge(self, names: List[str] = None) -> int:
+        """Merge segments (all by default) without deleted chunks; returns chunks purged"""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            listed = dict(conn.execute('SELECT name, seq FROM segments').fetchall())
+            names = [name for name in (names or listed) if name in listed]
+            deleted = np.fromiter(
+                (o for (o,) in conn.execute('SELECT ord FROM chunks WHERE deleted != 0')),
+                dtype=np.int64
+            )
+            segments = [self._load_segment(name) for name in names]
+            # Merge the (small) vocabularies, then work on integer term ids
+            vocabulary = np.unique(np.concatenate([s['terms'] for s in segments])) if segments else np.array([], dtype=str)
+            term_ids = np.concatenate([
+                np.repeat(np.searchsorted(vocabulary, s['terms']), np.diff(s['offsets'])) for s in segments
+            ]) if segments else np.empty(0, dtype=np.int64)
+            ords = np.concatenate([s['ords'] for s in segments]) if segments else np.empty(0, dtype=np.int64)
+            freqs = np.concatenate([s['freqs'] for s in segments]) if segments else np.empty(0, dtype=np.float32)
+            keep = ~np.isin(ords, deleted)
+
+            conn.executemany('DELETE FROM segments WHERE name = ?', [(name,) for name in names])
+            if keep.any():
+                # The merged segment takes the newest sequence number of its inputs
+                self._write_segment(
+                    conn, _build_segment(vocabulary, term_ids[keep], ords[keep], freqs[keep]),
+                    seq=max(listed[name] for name in names)
+                )
+            # Postings of deleted chunks left in other segments are masked
+            # at query time: ordinals without a row are not live
+            purged = conn.execute('DELETE FROM chunks WHERE deleted != 0').rowcount
+            if purged:
+                self._next_value(conn, 'epoch')
+            self._next_value(conn, 'generation')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        for name in names:
+            (self.directory / name).unlink(missing_ok=True)
+        logger.info(f"Merged {len(names)} lexical segments in {self.directory}, purged {purged} chunks")
+        return purged
+
+    def drop(self):
+        """Delete the index from disk"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+        for path in self.directory.iterdir():
+            path.unlink()
+        self.directory.rmdir()
+
+    # -- reads ----------------------------------------------------------
+
+    def count(self) -> int:
+        self._refresh()
+        return self._live_count
+
+    def search(self, query: str, n_results: int = 10,
+               doc_ids: Optional[List[int]] = None) -> List[Tuple[str, float]]:
+        """(chunk id, BM25 score) of the best matching chunks, optionally of doc_ids only"""
+        self._refresh()
+        with self._lock:
+            segments, lengths, live = self._segments, self._lengths, self._live
+            row_doc_ids = self._doc_ids
+            live_count, avg_length = self._live_count, self._avg_length
+        terms = sorted(set(tokenize(query)))
+        if not terms or not live_count or not segments:
+            return []
+
+        query_terms = np.array(terms)
+        postings: Dict[str, List[Tuple[np.ndarray, np.ndarray]]] = {term: [] for term in terms}
+        for segment in segments.values():
+            vocabulary = segment['terms']
+            positions = np.searchsorted(vocabulary, query_terms)
+            for term, position in zip(terms, positions):
+                if position < len(vocabulary) and vocabulary[position] == term:
+                    start, end = segment['offsets'][position], segment['offsets'][position + 1]
+                    postings[term].append((segment['ords'][start:end], segment['freqs'][start:end]))
+
+        scores = np.zeros(len(lengths), dtype=np.float32)
+        norm = self.k1 * (1.0 - self.b + self.b * lengths / max(avg_length, 1e-9))
+        for term, lists in postings.items():
+            if not lists:
+                continue
+            ords = np.concatenate([o for o, _ in lists])
+            freqs = np.concatenate([f for _, f in lists])
+            document_frequency = int(live[ords].sum())
+            if not document_frequency:
+                continue
+            idf = math.log(1.0 + (live_count - document_frequency + 0.5) / (document_frequency + 0.5))
+            # Every chunk appears at most once per term, so plain indexing accumulates
+            scores[ords] += idf * freqs * (self.k1 + 1.0) / (freqs + norm[ords])
+
+        scores[~live] = 0.0
+        if doc_ids is not None:
+            # Term statistics stay corpus-wide; only the candidates are restricted
+            scores[~np.isin(row_doc_ids, np.asarray(doc_ids, dtype=np.int64))] = 0.0
+        matched = np.flatnonzero(scores)
+        if not len(matched):
+            return []
+        k = min(n_results, len(matched))
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+
+        placeholders = ','.join('?' * len(top))
+        ids = dict(self._conn().execute(
+            f'SELECT ord, id FROM chunks WHERE ord IN ({placeholders})', [int(o) for o in top]
+        ).fetchall())
+        return [(ids[int(o)], float(scores[o])) for o in top if int(o) in ids]
+
+
+lexical_index_pool = LocalIndexPool(LexicalIndex)
@@ -0,0 +1,282 @@
+"""Admission control for LLM calls.
+
+Three layers keep bursts from stalling every worker on the provider's
+rate limits:
+
+- ``FairQueue`` caps concurrent LLM calls per process and grants free
+  slots round-robin across users, so one user's burst waits behind
+  itself rather than in front of everyone else.
+- ``RateLimiter`` holds token buckets for requests and tokens per minute
+  in a SQLite table shared by every process on the host, so workers
+  together stay under the provider's limits instead of each discovering
+  them with a 429. A 429 that still gets through pauses every worker for
+  its retry-after.
+- ``backoff_delay`` spaces retries of failed calls with full jitter, so
+  workers that failed together do not retry together.
+
+Every wait is bounded by the request's deadline: a request that cannot be
+answered in time fails at once with ``LLMOverloaded`` rather than queueing,
+which keeps latency bounded under overload.
+"""
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from typing import Optional
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LLMError(Exception):
+    """An LLM call that failed, with the HTTP status to answer the client with"""
+    status = 502
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMOverloaded(LLMError):
+    """The request could not be admitted before its deadline"""
+    status = 503
+
+
+class LLMUnavailable(LLMError):
+    """The provider kept failing or timing out"""
+    status = 504
+
+
+def backoff_delay(attempt: int, base: float, cap: float, retry_after: Optional[float] = None) -> float:
+    """Seconds before retry number attempt (0-based): full jitter, at least retry_after"""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = retry_after + random.uniform(0, base)
+    return delay
+
+
+class RateLimiter:
+    """Token buckets on LLM requests and tokens per minute, shared by every process on the host.
+
+    Each bucket holds up to a minute's allowance and refills continuously.
+    A call takes its cost from both buckets in one transaction, or takes
+    nothing and learns how long to wait. Token costs are estimates made
+    before the call; ``refund`` settles them once usage is known. A limit
+    of 0 disables its bucket.
+    """
+
+    def __init__(self, path: str, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        self.path = str(path)
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._local = threading.local()
+
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connection()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS buckets ('
+            ' id INTEGER PRIMARY KEY CHECK (id = 1),'
+            ' requests REAL NOT NULL,'
+            ' tokens REAL NOT NULL,'
+            ' updated REAL NOT NULL,'
+            ' paused_until REAL NOT NULL DEFAULT 0)'
+        )
+        conn.execute(
+            'INSERT OR IGNORE INTO buckets (id, requests, tokens, updated) VALUES (1, ?, ?, ?)',
+            (requests_per_minute, tokens_per_minute, time.time())
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _shortfall(level: float, cost: float, per_minute: int) -> float:
+        """Seconds until a bucket at level holds cost"""
+        if not per_minute or level >= cost:
+            return 0.0
+        return (cost - level) * 60.0 / per_minute
+
+    def try_acquire(self, tokens: int = 0) -> float:
+        """Take one request and tokens; returns 0, or the seconds to wait before trying again"""
+        # A call larger than a minute's allowance waits for a full bucket
+        tokens = min(tokens, self.tokens_per_minute) if self.tokens_per_minute else 0
+        now = time.time()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            requests_level, tokens_level, updated, paused_until = conn.execute(
+                'SELECT requests, tokens, updated, paused_until FROM buckets WHERE id = 1'
+            ).fetchone()
+            elapsed = max(0.0, now - updated)
+            requests_level = min(self.requests_per_minute,
+                                 requests_level + elapsed * self.requests_per_minute / 60.0)
+            tokens_level = min(self.tokens_per_minute, tokens_level + elapsed * self.tokens_per_minute / 60.0)
+            wait = max(
+                paused_until - now,
+                self._shortfall(requests_level, 1, self.requests_per_minute),
+                self._shortfall(tokens_level, tokens, self.tokens_per_minute),
+            )
+            if wait <= 0:
+                requests_level -= 1 if self.requests_per_minute else 0
+                tokens_level -= tokens
+            conn.execute(
+                'UPDATE buckets SET requests = ?, tokens = ?, updated = ? WHERE id = 1',
+                (requests_level, tokens_level, now)
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return max(0.0, wait)
+
+    def _admit_wait(self, tokens: int, deadline: float) -> float:
+        wait = self.try_acquire(tokens)
+        if wait and time.monotonic() + wait > deadline:
+            raise LLMOverloaded('The assistant is at its rate limit; please try again shortly', retry_after=wait)
+        # Processes woken by the same refill should not all retry at once
+        return wait and wait + random.uniform(0, min(wait, 0.05))
+
+    def acquire(self, tokens: int, deadline: float):
+        """Wait for the buckets to admit a call, or raise LLMOverloaded if that would pass deadline"""
+        while True:
+            wait = self._admit_wait(tokens, deadline)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: int, deadline: float):
+        while True:
+            wait = await asyncio.to_thread(self._admit_wait, tokens, deadline)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def refund(self, tokens: int):
+        """Return unused estimated tokens to the bucket (negative charges more)"""
+        if not self.tokens_per_minute or not tokens:
+            return
+        self._connection().execute(
+            'UPDATE buckets SET tokens = MIN(?, tokens + ?) WHERE id = 1', (self.tokens_per_minute, tokens)
+        )
+
+    def pause(self, seconds: float):
+        """Admit nothing, in any process, for seconds (the provider's retry-after)"""
+        self._connection().execute(
+            'UPDATE buckets SET paused_until = MAX(paused_until, ?) WHERE id = 1', (time.time() + seconds,)
+        )
+
+
+class _Ticket:
+    __slots__ = ('wake', 'granted')
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+
+
+class FairQueue:
+    """At most ``concurrency`` LLM calls in flight in this process, granted round-robin across users.
+
+    Waiting requests are queued per user; each released slot goes to the
+    next user in turn, who then moves to the back. Past ``max_waiting``
+    queued requests new ones are rejected at once. Works for threads
+    (``slot``) and coroutines (``slot_async``) alike.
+    """
+
+    def __init__(self, concurrency: int, max_waiting: int):
+        self.concurrency = concurrency
+        self.max_waiting = max_waiting
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiting_count = 0
+        self._waiting = OrderedDict()
+
+    def _enqueue(self, user_id, wake) -> Optional[_Ticket]:
+        """None when a slot is free now, else a ticket that wake() reports granted"""
+        with self._lock:
+            if self._active < self.concurrency and not self._waiting:
+                self._active += 1
+                return None
+            if self._waiting_count >= self.max_waiting:
+                raise LLMOverloaded('The assistant is busy; please try again shortly', retry_after=1.0)
+            ticket = _Ticket(wake)
+            self._waiting.setdefault(user_id, deque()).append(ticket)
+            self._waiting_count += 1
+            return ticket
+
+    def _withdraw(self, user_id, ticket: _Ticket) -> bool:
+        """Remove a ticket that gave up waiting; False if it was granted meanwhile"""
+        with self._lock:
+            if ticket.granted:
+                return False
+            tickets = self._waiting[user_id]
+            tickets.remove(ticket)
+            if not tickets:
+                del self._waiting[user_id]
+            self._waiting_count -= 1
+            return True
+
+    def release(self):
+        with self._lock:
+            if not self._waiting:
+                self._active -= 1
+                return
+            user_id, tickets = self._waiting.popitem(last=False)
+            ticket = tickets.popleft()
+            if tickets:
+                # The user had their turn; back of the line
+                self._waiting[user_id] = tickets
+            self._waiting_count -= 1
+            ticket.granted = True
+        ticket.wake()
+
+    @contextmanager
+    def slot(self, user_id, timeout: float):
+        event = threading.Event()
+        ticket = self._enqueue(user_id, event.set)
+        if ticket is not None and not event.wait(max(0.0, timeout)) and self._withdraw(user_id, ticket):
+            raise LLMOverloaded('The assistant is busy; please try again shortly', retry_after=1.0)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def slot_async(self, user_id, timeout: float):
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        ticket = self._enqueue(user_id, wake)
+        if ticket is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(granted), max(0.0, timeout))
+            except asyncio.TimeoutError:
+                if self._withdraw(user_id, ticket):
+                    raise LLMOverloaded('The assistant is busy; please try again shortly', retry_after=1.0)
+            except asyncio.CancelledError:
+                if not self._withdraw(user_id, ticket):
+                    self.release()
+                raise
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'active': self._active, 'waiting': self._waiting_count, 'users_waiting': len(self._waiting)}
@@ -1,44 +1,201 @@
-from groq import Groq
+from groq import (
+    APIConnectionError, APIError, APITimeoutError, AsyncGroq, Groq, InternalServerError, RateLimitError
+)
 from django.conf import settings
-from typing import List, Dict
+from typing import AsyncIterator, List, Dict, Optional
+import asyncio
+import httpx
+import itertools
+import time
+import weakref
 import logging
 
+from .llm_limits import FairQueue, LLMError, LLMOverloaded, LLMUnavailable, RateLimiter, backoff_delay
+from .metrics import registry
+from .prompt_builder import Prompt, PromptBuilder, TokenCounter
+
 logger = logging.getLogger(__name__)
 
+LLM_ATTEMPTS = registry.counter('rag_llm_attempts_total', 'LLM API calls by result', ['result'])
+
+# Failures worth another attempt; anything else (bad request, auth) is final
+RETRYABLE = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Seconds the provider asked us to wait, if it said"""
+    response = getattr(error, 'response', None)
+    try:
+        return float(response.headers['retry-after'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
 class LLMService:
     def __init__(self):
-        self.client = Groq(api_key=settings.GROQ_API_KEY)
+        # One keep-alive connection pool per process, no SDK retries: the
+        # retry policy below also waits on the rate limiter and deadline
+        self.timeout = httpx.Timeout(settings.LLM_TIMEOUT, connect=settings.LLM_CONNECT_TIMEOUT)
+        self.limits = httpx.Limits(
+            max_connections=settings.LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.LLM_MAX_CONNECTIONS,
+            keepalive_expiry=30
+        )
+        self.client = Groq(
+            api_key=settings.GROQ_API_KEY,
+            base_url=settings.LLM_BASE_URL or None,
+            max_retries=0,
+            http_client=httpx.Client(limits=self.limits, timeout=self.timeout)
+        )
         self.model = settings.LLM_MODEL
+        # AsyncGroq's connection pool is bound to the event loop it was
+        # first used on, so keep one client per loop
+        self._async_clients = weakref.WeakKeyDictionary()
+        self.queue = FairQueue(settings.LLM_CONCURRENCY, settings.LLM_QUEUE_SIZE)
+        self.limiter = None
+        if settings.LLM_REQUESTS_PER_MINUTE or settings.LLM_TOKENS_PER_MINUTE:
+            self.limiter = RateLimiter(
+                settings.LLM_RATE_LIMIT_PATH,
+                requests_per_minute=settings.LLM_REQUESTS_PER_MINUTE,
+                tokens_per_minute=settings.LLM_TOKENS_PER_MINUTE
+            )
+        self.prompt_builder = PromptBuilder(
+            TokenCounter(settings.PROMPT_TOKENIZER),
+            max_tokens=settings.PROMPT_MAX_TOKENS,
+            history_tokens=settings.PROMPT_HISTORY_TOKENS,
+            history_message_tokens=settings.PROMPT_HISTORY_MESSAGE_TOKENS
+        )
     
-    def generate_response(self, query: str, context: List[str], 
-                         chat_history: List[Dict] = None) -> str:
-        """Generate response using RAG"""
-        try:
-            context_text = "\n\n".join(context) if context else "No relevant context found."
-            
-            system_message = f"""You are a helpful AI assistant. Answer the user's question based on the following context.
-
-Context:
-{context_text}
-
-If the answer cannot be found in the context, say so politely and provide general knowledge if appropriate."""
-            
-            messages = [{"role": "system", "content": system_message}]
-            
-            if chat_history:
-                messages.extend(chat_history[-5:])
-            
-            messages.append({"role": "user", "content": query})
-            
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=0.7,
-                max_tokens=1024
+    def build_prompt(self, query: str, context: List[str], chat_history: List[Dict] = None,
+                     scores: List[float] = None) -> Prompt:
+        """RAG prompt packed under the configured token budget"""
+        prompt = self.prompt_builder.build(query, context, chat_history, scores)
+        logger.info(
+            f"Prompt: {prompt.prompt_tokens} tokens ({prompt.context_tokens} context from "
+            f"{prompt.chunks_used}/{prompt.chunks_used + prompt.chunks_dropped} chunks, "
+            f"{prompt.history_tokens} history)"
+        )
+        return prompt
+    
+    @staticmethod
+    def _cost(prompt: Prompt) -> int:
+        # Providers count prompt and completion tokens; reserve the
+        # completion's limit and refund what was not used
+        return prompt.prompt_tokens + settings.LLM_MAX_TOKENS
+
+    @staticmethod
+    def _attempt_timeout(deadline: float) -> httpx.Timeout:
+        remaining = max(0.1, deadline - time.monotonic())
+        return httpx.Timeout(min(settings.LLM_TIMEOUT, remaining),
+                             connect=min(settings.LLM_CONNECT_TIMEOUT, remaining))
+
+    def _retry_delay(self, error: Exception, attempt: int, deadline: float) -> float:
+        """Seconds to wait before retrying a failed call, or the typed error to give up with"""
+        if not isinstance(error, RETRYABLE):
+            LLM_ATTEMPTS.inc(result='rejected')
+            raise LLMError(f'The language model rejected the request: {error}') from error
+        rate_limited = isinstance(error, RateLimitError)
+        LLM_ATTEMPTS.inc(result='rate_limited' if rate_limited else 'failed')
+        retry_after = _retry_after(error)
+        delay = backoff_delay(attempt, settings.LLM_BACKOFF_BASE, settings.LLM_BACKOFF_MAX, retry_after)
+        if rate_limited and self.limiter is not None:
+            # Hold off every worker, not only this one
+            self.limiter.pause(retry_after or delay)
+        if attempt >= settings.LLM_MAX_RETRIES or time.monotonic() + delay >= deadline:
+            if rate_limited:
+                raise LLMOverloaded('The assistant is at its rate limit; please try again shortly',
+                                    retry_after=retry_after or delay) from error
+            raise LLMUnavailable(f'The language model is not responding: {error}') from error
+        logger.warning(f"LLM call failed ({type(error).__name__}), retry {attempt + 1} in {delay:.2f}s")
+        return delay
+
+    def complete(self, prompt: Prompt, user_id: int = None) -> str:
+        """Generate response for a built prompt.
+
+        Waits for a slot in the user's turn and for the rate limiter, and
+        retries transient failures, all within LLM_DEADLINE seconds; raises
+        LLMError (or a subclass) when it cannot answer.
+        """
+        deadline = time.monotonic() + settings.LLM_DEADLINE
+        cost = self._cost(prompt)
+        with self.queue.slot(user_id, deadline - time.monotonic()):
+            for attempt in itertools.count():
+                if self.limiter is not None:
+                    self.limiter.acquire(cost, deadline)
+                try:
+                    response = self.client.chat.completions.create(
+                        model=self.model,
+                        messages=prompt.messages,
+                        temperature=0.7,
+                        max_tokens=settings.LLM_MAX_TOKENS,
+                        timeout=self._attempt_timeout(deadline)
+                    )
+                    break
+                except Exception as e:
+                    if self.limiter is not None:
+                        self.limiter.refund(cost)
+                    time.sleep(self._retry_delay(e, attempt, deadline))
+        LLM_ATTEMPTS.inc(result='ok')
+        if response.usage is not None:
+            if self.limiter is not None:
+                self.limiter.refund(cost - response.usage.prompt_tokens - response.usage.completion_tokens)
+            logger.info(
+                f"LLM usage: {response.usage.prompt_tokens} prompt tokens "
+                f"(estimated {prompt.prompt_tokens}), {response.usage.completion_tokens} completion tokens"
+            )
+        return response.choices[0].message.content
+    
+    def _async_client(self) -> AsyncGroq:
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = AsyncGroq(
+                api_key=settings.GROQ_API_KEY,
+                base_url=settings.LLM_BASE_URL or None,
+                max_retries=0,
+                http_client=httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
             )
-            
-            return response.choices[0].message.content
-        
-        except Exception as e:
-            logger.error(f"Error generating response: {e}")
-            return f"Sorry, I encountered an error: {str(e)}"
\ No newline at end of file
+            self._async_clients[loop] = client
+        return client
+    
+    async def stream_response(self, prompt: Prompt, user_id: int = None) -> AsyncIterator[str]:
+        """Yield the response text as the model generates it.
+
+        Admission and retries work as in complete(), up to the first token;
+        a stream that fails after that raises LLMUnavailable.
+        """
+        deadline = time.monotonic() + settings.LLM_DEADLINE
+        cost = self._cost(prompt)
+        async with self.queue.slot_async(user_id, deadline - time.monotonic()):
+            for attempt in itertools.count():
+                if self.limiter is not None:
+                    await self.limiter.acquire_async(cost, deadline)
+                try:
+                    stream = await self._async_client().chat.completions.create(
+                        model=self.model,
+                        messages=prompt.messages,
+                        temperature=0.7,
+                        max_tokens=settings.LLM_MAX_TOKENS,
+                        stream=True,
+                        timeout=self._attempt_timeout(deadline)
+                    )
+                    break
+                except Exception as e:
+                    # The limiter's SQLite writes stay off the event loop, as in acquire_async
+                    if self.limiter is not None:
+                        await asyncio.to_thread(self.limiter.refund, cost)
+                    await asyncio.sleep(await asyncio.to_thread(self._retry_delay, e, attempt, deadline))
+            LLM_ATTEMPTS.inc(result='ok')
+
+            completion_tokens = 0
+            try:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        # A streamed delta is about one token
+                        completion_tokens += 1
+                        yield chunk.choices[0].delta.content
+            except (APIError, httpx.HTTPError) as e:
+                raise LLMUnavailable(f'The language model stopped responding: {e}') from e
+            finally:
+                if self.limiter is not None:
+                    await asyncio.to_thread(self.limiter.refund, cost - prompt.prompt_tokens - completion_tokens)
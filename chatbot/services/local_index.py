@@ -0,0 +1,681 @@
+"""In-process vector index stored as memory-mapped matrices.
+
+Layout of an index directory (one per user):
+
+- ``vectors.f32``: row-major float32 matrix, appended to as chunks are added
+- ``vectors.f16`` / ``vectors.i8`` + ``scales.f32``: the searched matrix
+  when the index stores float16 or int8 vectors (see below)
+- ``meta.sqlite3``: row -> (id, document, metadata, deleted) plus index info;
+  ``deleted`` is 0 for live rows, else the generation that deleted them
+- ``ivf.npz``: IVF coarse quantizer, written once the index is large enough
+
+Deletes only mark rows; compact() rewrites the files without them.
+
+An index created with ``storage='float16'`` or ``'int8'`` scans a compact
+matrix instead of float32: half or a quarter of the bytes per vector, so
+the working set that must stay in the page cache shrinks accordingly.
+int8 rows are quantized symmetrically with one float32 scale per row.
+With ``rerank`` the float32 rows are also written to ``vectors.f32``, and
+the ``rerank * n_results`` best quantized candidates are re-scored
+against them; only those rows are read, so the file can stay on disk.
+The storage mode is fixed when the first vectors are added; compact()
+converts an existing index to the mode it is opened with.
+
+Search is exact NumPy brute force until the number of live rows reaches
+``ann_threshold``; from then on an IVF index (k-means centroids plus
+inverted lists) restricts the exact scoring to the ``nprobe`` closest
+lists. Distances are squared L2, the same as Chroma's default space.
+
+Writers from several processes are serialized by a SQLite write
+transaction; readers notice new rows or deletions through a generation
+counter and remap the matrix. Within an epoch (between compactions) a
+reader only reads what changed since its generation: new rows, rows
+deleted by later generations, and IVF assignments of the new rows.
+"""
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+import numpy as np
+import json
+import os
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Rows scored per block when assigning vectors to IVF centroids
+_ASSIGN_BLOCK = 4096
+# Rows converted to float32 per block when scanning a quantized matrix;
+# small enough for the converted block to stay in cache
+_SCORE_BLOCK = 2048
+
+# storage mode -> (file suffix, dtype of the searched matrix)
+STORAGE_TYPES = {
+    'float32': ('f32', np.float32),
+    'float16': ('f16', np.float16),
+    'int8': ('i8', np.int8),
+}
+
+
+def quantize(vectors: np.ndarray, storage: str):
+    """Rows in a storage mode's dtype, plus per-row scales for int8"""
+    if storage == 'int8':
+        # The largest component of each row maps to +-127
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        data = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return data, scales.astype(np.float32)
+    return vectors.astype(STORAGE_TYPES[storage][1], copy=False), None
+
+
+def dequantize(data: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+    """float32 rows from a (possibly quantized) block"""
+    block = np.asarray(data, dtype=np.float32)
+    if scales is not None:
+        block = block * np.asarray(scales, dtype=np.float32)[:, None]
+    return block
+
+
+def _squared_norms(matrix: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+    norms = np.empty(len(matrix), dtype=np.float32)
+    for start in range(0, len(matrix), _ASSIGN_BLOCK):
+        block = dequantize(matrix[start:start + _ASSIGN_BLOCK],
+                           None if scales is None else scales[start:start + _ASSIGN_BLOCK])
+        norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+    return norms
+
+
+def _dot(matrix: np.ndarray, scales: Optional[np.ndarray], query: np.ndarray,
+         rows: Optional[np.ndarray] = None) -> np.ndarray:
+    """Dot product of the query with every row, or with the given rows"""
+    if matrix.dtype == np.float32:
+        return (matrix if rows is None else matrix[rows]) @ query
+    count = len(matrix) if rows is None else len(rows)
+    products = np.empty(count, dtype=np.float32)
+    for start in range(0, count, _SCORE_BLOCK):
+        select = slice(start, start + _SCORE_BLOCK) if rows is None else rows[start:start + _SCORE_BLOCK]
+        products[start:start + _SCORE_BLOCK] = np.asarray(matrix[select], dtype=np.float32) @ query
+    if scales is not None:
+        # Scaling the products is cheaper than scaling every component
+        products *= scales if rows is None else scales[rows]
+    return products
+
+
+def _nearest_centroids(vectors: np.ndarray, centroids: np.ndarray,
+                       scales: Optional[np.ndarray] = None) -> np.ndarray:
+    """Index of the nearest centroid for each row, computed in blocks"""
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), _ASSIGN_BLOCK):
+        block = dequantize(vectors[start:start + _ASSIGN_BLOCK],
+                           None if scales is None else scales[start:start + _ASSIGN_BLOCK])
+        # ||c||^2 - 2 x.c ranks centroids like the full squared distance
+        scores = centroid_norms - 2.0 * (block @ centroids.T)
+        assignments[start:start + len(block)] = np.argmin(scores, axis=1)
+    return assignments
+
+
+def train_ivf(vectors: np.ndarray, nlist: int, iterations: int = 10,
+              sample_size: int = 50000, seed: int = 0,
+              scales: Optional[np.ndarray] = None) -> np.ndarray:
+    """k-means centroids over a sample of the vectors"""
+    rng = np.random.default_rng(seed)
+    sample_rows = np.sort(rng.choice(len(vectors), size=min(sample_size, len(vectors)), replace=False))
+    sample = dequantize(vectors[sample_rows], None if scales is None else scales[sample_rows])
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = _nearest_centroids(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=nlist)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # Re-seed empty lists from random sample points
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = sample[rng.choice(len(sample), size=len(empty), replace=False)]
+    return centroids
+
+
+class LocalIndex:
+    def __init__(self, directory, ann_threshold: int = 20000, nprobe: int = 16,
+                 storage: str = 'float32', rerank: int = 0):
+        if storage not in STORAGE_TYPES:
+            raise ValueError(f'Unknown storage mode: {storage}')
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.directory / 'vectors.f32'
+        self.scales_path = self.directory / 'scales.f32'
+        self.ivf_path = self.directory / 'ivf.npz'
+        self.ann_threshold = ann_threshold
+        self.nprobe = nprobe
+        # Applied to new indexes; an existing index keeps the mode it was built with
+        self.storage = storage
+        self.rerank = rerank
+
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._generation = None
+        self._epoch = None
+        self._rows = 0
+        self._dim = 0
+        self._matrix: Optional[np.ndarray] = None
+        self._scales: Optional[np.ndarray] = None     # int8 storage only
+        self._originals: Optional[np.ndarray] = None  # float32 rows kept for re-ranking
+        self._norms = np.empty(0, dtype=np.float32)
+        self._live = np.empty(0, dtype=bool)
+        self._doc_ids = np.empty(0, dtype=np.int64)
+        self._ivf = None            # (centroids, list order, list offsets)
+        self._ivf_mtime = None
+        self._ivf_assignments = None  # list of each row assigned so far
+
+        conn = self._conn()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS chunks ('
+            ' row INTEGER PRIMARY KEY,'
+            ' id TEXT NOT NULL UNIQUE,'
+            ' document TEXT NOT NULL,'
+            ' metadata TEXT NOT NULL,'
+            ' doc_id TEXT,'
+            ' deleted INTEGER NOT NULL DEFAULT 0)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS chunks_doc_id ON chunks (doc_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS chunks_deleted ON chunks (deleted)')
+        conn.execute('CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    # -- storage helpers ------------------------------------------------
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.directory / 'meta.sqlite3', timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _get_info(conn, key: str, default=None):
+        row = conn.execute('SELECT value FROM info WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    @staticmethod
+    def _set_info(conn, key: str, value):
+        conn.execute('INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def _bump_generation(self, conn):
+        self._set_info(conn, 'generation', int(self._get_info(conn, 'generation', 0)) + 1)
+
+    def _matrix_path(self, storage: str) -> Path:
+        return self.directory / f'vectors.{STORAGE_TYPES[storage][0]}'
+
+    def _row_files(self, storage: str, originals: bool, dim: int):
+        """(path, dtype, row shape) of every file holding one entry per row"""
+        files = [(self._matrix_path(storage), STORAGE_TYPES[storage][1], (dim,))]
+        if storage == 'int8':
+            files.append((self.scales_path, np.float32, ()))
+        if originals:
+            files.append((self.vectors_path, np.float32, (dim,)))
+        return files
+
+    @staticmethod
+    def _write_rows(path: Path, data: np.ndarray, start_row: int):
+        row_bytes = data.itemsize * (data.shape[1] if data.ndim == 2 else 1)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, np.ascontiguousarray(data).tobytes(), start_row * row_bytes)
+        finally:
+            os.close(fd)
+
+    # -- reader state -----------------------------------------------------
+
+    def _refresh(self):
+        """Remap the matrix and load new rows and deletions if another writer changed them"""
+        conn = self._conn()
+        generation = int(self._get_info(conn, 'generation', 0))
+        ivf_mtime = self.ivf_path.stat().st_mtime if self.ivf_path.exists() else None
+        if generation == self._generation and ivf_mtime == self._ivf_mtime:
+            return
+
+        with self._lock:
+            rows = int(self._get_info(conn, 'rows', 0))
+            dim = int(self._get_info(conn, 'dim', 0))
+            # compact() renumbers rows, so cached state is only reusable
+            # within one epoch
+            epoch = int(self._get_info(conn, 'epoch', 0))
+            storage = self._get_info(conn, 'storage', 'float32')
+            reusable = dim == self._dim and epoch == self._epoch and self._generation is not None
+            scales = originals = None
+            if rows and dim:
+                # Plain ndarray views of the mappings: indexing a np.memmap
+                # subclass is several times slower
+                matrix = np.asarray(np.memmap(
+                    self._matrix_path(storage), dtype=STORAGE_TYPES[storage][1], mode='r', shape=(rows, dim)
+                ))
+                if storage == 'int8':
+                    scales = np.asarray(np.memmap(self.scales_path, dtype=np.float32, mode='r', shape=(rows,)))
+                if int(self._get_info(conn, 'originals', 0)):
+                    originals = np.asarray(np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(rows, dim)))
+                old_rows = min(len(self._norms), rows) if reusable else 0
+                norms = np.empty(rows, dtype=np.float32)
+                norms[:old_rows] = self._norms[:old_rows]
+                norms[old_rows:] = _squared_norms(matrix[old_rows:], None if scales is None else scales[old_rows:])
+            else:
+                matrix, norms, old_rows = None, np.empty(0, dtype=np.float32), 0
+
+            live = np.ones(rows, dtype=bool)
+            live[:old_rows] = self._live[:old_rows]
+            # Rows deleted since the generation this reader last loaded
+            deleted = [r for (r,) in conn.execute(
+                'SELECT row FROM chunks WHERE deleted > ?', (self._generation if reusable else 0,)
+            )]
+            if deleted:
+                deleted = np.asarray(deleted, dtype=np.int64)
+                live[deleted[deleted < rows]] = False
+
+            # A row's doc_id never changes, so only new rows are read
+            doc_ids = np.full(rows, -1, dtype=np.int64)
+            doc_ids[:old_rows] = self._doc_ids[:old_rows]
+            for row, doc_id in conn.execute(
+                'SELECT row, doc_id FROM chunks WHERE row >= ? AND doc_id IS NOT NULL', (old_rows,)
+            ):
+                if row < rows:
+                    doc_ids[row] = int(doc_id)
+
+            self._matrix, self._norms, self._live = matrix, norms, live
+            self._scales, self._originals = scales, originals
+            self._doc_ids = doc_ids
+            self._rows, self._dim, self._epoch = rows, dim, epoch
+            self._load_ivf(ivf_mtime, reload=not reusable or ivf_mtime != self._ivf_mtime)
+            self._generation = generation
+
+    def _load_ivf(self, ivf_mtime, reload: bool):
+        """Bring the IVF lists up to date: read the file when it changed, assign rows added since"""
+        self._ivf_mtime = ivf_mtime
+        if ivf_mtime is None or self._matrix is None:
+            self._ivf = self._ivf_assignments = None
+            return
+        if reload or self._ivf is None:
+            with np.load(self.ivf_path) as data:
+                centroids = data['centroids']
+                assignments = data['assignments']
+            if centroids.shape[1] != self._dim:
+                self._ivf = self._ivf_assignments = None
+                return
+        else:
+            centroids, assignments = self._ivf[0], self._ivf_assignments
+            if len(assignments) >= self._rows:
+                # Only deletions: the lists are unchanged
+                return
+        if len(assignments) < self._rows:
+            # Rows added since training go to their nearest existing list
+            extra = _nearest_centroids(
+                self._matrix[len(assignments):], centroids,
+                None if self._scales is None else self._scales[len(assignments):]
+            )
+            assignments = np.concatenate([assignments, extra])
+        assignments = assignments[:self._rows]
+        order = np.argsort(assignments, kind='stable').astype(np.int64)
+        offsets = np.searchsorted(assignments[order], np.arange(len(centroids) + 1))
+        self._ivf = (centroids, order, offsets)
+        self._ivf_assignments = assignments
+
+    # -- writes ---------------------------------------------------------
+
+    def add(self, ids: List[str], texts: List[str], embeddings: np.ndarray,
+            metadatas: List[Dict] = None):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or len(embeddings) != len(ids):
+            raise ValueError('Expected one embedding row per id')
+        metadatas = metadatas or [{}] * len(ids)
+
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            dim = int(self._get_info(conn, 'dim', 0))
+            if not dim:
+                dim = embeddings.shape[1]
+                self._set_info(conn, 'dim', dim)
+                self._set_info(conn, 'storage', self.storage)
+                self._set_info(conn, 'originals', int(self.storage != 'float32' and self.rerank > 0))
+            elif dim != embeddings.shape[1]:
+                raise ValueError(f'Embedding dimension {embeddings.shape[1]} does not match index dimension {dim}')
+
+            rows = int(self._get_info(conn, 'rows', 0))
+            storage = self._get_info(conn, 'storage', 'float32')
+            data, scales = quantize(embeddings, storage)
+            self._write_rows(self._matrix_path(storage), data, rows)
+            if scales is not None:
+                self._write_rows(self.scales_path, scales, rows)
+            if int(self._get_info(conn, 'originals', 0)):
+                self._write_rows(self.vectors_path, embeddings, rows)
+
+            conn.executemany(
+                'INSERT INTO chunks (row, id, document, metadata, doc_id) VALUES (?, ?, ?, ?, ?)',
+                [
+                    (rows + i, ids[i], texts[i], json.dumps(metadata),
+                     str(metadata['doc_id']) if 'doc_id' in metadata else None)
+                    for i, metadata in enumerate(metadatas)
+                ]
+            )
+            self._set_info(conn, 'rows', rows + len(ids))
+            self._bump_generation(conn)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self._maybe_train()
+
+    def _mark_deleted(self, column: str, values: List[str]) -> int:
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Rows are marked with the generation that deletes them, so
+            # readers fetch only deletions newer than what they loaded
+            generation = int(self._get_info(conn, 'generation', 0)) + 1
+            deleted = 0
+            for start in range(0, len(values), 500):
+                batch = values[start:start + 500]
+                placeholders = ','.join('?' * len(batch))
+                deleted += conn.execute(
+                    f'UPDATE chunks SET deleted = ? WHERE deleted = 0 AND {column} IN ({placeholders})',
+                    [generation, *batch]
+                ).rowcount
+            if deleted:
+                self._set_info(conn, 'generation', generation)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return deleted
+
+    def delete(self, ids: List[str]) -> int:
+        """Mark rows deleted; space is reclaimed by compact()"""
+        return self._mark_deleted('id', list(ids))
+
+    def delete_documents(self, doc_ids: List[int]) -> int:
+        """Mark every row of the given documents deleted"""
+        return self._mark_deleted('doc_id', [str(int(doc_id)) for doc_id in doc_ids])
+
+    def compact(self) -> int:
+        """Rewrite the vectors and metadata without deleted rows.
+
+        Returns the number of rows reclaimed. Live rows keep their order
+        and are renumbered densely, so the IVF index is rebuilt. An index
+        built with another storage mode than this instance's is converted
+        on the way; without float32 originals the conversion starts from
+        the quantized vectors.
+        """
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = int(self._get_info(conn, 'rows', 0))
+            dim = int(self._get_info(conn, 'dim', 0))
+            keep = np.fromiter(
+                (r for (r,) in conn.execute('SELECT row FROM chunks WHERE deleted = 0 ORDER BY row')),
+                dtype=np.int64
+            )
+            reclaimed = rows - len(keep)
+            storage = self._get_info(conn, 'storage', 'float32')
+            originals = bool(int(self._get_info(conn, 'originals', 0)))
+            target = (self.storage, self.storage != 'float32' and self.rerank > 0)
+            converting = rows > 0 and (storage, originals) != target
+            if not reclaimed and not converting:
+                conn.execute('COMMIT')
+                return 0
+
+            old_files = self._row_files(storage, originals, dim)
+            new_files = self._row_files(*target, dim) if converting else old_files
+            if converting:
+                # Rows go through float32: exact when float32 is stored,
+                # otherwise dequantized
+                scales = None
+                if originals or storage == 'float32':
+                    matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(rows, dim))
+                else:
+                    matrix = np.memmap(self._matrix_path(storage), dtype=STORAGE_TYPES[storage][1],
+                                       mode='r', shape=(rows, dim))
+                    if storage == 'int8':
+                        scales = np.memmap(self.scales_path, dtype=np.float32, mode='r', shape=(rows,))
+                outputs = [open(path.with_name(path.name + '.tmp'), 'wb') for path, _, _ in new_files]
+                try:
+                    for start in range(0, len(keep), _ASSIGN_BLOCK):
+                        block = keep[start:start + _ASSIGN_BLOCK]
+                        vectors = dequantize(matrix[block], None if scales is None else scales[block])
+                        data, block_scales = quantize(vectors, target[0])
+                        parts = [data] + ([block_scales] if block_scales is not None else [])
+                        if target[1]:
+                            parts.append(vectors)
+                        for out, part in zip(outputs, parts):
+                            out.write(np.ascontiguousarray(part).tobytes())
+                finally:
+                    for out in outputs:
+                        out.close()
+                del matrix, scales
+                self._set_info(conn, 'storage', target[0])
+                self._set_info(conn, 'originals', int(target[1]))
+            else:
+                for path, dtype, row_shape in old_files:
+                    source = np.memmap(path, dtype=dtype, mode='r', shape=(rows, *row_shape))
+                    with open(path.with_name(path.name + '.tmp'), 'wb') as out:
+                        for start in range(0, len(keep), _ASSIGN_BLOCK):
+                            out.write(np.ascontiguousarray(source[keep[start:start + _ASSIGN_BLOCK]]).tobytes())
+                    del source
+
+            conn.execute('DELETE FROM chunks WHERE deleted != 0')
+            conn.execute('CREATE TEMP TABLE remap (old INTEGER PRIMARY KEY, new INTEGER NOT NULL)')
+            conn.executemany('INSERT INTO remap (old, new) VALUES (?, ?)',
+                             ((int(old), new) for new, old in enumerate(keep)))
+            # Negate first so no intermediate row number collides
+            conn.execute('UPDATE chunks SET row = -1 - row')
+            conn.execute('UPDATE chunks SET row = (SELECT new FROM remap WHERE old = -1 - chunks.row)')
+            conn.execute('DROP TABLE remap')
+            self._set_info(conn, 'rows', len(keep))
+            self._set_info(conn, 'epoch', int(self._get_info(conn, 'epoch', 0)) + 1)
+            self._bump_generation(conn)
+
+            # Swap files while holding the write lock: readers keep their
+            # mapping of the old file until they see the new generation
+            for path, _, _ in new_files:
+                os.replace(path.with_name(path.name + '.tmp'), path)
+            for path in {path for path, _, _ in old_files} - {path for path, _, _ in new_files}:
+                path.unlink()
+            if self.ivf_path.exists():
+                self.ivf_path.unlink()
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if converting:
+            logger.info(f"Converted {self.directory} from {storage} to {target[0]} storage")
+        logger.info(f"Compacted {self.directory}: reclaimed {reclaimed} of {rows} rows")
+        self._maybe_train()
+        return reclaimed
+
+    def _maybe_train(self):
+        """(Re)build the IVF index once the corpus passes the ANN threshold"""
+        self._refresh()
+        live = int(self._live.sum())
+        if live < self.ann_threshold or self._matrix is None:
+            return
+        trained_rows = 0
+        if self.ivf_path.exists():
+            with np.load(self.ivf_path) as data:
+                trained_rows = int(data['rows'])
+        # Retrain when the corpus has doubled since the last training
+        if trained_rows and self._rows < 2 * trained_rows:
+            return
+
+        nlist = int(min(4096, max(16, np.sqrt(live))))
+        centroids = train_ivf(self._matrix, nlist, scales=self._scales)
+        assignments = _nearest_centroids(self._matrix, centroids, self._scales)
+        tmp_path = self.directory / 'ivf.tmp.npz'
+        np.savez(tmp_path, centroids=centroids, assignments=assignments, rows=self._rows)
+        os.replace(tmp_path, self.ivf_path)
+        logger.info(f"Trained IVF index with {nlist} lists over {self._rows} rows in {self.directory}")
+
+    def drop(self):
+        """Delete the index from disk"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+        for path in self.directory.iterdir():
+            path.unlink()
+        self.directory.rmdir()
+
+    # -- reads ----------------------------------------------------------
+
+    def count(self) -> int:
+        self._refresh()
+        return int(self._live.sum())
+
+    def entries(self, batch_size: int = 1000):
+        """Yield (id, document, metadata) for every live row"""
+        last_row = -1
+        while True:
+            batch = self._conn().execute(
+                'SELECT row, id, document, metadata FROM chunks WHERE deleted = 0 AND row > ? ORDER BY row LIMIT ?',
+                (last_row, batch_size)
+            ).fetchall()
+            if not batch:
+                return
+            for row, chunk_id, document, metadata in batch:
+                yield chunk_id, document, json.loads(metadata)
+            last_row = batch[-1][0]
+
+    def get(self, ids: List[str]) -> dict:
+        """Documents and metadata of live rows by id, in Chroma's get() format"""
+        records = {}
+        conn = self._conn()
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            placeholders = ','.join('?' * len(batch))
+            for chunk_id, document, metadata in conn.execute(
+                    f'SELECT id, document, metadata FROM chunks WHERE deleted = 0 AND id IN ({placeholders})',
+                    batch):
+                records[chunk_id] = (document, json.loads(metadata))
+        found = [chunk_id for chunk_id in ids if chunk_id in records]
+        return {
+            'ids': found,
+            'documents': [records[chunk_id][0] for chunk_id in found],
+            'metadatas': [records[chunk_id][1] for chunk_id in found],
+        }
+
+    def search(self, query_embedding: np.ndarray, n_results: int = 3,
+               doc_ids: Optional[List[int]] = None) -> dict:
+        """Nearest rows to the query, in Chroma's result format.
+
+        With doc_ids, only chunks of those documents are considered.
+        """
+        while True:
+            result = self._search(query_embedding, n_results, doc_ids)
+            if result is not None:
+                return result
+            # A compaction renumbered the rows after they were scored
+            logger.info(f"Index {self.directory} was compacted during a search; searching again")
+
+    def _search(self, query_embedding: np.ndarray, n_results: int,
+                doc_ids: Optional[List[int]]) -> Optional[dict]:
+        """search() on a snapshot of the reader state; None if the rows it found were renumbered"""
+        self._refresh()
+        with self._lock:
+            matrix, norms, live, ivf = self._matrix, self._norms, self._live, self._ivf
+            row_doc_ids, scales, epoch = self._doc_ids, self._scales, self._epoch
+            originals = self._originals if self.rerank > 0 else None
+        empty = {'ids': [[]], 'documents': [[]], 'metadatas': [[]], 'distances': [[]]}
+        if matrix is None:
+            return empty
+
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        if doc_ids is not None:
+            live = live & np.isin(row_doc_ids, np.asarray(doc_ids, dtype=np.int64))
+        use_ann = ivf is not None and int(live.sum()) >= self.ann_threshold
+        if doc_ids is not None and not use_ann:
+            # A user's share of a large corpus: score only their rows
+            candidates = np.flatnonzero(live)
+            scores = norms[candidates] - 2.0 * _dot(matrix, scales, query, candidates)
+        elif use_ann:
+            centroids, order, offsets = ivf
+            centroid_distances = np.einsum('ij,ij->i', centroids, centroids) - 2.0 * (centroids @ query)
+            nprobe = min(self.nprobe, len(centroids))
+            probe = np.argpartition(centroid_distances, nprobe - 1)[:nprobe]
+            candidates = np.concatenate([order[offsets[c]:offsets[c + 1]] for c in probe])
+            candidates.sort()
+            candidates = candidates[live[candidates]]
+            scores = norms[candidates] - 2.0 * _dot(matrix, scales, query, candidates)
+        else:
+            candidates = None
+            scores = norms - 2.0 * _dot(matrix, scales, query)
+            scores[~live] = np.inf
+
+        available = len(scores) if candidates is not None else int(live.sum())
+        k = min(n_results, available)
+        if k <= 0:
+            return empty
+        shortlist = min(k * self.rerank, available) if originals is not None else k
+        top = np.argpartition(scores, shortlist - 1)[:shortlist]
+        rows = candidates[top] if candidates is not None else top
+        scores = scores[top]
+        if originals is not None:
+            # Re-score the quantized shortlist against the float32 rows
+            exact = originals[rows]
+            scores = np.einsum('ij,ij->i', exact, exact) - 2.0 * (exact @ query)
+        order = np.argsort(scores)[:k]
+        rows = rows[order]
+        distances = scores[order] + float(query @ query)
+
+        conn = self._conn()
+        placeholders = ','.join('?' * len(rows))
+        # One read transaction: the rows are looked up in the epoch they were scored in
+        conn.execute('BEGIN')
+        try:
+            if int(self._get_info(conn, 'epoch', 0)) != epoch:
+                return None
+            records = {
+                row: (chunk_id, document, metadata)
+                for row, chunk_id, document, metadata in conn.execute(
+                    f'SELECT row, id, document, metadata FROM chunks WHERE row IN ({placeholders})',
+                    [int(r) for r in rows]
+                )
+            }
+        finally:
+            conn.execute('COMMIT')
+        hits = [records[int(r)] for r in rows if int(r) in records]
+        return {
+            'ids': [[hit[0] for hit in hits]],
+            'documents': [[hit[1] for hit in hits]],
+            'metadatas': [[json.loads(hit[2]) for hit in hits]],
+            'distances': [[float(d) for r, d in zip(rows, distances) if int(r) in records]],
+        }
+
+
+class LocalIndexPool:
+    """Process-wide LRU of open index instances, LocalIndex by default"""
+
+    def __init__(self, index_class=None):
+        self.index_class = index_class or LocalIndex
+        self._lock = threading.Lock()
+        self._indexes = OrderedDict()
+
+    def get(self, directory, max_open: int, **kwargs):
+        key = str(directory)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None:
+                index = self.index_class(directory, **kwargs)
+                self._indexes[key] = index
+            self._indexes.move_to_end(key)
+            while len(self._indexes) > max_open:
+                self._indexes.popitem(last=False)
+            return index
+
+    def evict(self, directory):
+        with self._lock:
+            self._indexes.pop(str(directory), None)
+
+
+local_index_pool = LocalIndexPool()
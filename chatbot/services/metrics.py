@@ -0,0 +1,216 @@
+"""In-process metrics in the Prometheus text format, and per-request traces.
+
+Counters and histograms live in a module-level registry and are rendered
+by the ``/metrics`` view. Each worker process keeps its own values, so
+scrape every worker (or run one per container) to see all traffic.
+
+A Trace times the stages of one chat request or ingestion job. When it
+finishes, every stage is observed in ``rag_stage_seconds`` and the whole
+trace is logged as one JSON line on the ``chatbot.trace`` logger.
+Recording costs a few microseconds per stage.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Sequence, Tuple
+from django.conf import settings
+import json
+import math
+import threading
+import time
+import logging
+
+trace_logger = logging.getLogger('chatbot.trace')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = defaultdict(float)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [count per bucket (+Inf last), sum]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return sum(entry[0]) if entry else 0
+
+    def _samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {_format_value(total)}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = Registry()
+
+REQUESTS = registry.counter(
+    'rag_requests_total', 'Chat requests and ingestion jobs by outcome', ['pipeline', 'outcome']
+)
+REQUEST_SECONDS = registry.histogram(
+    'rag_request_seconds', 'End-to-end duration of chat requests and ingestion jobs', ['pipeline']
+)
+STAGE_SECONDS = registry.histogram(
+    'rag_stage_seconds', 'Time spent in one stage of a request or ingestion job', ['pipeline', 'stage']
+)
+FIRST_TOKEN_SECONDS = registry.histogram(
+    'rag_first_token_seconds', 'Time from request to the first streamed token', ['pipeline']
+)
+INGESTED_CHUNKS = registry.counter(
+    'rag_ingested_chunks_total', 'Chunks embedded and stored by ingestion'
+)
+RESPONSE_CACHE_LOOKUPS = registry.counter(
+    'rag_response_cache_lookups_total', 'Response cache lookups by result', ['result']
+)
+
+
+class Trace:
+    """Stage timings and attributes of one request or ingestion job"""
+
+    def __init__(self, pipeline: str, **fields):
+        self.pipeline = pipeline
+        self.fields = fields
+        self.stages: Dict[str, float] = {}
+        self.start = time.perf_counter()
+        self.finished = False
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a block; repeated stages of the same name add up"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def finish(self, outcome: str = 'ok', **fields) -> float:
+        """Record the trace in the metrics and log it; returns the total seconds"""
+        total = self.elapsed()
+        if self.finished:
+            return total
+        self.finished = True
+        self.fields.update(fields)
+        if not settings.METRICS_ENABLED:
+            return total
+
+        REQUESTS.inc(pipeline=self.pipeline, outcome=outcome)
+        REQUEST_SECONDS.observe(total, pipeline=self.pipeline)
+        for name, seconds in self.stages.items():
+            STAGE_SECONDS.observe(seconds, pipeline=self.pipeline, stage=name)
+        trace_logger.info(json.dumps({
+            'pipeline': self.pipeline,
+            'outcome': outcome,
+            'total_ms': round(total * 1000, 2),
+            'stages_ms': {name: round(seconds * 1000, 2) for name, seconds in self.stages.items()},
+            **self.fields,
+        }, default=str))
+        return total
@@ -0,0 +1,139 @@
+"""ONNX Runtime stand-in for a SentenceTransformer on CPU.
+
+``manage.py export_onnx`` writes an embedding model's transformer as
+``model.onnx`` (plus a dynamically int8-quantized ``model.int8.onnx``),
+its fast tokenizer as ``tokenizer.json`` and its pooling settings as
+``encoder.json``. OnnxEncoder tokenizes, runs the graph and reproduces
+the model's pooling and normalization, behind the part of the
+SentenceTransformer interface that EmbeddingService uses.
+"""
+from pathlib import Path
+from typing import List
+import numpy as np
+import json
+import logging
+import random
+
+logger = logging.getLogger(__name__)
+
+ENCODER_CONFIG = 'encoder.json'
+POOLING_MODES = ('mean', 'cls', 'max')
+
+# Words of the sentences an exported model is checked against the float one on
+PARITY_TEXT = (
+    'Employees submit travel expense reports within 30 days, with receipts for '
+    'anything over $25. The manager approves the report; finance reimburses it '
+    'in the next payroll run. Contracts with a new vendor need a security review '
+    'of network access, database backups and incident response before signing. '
+    'Quarterly audits check compliance, risk and the annual budget per department. '
+    'Onboarding covers training, leave, benefits and the project schedule: each '
+    'milestone has an owner, a deadline and a review. Questions? Ask HR (ext. 4410) '
+    'or read the policy wiki, section 3.2.'
+)
+
+
+def parity_sentences(count: int, seed: int = 0) -> List[str]:
+    """Deterministic sentences of 3 to 120 words drawn from PARITY_TEXT"""
+    rng = random.Random(seed)
+    words = PARITY_TEXT.split()
+    return [' '.join(rng.choice(words) for _ in range(rng.randint(3, 120))) for _ in range(count)]
+
+
+def cosine_drift(reference: np.ndarray, candidate: np.ndarray) -> np.ndarray:
+    """1 - cosine similarity between matching rows"""
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True).clip(min=1e-12)
+    candidate = candidate / np.linalg.norm(candidate, axis=1, keepdims=True).clip(min=1e-12)
+    return 1.0 - np.einsum('ij,ij->i', reference, candidate)
+
+
+class FastTokenizer:
+    """tokenize() of a Hugging Face fast tokenizer, without truncation.
+
+    Stands in for a SentenceTransformer's tokenizer where only token counts
+    are needed; ``backend_tokenizer`` is named as on transformers' fast
+    tokenizers.
+    """
+
+    def __init__(self, backend_tokenizer):
+        self.backend_tokenizer = backend_tokenizer
+        self.backend_tokenizer.no_truncation()
+        self.backend_tokenizer.no_padding()
+
+    @classmethod
+    def from_file(cls, path) -> 'FastTokenizer':
+        from tokenizers import Tokenizer
+        return cls(Tokenizer.from_file(str(path)))
+
+    @classmethod
+    def from_str(cls, serialized: str) -> 'FastTokenizer':
+        from tokenizers import Tokenizer
+        return cls(Tokenizer.from_str(serialized))
+
+    def tokenize(self, text: str) -> List[str]:
+        return self.backend_tokenizer.encode(text, add_special_tokens=False).tokens
+
+    def num_special_tokens_to_add(self, pair: bool = False) -> int:
+        return self.backend_tokenizer.num_special_tokens_to_add(pair)
+
+
+class OnnxEncoder:
+    def __init__(self, directory, quantized: bool = False, threads: int = 0):
+        # Deferred like sentence_transformers: only embedding processes need it
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        directory = Path(directory)
+        config = json.loads((directory / ENCODER_CONFIG).read_text())
+        if config['pooling'] not in POOLING_MODES:
+            raise ValueError(f"Unsupported pooling mode: {config['pooling']}")
+        self.model_name = config['model_name']
+        self.max_seq_length = config['max_seq_length']
+        self.pooling = config['pooling']
+        self.normalize = config['normalize']
+        self.dimension = config['dimension']
+
+        # Same truncation and padding as the original tokenizer call
+        self._tokenizer = Tokenizer.from_file(str(directory / 'tokenizer.json'))
+        self._tokenizer.enable_truncation(self.max_seq_length)
+        self._tokenizer.enable_padding(pad_id=config['pad_token_id'], pad_token=config['pad_token'])
+        self.tokenizer = FastTokenizer.from_file(directory / 'tokenizer.json')
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        path = directory / ('model.int8.onnx' if quantized else 'model.onnx')
+        self.session = onnxruntime.InferenceSession(str(path), options, providers=['CPUExecutionProvider'])
+        self._input_names = {model_input.name for model_input in self.session.get_inputs()}
+        logger.info(f"Loaded ONNX embedding model from {path}")
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def _pool(self, hidden: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        if self.pooling == 'cls':
+            return hidden[:, 0]
+        if self.pooling == 'max':
+            return np.where(mask[:, :, None] > 0, hidden, -1e9).max(axis=1)
+        weights = mask[:, :, None].astype(np.float32)
+        return (hidden * weights).sum(axis=1) / weights.sum(axis=1).clip(min=1e-9)
+
+    def encode(self, sentences: List[str], batch_size: int = 32, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = False, show_progress_bar: bool = False) -> np.ndarray:
+        """Embeddings of the sentences as a (len(sentences), dim) float32 array"""
+        output = np.empty((len(sentences), self.dimension), dtype=np.float32)
+        for start in range(0, len(sentences), batch_size):
+            encodings = self._tokenizer.encode_batch(sentences[start:start + batch_size])
+            mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+            feed = {
+                'input_ids': np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+                'attention_mask': mask,
+            }
+            if 'token_type_ids' in self._input_names:
+                feed['token_type_ids'] = np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)
+            hidden = self.session.run(None, feed)[0]
+            output[start:start + len(encodings)] = self._pool(hidden, mask)
+        if self.normalize or normalize_embeddings:
+            output /= np.linalg.norm(output, axis=1, keepdims=True).clip(min=1e-12)
+        return output
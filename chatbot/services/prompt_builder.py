@@ -0,0 +1,243 @@
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence
+import math
+import os
+import threading
+import logging
+
+from .onnx_encoder import FastTokenizer
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_TEMPLATE = """You are a helpful AI assistant. Answer the user's question based on the following context.
+
+Context:
+{context}
+
+If the answer cannot be found in the context, say so politely and provide general knowledge if appropriate."""
+
+NO_CONTEXT = "No relevant context found."
+
+# Chat templates add a few tokens of framing per message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Shortest run of words treated as overlap between two chunks
+MIN_OVERLAP_WORDS = 8
+
+# PROMPT_TOKENIZER value that estimates token counts instead of tokenizing
+ESTIMATE = 'estimate'
+
+
+class TokenCounter:
+    """Counts tokens with a Hugging Face fast tokenizer.
+
+    ``tokenizer`` is a tokenizer.json path or a Hub repository id; empty
+    uses the embedding model's tokenizer, and ``ESTIMATE`` counts without
+    one. Estimates take one token per four ASCII bytes, close for English
+    text with BPE vocabularies, and one per other character so that
+    non-Latin text is not undercounted. A tokenizer that cannot be loaded
+    also falls back to the estimate.
+    """
+
+    def __init__(self, tokenizer: str = ''):
+        self.name = tokenizer
+        self._tokenizer = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.count = lru_cache(maxsize=16384)(self._count)
+
+    def _load(self):
+        if self._loaded:
+            return self._tokenizer
+        with self._lock:
+            if not self._loaded:
+                if self.name != ESTIMATE:
+                    try:
+                        if not self.name:
+                            from .embeddings import EmbeddingService
+                            self._tokenizer = EmbeddingService().tokenizer
+                        elif os.path.exists(self.name):
+                            self._tokenizer = FastTokenizer.from_file(self.name)
+                        else:
+                            from tokenizers import Tokenizer
+                            self._tokenizer = FastTokenizer(Tokenizer.from_pretrained(self.name))
+                    except Exception as e:
+                        logger.warning(f"Could not load tokenizer {self.name or 'of the embedding model'}, "
+                                       f"estimating token counts: {e}")
+                self._loaded = True
+        return self._tokenizer
+
+    def _count(self, text: str) -> int:
+        tokenizer = self._load()
+        if tokenizer is not None:
+            return len(tokenizer.tokenize(text))
+        ascii_bytes = sum(1 for char in text if char < '\x80')
+        return math.ceil(ascii_bytes / 4) + len(text) - ascii_bytes
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Longest word prefix of text within max_tokens"""
+        if self.count(text) <= max_tokens:
+            return text
+        words = text.split()
+        low, high = 0, len(words)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.count(' '.join(words[:mid]) + ' …') <= max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        return ' '.join(words[:low]) + ' …' if low else ''
+
+
+@dataclass
+class Prompt:
+    messages: List[Dict]
+    prompt_tokens: int = 0
+    context_tokens: int = 0
+    history_tokens: int = 0
+    chunks_used: int = 0
+    chunks_dropped: int = 0
+    history_messages_dropped: int = 0
+    chunk_indexes: List[int] = field(default_factory=list)
+
+    def report(self) -> dict:
+        return {
+            'prompt_tokens': self.prompt_tokens,
+            'context_tokens': self.context_tokens,
+            'history_tokens': self.history_tokens,
+            'chunks_used': self.chunks_used,
+            'chunks_dropped': self.chunks_dropped,
+            'history_messages_dropped': self.history_messages_dropped,
+        }
+
+
+def _overlap_size(left: List[str], right: List[str]) -> int:
+    """Length of the longest suffix of left that is a prefix of right"""
+    if not left or not right:
+        return 0
+    first = right[0]
+    # Earlier start positions give longer overlaps
+    for start, word in enumerate(left):
+        size = len(left) - start
+        if size < MIN_OVERLAP_WORDS:
+            break
+        if word == first and size <= len(right) and left[start:] == right[:size]:
+            return size
+    return 0
+
+
+def _trim_overlap(words: List[str], selected: List[List[str]]) -> List[str]:
+    """Drop the words of a chunk that an already selected chunk contains.
+
+    Consecutive chunks of a document share their boundary words, so the
+    overlap is a prefix or suffix of the new chunk matching a suffix or
+    prefix of a selected one.
+    """
+    for other in selected:
+        words = words[_overlap_size(other, words):]
+        size = _overlap_size(words, other)
+        if size:
+            words = words[:-size]
+    return words
+
+
+class PromptBuilder:
+    """Assemble RAG chat messages under a token budget.
+
+    The system template, the question and a share of the budget for
+    history are accounted first; retrieved chunks are then packed in order
+    of relevance into what is left, with text shared between overlapping
+    chunks included once. History keeps the most recent messages that fit,
+    truncating long ones; older questions are listed in one line.
+    """
+
+    def __init__(self, counter: TokenCounter, max_tokens: int = 3000,
+                 history_tokens: int = 800, history_message_tokens: int = 300):
+        self.counter = counter
+        self.max_tokens = max_tokens
+        self.history_tokens = history_tokens
+        self.history_message_tokens = history_message_tokens
+
+    def _message_tokens(self, content: str) -> int:
+        return self.counter.count(content) + MESSAGE_OVERHEAD_TOKENS
+
+    def _pack_history(self, chat_history: Sequence[Dict], budget: int):
+        """Most recent messages within budget, oldest first, and the number dropped"""
+        packed, used = [], 0
+        for message in reversed(chat_history):
+            content = self.counter.truncate(message['content'], self.history_message_tokens)
+            tokens = self._message_tokens(content)
+            if used + tokens > budget:
+                break
+            packed.append({'role': message['role'], 'content': content})
+            used += tokens
+        packed.reverse()
+        # Keep whole question/answer turns
+        if packed and packed[0]['role'] == 'assistant':
+            used -= self._message_tokens(packed.pop(0)['content'])
+        return packed, used, len(chat_history) - len(packed)
+
+    def _earlier_questions(self, chat_history: Sequence[Dict], dropped: int, budget: int) -> str:
+        questions = [m['content'] for m in chat_history[:dropped] if m['role'] == 'user']
+        if not questions or budget <= 0:
+            return ''
+        line = 'Earlier in this conversation the user asked: ' + '; '.join(
+            ' '.join(q.split()[:20]) for q in reversed(questions)
+        )
+        return self.counter.truncate(line, budget)
+
+    def build(self, query: str, context: Sequence[str], chat_history: Sequence[Dict] = None,
+              scores: Optional[Sequence[float]] = None) -> Prompt:
+        """Messages for query; scores are distances, lower is more relevant"""
+        chat_history = list(chat_history or [])
+        fixed = (self._message_tokens(SYSTEM_TEMPLATE.format(context=''))
+                 + self._message_tokens(query))
+        remaining = max(0, self.max_tokens - fixed)
+
+        history, history_used, dropped = self._pack_history(
+            chat_history, min(self.history_tokens, remaining)
+        )
+        remaining -= history_used
+
+        order = list(range(len(context)))
+        if scores is not None:
+            order.sort(key=lambda i: scores[i])
+
+        selected: List[List[str]] = []
+        parts, indexes = [], []
+        context_used = 0
+        for i in order:
+            words = _trim_overlap(context[i].split(), selected)
+            if not words:
+                continue
+            text = ' '.join(words)
+            # Chunks are joined by a blank line, about two tokens
+            tokens = self.counter.count(text) + 2
+            if context_used + tokens > remaining:
+                continue
+            selected.append(context[i].split())
+            parts.append(text)
+            indexes.append(i)
+            context_used += tokens
+        remaining -= context_used
+
+        context_text = "\n\n".join(parts) if parts else NO_CONTEXT
+        system_message = SYSTEM_TEMPLATE.format(context=context_text)
+        earlier = self._earlier_questions(chat_history, dropped, remaining)
+        if earlier:
+            system_message += '\n\n' + earlier
+
+        messages = [{"role": "system", "content": system_message}, *history,
+                    {"role": "user", "content": query}]
+        prompt_tokens = sum(self._message_tokens(m['content']) for m in messages)
+        return Prompt(
+            messages=messages,
+            prompt_tokens=prompt_tokens,
+            context_tokens=context_used,
+            history_tokens=history_used,
+            chunks_used=len(parts),
+            chunks_dropped=len(context) - len(parts),
+            history_messages_dropped=dropped,
+            chunk_indexes=indexes,
+        )
@@ -0,0 +1,110 @@
+"""In-process cache of chat query embeddings.
+
+Queries are normalized (Unicode NFKC, case-folded, whitespace collapsed,
+surrounding punctuation stripped) and embedded in that form, so "Summarize"
+and "summarize?" share one vector. Lookups go first to a read-only table
+of precomputed queries, loaded when the worker starts (see ``manage.py
+precompute_queries``), then to a size-bounded LRU. Both sit in front of
+EmbeddingCache, whose sha256 keys and SQLite table are the next level for
+queries seen by other processes.
+"""
+from pathlib import Path
+from typing import Dict, List, Optional
+import numpy as np
+import re
+import threading
+import unicodedata
+import logging
+
+from .embedding_cache import LRUCache
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+QUERY_EMBEDDING_LOOKUPS = registry.counter(
+    'rag_query_embedding_lookups_total', 'Query embedding lookups by source', ['source']
+)
+
+EDGE_PUNCTUATION = re.compile(r'^[\s"\'`.,;:!?()\[\]]+|[\s"\'`.,;:!?()\[\]]+$')
+
+
+def normalize_query(text: str) -> str:
+    """Canonical form of a chat query for caching and embedding"""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    return EDGE_PUNCTUATION.sub('', ' '.join(text.split()))
+
+
+class QueryEmbeddingCache:
+    """Precomputed table plus LRU of query vectors, keyed by normalized text"""
+
+    def __init__(self, max_size: int = 2048):
+        self.memory = LRUCache(max_size)
+        self.precomputed: Dict[str, np.ndarray] = {}
+        self._stats_lock = threading.Lock()
+        self.precomputed_hits = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, query: str) -> Optional[np.ndarray]:
+        """Vector for an already normalized query, or None"""
+        vector = self.precomputed.get(query)
+        source = 'precomputed'
+        if vector is None:
+            vector = self.memory.get(query)
+            source = 'memory' if vector is not None else 'miss'
+        with self._stats_lock:
+            if source == 'precomputed':
+                self.precomputed_hits += 1
+            elif source == 'memory':
+                self.hits += 1
+            else:
+                self.misses += 1
+        QUERY_EMBEDDING_LOOKUPS.inc(source=source)
+        return vector
+
+    def put(self, query: str, vector: np.ndarray):
+        self.memory.put(query, np.ascontiguousarray(vector, dtype=np.float32))
+
+    def load(self, path, model_name: str) -> int:
+        """Load a precomputed table; returns the number of queries loaded"""
+        path = Path(path)
+        if not path.exists():
+            return 0
+        try:
+            with np.load(path) as data:
+                if str(data['model']) != model_name:
+                    logger.warning(
+                        f"Ignoring precomputed queries in {path}: computed with {data['model']}, "
+                        f"not {model_name}"
+                    )
+                    return 0
+                queries, vectors = data['queries'].tolist(), data['vectors']
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning(f"Could not load precomputed queries from {path}: {e}")
+            return 0
+        # Replaced wholesale, so readers never see a partial table
+        self.precomputed = {query: vectors[i] for i, query in enumerate(queries)}
+        logger.info(f"Loaded {len(queries)} precomputed query embeddings from {path}")
+        return len(queries)
+
+    @staticmethod
+    def save(path, queries: List[str], vectors: np.ndarray, model_name: str):
+        """Write a precomputed table for load()"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + '.tmp.npz')
+        np.savez(tmp, queries=np.array(queries, dtype=str), vectors=np.asarray(vectors, dtype=np.float32),
+                 model=np.array(model_name))
+        tmp.replace(path)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            lookups = self.precomputed_hits + self.hits + self.misses
+            return {
+                'precomputed_entries': len(self.precomputed),
+                'precomputed_hits': self.precomputed_hits,
+                'memory_entries': len(self.memory),
+                'memory_hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.precomputed_hits + self.hits) / lookups if lookups else 0.0,
+            }
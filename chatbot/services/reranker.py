@@ -0,0 +1,160 @@
+"""Cross-encoder re-ranking of retrieved chunks.
+
+Retrieval over-fetches RERANK_CANDIDATES chunks; a small cross-encoder
+scores each (query, chunk) pair in one batched call and only the best
+RERANK_TOP_K reach the prompt. Scores are kept in a bounded LRU keyed by
+(normalized query, chunk id). Chunk ids are never reused for other text,
+so an entry stays valid until it is evicted.
+
+Scoring runs on a small thread pool and a request waits at most
+RERANK_BUDGET_MS for it. Past the budget the request keeps the retrieval
+order; the batch still finishes in the background and fills the cache,
+so the question is re-ranked when it is asked again. Batches that have
+not started by then are cancelled, so a backlog sheds load instead of
+growing.
+"""
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from django.conf import settings
+from typing import List, Optional
+import numpy as np
+import logging
+import threading
+
+from .embedding_cache import LRUCache
+from .metrics import registry
+from .query_embeddings import normalize_query
+
+logger = logging.getLogger(__name__)
+
+RERANK_REQUESTS = registry.counter(
+    'rag_rerank_requests_total', 'Re-ranked retrievals by result', ['result']
+)
+RERANK_SCORE_LOOKUPS = registry.counter(
+    'rag_rerank_score_lookups_total', 'Cross-encoder score cache lookups by result', ['result']
+)
+
+
+def _head(results: dict, n_results: int) -> dict:
+    """The first n_results of a search result, in retrieval order"""
+    return {
+        key: [(results.get(key) or [[]])[0][:n_results]]
+        for key in ('ids', 'documents', 'metadatas', 'distances')
+    }
+
+
+class Reranker:
+    def __init__(self, model_name: str, max_length: int = 256, batch_size: int = 32,
+                 cache_size: int = 20000, workers: int = 1):
+        self.model_name = model_name
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.workers = workers
+        self.scores = LRUCache(cache_size)
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def model(self):
+        """The CrossEncoder, loaded on first use"""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    from sentence_transformers import CrossEncoder
+                    self._model = CrossEncoder(self.model_name, max_length=self.max_length)
+                    logger.info(f"Loaded re-ranking model: {self.model_name}")
+        return self._model
+
+    def warm_up(self):
+        self.model
+
+    def _pool(self) -> ThreadPoolExecutor:
+        # Created on first use, in the worker: threads do not survive fork
+        if self._executor is None:
+            with self._model_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='rerank')
+        return self._executor
+
+    def _predict(self, query: str, chunk_ids: List[str], texts: List[str]) -> np.ndarray:
+        scores = self.model.predict(
+            [(query, text) for text in texts],
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        for chunk_id, score in zip(chunk_ids, scores):
+            self.scores.put((query, chunk_id), float(score))
+        return scores
+
+    def rerank(self, query: str, results: dict, n_results: int, budget: float) -> dict:
+        """The n_results best chunks of an over-fetched search result.
+
+        Returned in Chroma's result format, with negated cross-encoder
+        scores as distances so lower is still more relevant. If scoring
+        takes longer than budget seconds, or fails, the first n_results
+        are returned in retrieval order.
+        """
+        ids = (results.get('ids') or [[]])[0]
+        if len(ids) <= 1:
+            return _head(results, n_results)
+        documents = results['documents'][0]
+        query = normalize_query(query) or query
+
+        scores = np.empty(len(ids), dtype=np.float32)
+        missing = []
+        for i, chunk_id in enumerate(ids):
+            score = self.scores.get((query, chunk_id))
+            if score is None:
+                missing.append(i)
+            else:
+                scores[i] = score
+        RERANK_SCORE_LOOKUPS.inc(len(ids) - len(missing), result='hit')
+        RERANK_SCORE_LOOKUPS.inc(len(missing), result='miss')
+
+        if missing:
+            future = self._pool().submit(
+                self._predict, query, [ids[i] for i in missing], [documents[i] for i in missing]
+            )
+            try:
+                scores[missing] = future.result(timeout=budget)
+            except TimeoutError:
+                # Not started yet: drop it. Running: let it fill the cache
+                future.cancel()
+                RERANK_REQUESTS.inc(result='fallback')
+                return _head(results, n_results)
+            except Exception as e:
+                logger.error(f"Re-ranking failed, keeping retrieval order: {e}")
+                RERANK_REQUESTS.inc(result='error')
+                return _head(results, n_results)
+
+        order = np.argsort(-scores, kind='stable')[:n_results]
+        RERANK_REQUESTS.inc(result='reranked')
+        return {
+            'ids': [[ids[i] for i in order]],
+            'documents': [[documents[i] for i in order]],
+            'metadatas': [[results['metadatas'][0][i] for i in order]],
+            'distances': [[-float(scores[i]) for i in order]],
+        }
+
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker() -> Optional[Reranker]:
+    """Process-wide Reranker, or None when disabled"""
+    global _reranker
+    if not settings.RERANK_ENABLED:
+        return None
+    if _reranker is None:
+        with _reranker_lock:
+            if _reranker is None:
+                _reranker = Reranker(
+                    settings.RERANK_MODEL,
+                    max_length=settings.RERANK_MAX_LENGTH,
+                    batch_size=settings.RERANK_CANDIDATES,
+                    cache_size=settings.RERANK_CACHE_SIZE,
+                    workers=settings.RERANK_WORKERS
+                )
+    return _reranker
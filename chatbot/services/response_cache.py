@@ -0,0 +1,185 @@
+from django.conf import settings
+from pathlib import Path
+from typing import Dict, List, Optional
+import numpy as np
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Semantic cache of LLM responses.
+
+    An entry is reused when the same user asks a question whose embedding
+    is within ``similarity`` (cosine) of a cached question, *and* retrieval
+    returned the same chunk ids, *and* the chat history sent with the
+    question is the same, *and* the same LLM model answers. The chunk ids
+    and history pin the prompt context, so an answer is never reused over
+    different documents or for a follow-up in another conversation;
+    entries are also dropped whenever the user's vector store changes (see
+    VectorStoreService).
+
+    Entries live in a SQLite table shared by every process on the host and
+    expire after ``ttl`` seconds; beyond ``max_entries`` the least recently
+    used ones are evicted.
+    """
+
+    def __init__(self, path: str, similarity: float = 0.95, ttl: int = 86400,
+                 max_entries: int = 50000):
+        self.path = str(path)
+        self.similarity = similarity
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connection()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            ' id INTEGER PRIMARY KEY,'
+            ' user_id INTEGER NOT NULL,'
+            ' context_key BLOB NOT NULL,'
+            ' embedding BLOB NOT NULL,'
+            ' response TEXT NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' last_used REAL NOT NULL,'
+            ' hits INTEGER NOT NULL DEFAULT 0)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS responses_lookup ON responses (user_id, context_key)')
+        conn.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def context_key(chunk_ids: List[str], model: str, history: List[Dict] = None) -> bytes:
+        """Identity of the retrieved context, the chat history and the model answering over them"""
+        digest = hashlib.sha256('\0'.join([model, *sorted(chunk_ids)]).encode('utf-8'))
+        # Follow-ups ("and the second one?") only make sense in their conversation
+        for message in history or []:
+            digest.update(f"\1{message['role']}\0{message['content']}".encode('utf-8'))
+        return digest.digest()
+
+    @staticmethod
+    def _unit(embedding: np.ndarray) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def get(self, user_id: int, query_embedding: np.ndarray, chunk_ids: List[str],
+            model: str, history: List[Dict] = None) -> Optional[str]:
+        """Cached response for a similar question over the same context and history, if any"""
+        query = self._unit(query_embedding)
+        conn = self._connection()
+        rows = conn.execute(
+            'SELECT id, embedding, response FROM responses'
+            ' WHERE user_id = ? AND context_key = ? AND created_at >= ?',
+            (user_id, self.context_key(chunk_ids, model, history), time.time() - self.ttl)
+        ).fetchall()
+
+        best_id, best_response, best_score = None, None, self.similarity
+        for entry_id, blob, response in rows:
+            score = float(np.frombuffer(blob, dtype=np.float32) @ query)
+            if score >= best_score:
+                best_id, best_response, best_score = entry_id, response, score
+
+        with self._stats_lock:
+            if best_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if best_id is not None:
+            conn.execute(
+                'UPDATE responses SET hits = hits + 1, last_used = ? WHERE id = ?',
+                (time.time(), best_id)
+            )
+        return best_response
+
+    def put(self, user_id: int, query_embedding: np.ndarray, chunk_ids: List[str],
+            model: str, response: str, history: List[Dict] = None):
+        now = time.time()
+        conn = self._connection()
+        conn.execute(
+            'INSERT INTO responses (user_id, context_key, embedding, response, created_at, last_used)'
+            ' VALUES (?, ?, ?, ?, ?, ?)',
+            (user_id, self.context_key(chunk_ids, model, history),
+             self._unit(query_embedding).tobytes(), response, now, now)
+        )
+        with self._stats_lock:
+            self.puts += 1
+            evict = self.puts % 100 == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> int:
+        """Drop expired entries and trim the table to max_entries"""
+        conn = self._connection()
+        removed = conn.execute(
+            'DELETE FROM responses WHERE created_at < ?', (time.time() - self.ttl,)
+        ).rowcount
+        excess = conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0] - self.max_entries
+        if excess > 0:
+            removed += conn.execute(
+                'DELETE FROM responses WHERE id IN'
+                ' (SELECT id FROM responses ORDER BY last_used LIMIT ?)',
+                (excess,)
+            ).rowcount
+        return removed
+
+    def invalidate(self, user_id: int) -> int:
+        """Forget every response for a user, e.g. after their documents changed"""
+        return self._connection().execute(
+            'DELETE FROM responses WHERE user_id = ?', (user_id,)
+        ).rowcount
+
+    def stats(self) -> dict:
+        entries, stored_hits = self._connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM responses'
+        ).fetchone()
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': entries,
+                'entry_hits': stored_hits,
+                'similarity': self.similarity,
+                'ttl': self.ttl,
+            }
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Process-wide ResponseCache, or None when disabled"""
+    global _response_cache
+    if not settings.RESPONSE_CACHE_ENABLED:
+        return None
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                _response_cache = ResponseCache(
+                    settings.RESPONSE_CACHE_PATH,
+                    similarity=settings.RESPONSE_CACHE_SIMILARITY,
+                    ttl=settings.RESPONSE_CACHE_TTL,
+                    max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES
+                )
+    return _response_cache
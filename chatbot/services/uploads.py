@@ -0,0 +1,231 @@
+"""Resumable uploads sent in parts.
+
+A client opens an UploadSession with the file's name and size, then PUTs
+the bytes in order, each request carrying its start in the
+``Upload-Offset`` header. Parts are streamed from the request into
+``MEDIA_ROOT/uploads/partial/<session>.part`` and through a sha256 as
+they arrive, so server memory stays constant whatever the file size.
+After a dropped connection the client asks for the session's offset and
+continues from there. The part that completes the file renames it into
+``uploads/`` (no copy) and creates the Document, which the ingestion
+worker picks up on its next poll.
+
+The sha256 state stays in the process that received the previous part;
+a part arriving at another worker, or after a restart, first re-hashes
+the bytes already on disk. An exclusive lock on the part file keeps two
+requests from writing one session at once.
+"""
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+from pathlib import Path
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+
+from ..models import Document, UploadSession
+from .corpus import deduplicate
+from .metrics import Trace
+
+logger = logging.getLogger(__name__)
+
+ALLOWED_EXTENSIONS = ('pdf', 'txt')
+READ_BLOCK = 1024 * 1024
+# Hash states kept for sessions whose next part is expected here
+_MAX_HASHERS = 256
+
+
+class UploadError(Exception):
+    """A request the session cannot accept, with the HTTP status to answer"""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+_hashers = OrderedDict()
+_hashers_lock = threading.Lock()
+
+
+def partial_path(session: UploadSession) -> Path:
+    return Path(settings.MEDIA_ROOT) / 'uploads' / 'partial' / f'{session.id}.part'
+
+
+def upload_state(session: UploadSession) -> dict:
+    return {
+        'id': str(session.id),
+        'filename': session.filename,
+        'size': session.size,
+        'offset': session.received,
+        'part_size': settings.UPLOAD_PART_SIZE,
+        'completed': session.completed_at is not None,
+        'document_id': session.document_id,
+    }
+
+
+def open_session(user, filename: str, size: int) -> UploadSession:
+    """Start an upload of size bytes"""
+    filename = os.path.basename(filename.strip())
+    if filename.rsplit('.', 1)[-1].lower() not in ALLOWED_EXTENSIONS:
+        raise UploadError('Only PDF and TXT files are allowed.')
+    max_length = UploadSession._meta.get_field('filename').max_length
+    if len(filename) > max_length:
+        raise UploadError(f'File names must be at most {max_length} characters.')
+    if size <= 0:
+        raise UploadError('The file is empty.')
+    if size > settings.UPLOAD_MAX_SIZE:
+        raise UploadError(f'File size must be under {settings.UPLOAD_MAX_SIZE // (1024 * 1024)}MB.', status=413)
+
+    session = UploadSession.objects.create(user=user, filename=filename, size=size)
+    path = partial_path(session)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.touch()
+    return session
+
+
+def _hasher_at(session_id, offset: int, path: Path):
+    """sha256 of the first offset bytes of the part file"""
+    with _hashers_lock:
+        entry = _hashers.pop(session_id, None)
+    if entry is not None and entry[0] == offset:
+        return entry[1]
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        remaining = offset
+        while remaining:
+            block = f.read(min(READ_BLOCK, remaining))
+            if not block:
+                raise UploadError('Upload data is missing; start the upload again', status=410)
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher
+
+
+def _remember(session_id, offset: int, hasher):
+    with _hashers_lock:
+        _hashers[session_id] = (offset, hasher)
+        while len(_hashers) > _MAX_HASHERS:
+            _hashers.popitem(last=False)
+
+
+def write_part(session: UploadSession, offset: int, stream, length: int) -> UploadSession:
+    """Append length bytes read from stream at offset; completes the upload on the last part"""
+    if session.completed_at is not None:
+        raise UploadError('Upload already completed', status=409)
+    if length <= 0:
+        raise UploadError('Empty part')
+    if length > settings.UPLOAD_PART_MAX_SIZE:
+        raise UploadError(f'Parts must be at most {settings.UPLOAD_PART_MAX_SIZE} bytes', status=413)
+    if offset + length > session.size:
+        raise UploadError('Part extends past the declared file size')
+
+    trace = Trace('upload_part', user_id=session.user_id, upload_id=str(session.id), part_size=length)
+    path = partial_path(session)
+    try:
+        fd = os.open(path, os.O_WRONLY)
+    except FileNotFoundError:
+        raise UploadError('Upload not found', status=404)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError('Another part of this upload is being written', status=409)
+        # Another request may have moved the offset before the lock was taken
+        session.refresh_from_db(fields=['received', 'completed_at'])
+        if session.completed_at is not None or offset != session.received:
+            raise UploadError(f'Expected offset {session.received}', status=409)
+
+        with trace.stage('hash_resume'):
+            hasher = _hasher_at(session.id, offset, path)
+        written = 0
+        with trace.stage('write'):
+            while written < length:
+                block = stream.read(min(READ_BLOCK, length - written))
+                if not block:
+                    break
+                os.pwrite(fd, block, offset + written)
+                hasher.update(block)
+                written += len(block)
+            # Whatever arrived is kept even if the connection dropped, and
+            # must be on disk before the offset says so
+            os.fdatasync(fd)
+        if written:
+            session.received = offset + written
+            UploadSession.objects.filter(id=session.id).update(
+                received=session.received, updated_at=timezone.now()
+            )
+            _remember(session.id, session.received, hasher)
+        if session.received == session.size:
+            with trace.stage('finalize'):
+                os.ftruncate(fd, session.size)
+                _complete(session, hasher.hexdigest(), path)
+    finally:
+        # Closing releases the lock
+        os.close(fd)
+    trace.finish(written=written, completed=session.completed_at is not None)
+    if written < length:
+        raise UploadError(f'Part ended after {written} of {length} bytes; resume from {session.received}')
+    return session
+
+
+def _store(path: Path, filename: str) -> str:
+    """Move the part file into uploads/ under a free name, without copying it"""
+    # Long names are shortened to fit the Document.file column
+    max_length = Document._meta.get_field('file').max_length
+    while True:
+        name = default_storage.get_available_name(f'uploads/{get_valid_filename(filename)}', max_length=max_length)
+        try:
+            # Unlike a rename, linking fails if another upload took the name since
+            os.link(path, Path(settings.MEDIA_ROOT) / name)
+        except FileExistsError:
+            continue
+        path.unlink()
+        return name
+
+
+def _complete(session: UploadSession, content_hash: str, path: Path):
+    with transaction.atomic():
+        content, stored = deduplicate(content_hash, None)
+        if stored is None:
+            stored = _store(path, session.filename)
+        else:
+            path.unlink()
+
+        doc = Document.objects.create(
+            user_id=session.user_id,
+            filename=session.filename,
+            file=stored,
+            file_size=session.size,
+            content_hash=content_hash,
+            content=content
+        )
+        session.document = doc
+        session.completed_at = timezone.now()
+        session.save(update_fields=['document', 'completed_at', 'updated_at'])
+    with _hashers_lock:
+        _hashers.pop(session.id, None)
+    logger.info(f"Upload {session.id} completed as document {doc.id} ({session.size} bytes)")
+
+
+def abort_session(session: UploadSession):
+    """Discard an unfinished upload"""
+    partial_path(session).unlink(missing_ok=True)
+    with _hashers_lock:
+        _hashers.pop(session.id, None)
+    session.delete()
+
+
+def expire_sessions(max_age: timedelta) -> int:
+    """Delete sessions idle for longer than max_age, with their partial files"""
+    expired = UploadSession.objects.filter(updated_at__lt=timezone.now() - max_age)
+    count = 0
+    for session in expired.iterator():
+        abort_session(session)
+        count += 1
+    return count
@@ -1,61 +1,573 @@
-import chromadb
-from typing import List, Dict
+import numpy as np
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from django.conf import settings
+from django.utils import timezone
+import os
+import re
+import threading
 import uuid
 import logging
 
+from ..models import Document, DocumentContent, EmbeddingMetadata
+from .lexical_index import lexical_index_pool
+from .local_index import local_index_pool
+from .response_cache import get_response_cache
+
 logger = logging.getLogger(__name__)
 
+
+class ChromaClientPool:
+    """Process-wide Chroma client with an LRU of open collection handles.
+
+    Opening a PersistentClient and resolving a collection costs several
+    milliseconds; chat requests reuse both instead of paying it each time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = None
+        self._collections = OrderedDict()
+
+    def client(self):
+        # A client inherited through fork is not usable in the child
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    import chromadb
+                    self._client = chromadb.PersistentClient(
+                        path=str(settings.CHROMA_PERSIST_DIRECTORY)
+                    )
+                    self._pid = os.getpid()
+                    self._collections.clear()
+        return self._client
+
+    def collection(self, name: str):
+        client = self.client()
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is not None:
+                self._collections.move_to_end(name)
+                return collection
+
+        collection = client.get_or_create_collection(name=name)
+        with self._lock:
+            self._collections[name] = collection
+            self._collections.move_to_end(name)
+            while len(self._collections) > settings.CHROMA_COLLECTION_CACHE_SIZE:
+                self._collections.popitem(last=False)
+        return collection
+
+    def evict(self, name: str):
+        with self._lock:
+            self._collections.pop(name, None)
+
+    def reset(self):
+        with self._lock:
+            self._client = None
+            self._collections.clear()
+
+
+chroma_pool = ChromaClientPool()
+
+
+SHARED_NAMESPACE = 'shared'
+
+
+class VectorBackend(ABC):
+    """Storage and nearest-neighbour search for one namespace of chunks.
+
+    A namespace is ``user_<id>`` for a user's own store, or ``shared`` for
+    the deduplicated corpus. search() returns Chroma's query result shape
+    (a list per query for ids, documents, metadatas and distances) whatever
+    the backend; with doc_ids it only considers chunks of those documents.
+    """
+
+    @classmethod
+    @abstractmethod
+    def user_ids(cls) -> List[int]:
+        """Users that have a store on disk, including deleted users"""
+
+    @abstractmethod
+    def add(self, ids: List[str], texts: List[str], embeddings: np.ndarray,
+            metadatas: List[Dict] = None):
+        ...
+
+    @abstractmethod
+    def search(self, query_embedding: np.ndarray, n_results: int,
+               doc_ids: Optional[List[int]] = None) -> dict:
+        ...
+
+    @abstractmethod
+    def get(self, ids: List[str]) -> dict:
+        """Documents and metadata by id: {'ids', 'documents', 'metadatas'}"""
+
+    @abstractmethod
+    def delete(self, ids: List[str]):
+        ...
+
+    @abstractmethod
+    def delete_documents(self, doc_ids: List[int]) -> int:
+        ...
+
+    @abstractmethod
+    def entries(self, batch_size: int = 1000) -> Iterator[Tuple[str, str, Dict]]:
+        """Yield (id, document, metadata) for every stored chunk"""
+
+    @abstractmethod
+    def compact(self) -> int:
+        """Reclaim the space of deleted chunks; returns chunks reclaimed"""
+
+    @abstractmethod
+    def count(self) -> int:
+        ...
+
+    @abstractmethod
+    def drop(self):
+        ...
+
+
+class ChromaBackend(VectorBackend):
+    name_re = re.compile(r'^user_(\d+)_docs$')
+
+    def __init__(self, namespace: str):
+        self.client = chroma_pool.client()
+        self.collection_name = f"{namespace}_docs"
+        self.collection = chroma_pool.collection(self.collection_name)
+
+    def add(self, ids, texts, embeddings, metadatas=None):
+        self.collection.add(
+            documents=texts,
+            embeddings=embeddings,
+            metadatas=metadatas or None,
+            ids=ids
+        )
+
+    def search(self, query_embedding, n_results, doc_ids=None):
+        if doc_ids is None:
+            return self.collection.query(
+                query_embeddings=[query_embedding],
+                n_results=n_results
+            )
+        if not doc_ids:
+            return {'ids': [[]], 'documents': [[]], 'metadatas': [[]], 'distances': [[]]}
+        return self.collection.query(
+            query_embeddings=[query_embedding],
+            n_results=n_results,
+            where={'doc_id': {'$in': list(doc_ids)}}
+        )
+
+    @classmethod
+    def user_ids(cls):
+        user_ids = []
+        for collection in chroma_pool.client().list_collections():
+            match = cls.name_re.match(getattr(collection, 'name', collection))
+            if match:
+                user_ids.append(int(match.group(1)))
+        return user_ids
+
+    def get(self, ids):
+        result = self.collection.get(ids=ids, include=['documents', 'metadatas'])
+        records = dict(zip(result['ids'], zip(result['documents'], result['metadatas'])))
+        found = [chunk_id for chunk_id in ids if chunk_id in records]
+        return {
+            'ids': found,
+            'documents': [records[chunk_id][0] for chunk_id in found],
+            'metadatas': [records[chunk_id][1] for chunk_id in found],
+        }
+
+    def delete(self, ids):
+        self.collection.delete(ids=ids)
+
+    def delete_documents(self, doc_ids):
+        ids = self.collection.get(where={'doc_id': {'$in': doc_ids}}, include=[])['ids']
+        if ids:
+            self.collection.delete(ids=ids)
+        return len(ids)
+
+    def entries(self, batch_size=1000):
+        offset = 0
+        while True:
+            batch = self.collection.get(include=['documents', 'metadatas'], limit=batch_size, offset=offset)
+            if not batch['ids']:
+                return
+            yield from zip(batch['ids'], batch['documents'], batch['metadatas'])
+            offset += len(batch['ids'])
+
+    def compact(self):
+        # Chroma reclaims deleted entries itself
+        return 0
+
+    def count(self):
+        return self.collection.count()
+
+    def drop(self):
+        chroma_pool.evict(self.collection_name)
+        self.client.delete_collection(name=self.collection_name)
+
+
+class LocalBackend(VectorBackend):
+    """Memory-mapped NumPy index (see services/local_index.py)"""
+
+    def __init__(self, namespace: str):
+        self.directory = Path(settings.LOCAL_INDEX_DIRECTORY) / namespace
+        self.index = local_index_pool.get(
+            self.directory,
+            max_open=settings.LOCAL_INDEX_CACHE_SIZE,
+            ann_threshold=settings.LOCAL_INDEX_ANN_THRESHOLD,
+            nprobe=settings.LOCAL_INDEX_NPROBE,
+            storage=settings.LOCAL_INDEX_STORAGE,
+            rerank=settings.LOCAL_INDEX_RERANK
+        )
+
+    def add(self, ids, texts, embeddings, metadatas=None):
+        self.index.add(ids, texts, embeddings, metadatas)
+
+    def search(self, query_embedding, n_results, doc_ids=None):
+        return self.index.search(query_embedding, n_results, doc_ids)
+
+    @classmethod
+    def user_ids(cls):
+        root = Path(settings.LOCAL_INDEX_DIRECTORY)
+        if not root.is_dir():
+            return []
+        return sorted(
+            int(path.name[len('user_'):]) for path in root.iterdir()
+            if path.is_dir() and re.fullmatch(r'user_\d+', path.name)
+        )
+
+    def get(self, ids):
+        return self.index.get(ids)
+
+    def delete(self, ids):
+        self.index.delete(ids)
+
+    def delete_documents(self, doc_ids):
+        return self.index.delete_documents(doc_ids)
+
+    def entries(self, batch_size=1000):
+        return self.index.entries(batch_size)
+
+    def compact(self):
+        return self.index.compact()
+
+    def count(self):
+        return self.index.count()
+
+    def drop(self):
+        local_index_pool.evict(self.directory)
+        self.index.drop()
+
+
+BACKENDS = {
+    'chroma': ChromaBackend,
+    'local': LocalBackend,
+}
+
+
 class VectorStoreService:
-    def __init__(self, user_id: int):
+    """A user's chunks, or with user_id None the shared corpus.
+
+    In the shared corpus the ``doc_id`` of a chunk is the id of its
+    DocumentContent, and searches pass the ids the user may read.
+    """
+
+    def __init__(self, user_id: Optional[int], backend: str = None):
         self.user_id = user_id
+        self.namespace = SHARED_NAMESPACE if user_id is None else f"user_{user_id}"
+        self.backend_name = backend or settings.VECTOR_STORE_BACKEND
         try:
-            self.client = chromadb.PersistentClient(
-                path=str(settings.CHROMA_PERSIST_DIRECTORY)
-            )
-            self.collection_name = f"user_{user_id}_docs"
-            self.collection = self.client.get_or_create_collection(
-                name=self.collection_name
-            )
-            logger.info(f"Vector store initialized for user {user_id}")
+            self.backend = BACKENDS[self.backend_name](self.namespace)
         except Exception as e:
             logger.error(f"Error initializing vector store: {e}")
             raise
+        # BM25 index fused with vector results in search()
+        self.lexical = None
+        if settings.HYBRID_SEARCH_ENABLED:
+            self.lexical = self._open_lexical()
+    
+    @classmethod
+    def shared(cls, backend: str = None) -> 'VectorStoreService':
+        """The deduplicated corpus shared by all users"""
+        return cls(None, backend=backend)
     
-    def add_documents(self, texts: List[str], embeddings: List[List[float]], 
-                     metadatas: List[Dict] = None):
-        """Add documents to the vector store"""
+    @property
+    def is_shared(self) -> bool:
+        return self.user_id is None
+    
+    def _open_lexical(self):
+        return lexical_index_pool.get(
+            Path(settings.LEXICAL_INDEX_DIRECTORY) / self.namespace,
+            max_open=settings.LOCAL_INDEX_CACHE_SIZE,
+            k1=settings.BM25_K1,
+            b=settings.BM25_B,
+            max_segments=settings.LEXICAL_INDEX_MAX_SEGMENTS
+        )
+    
+    def _invalidate_responses(self):
+        # Cached answers may cite chunks that changed. Shared chunks are
+        # keyed by content, so their owners are invalidated by the caller
+        response_cache = get_response_cache()
+        if response_cache is not None and not self.is_shared:
+            response_cache.invalidate(self.user_id)
+    
+    def add_documents(self, texts: List[str], embeddings: np.ndarray, 
+                     metadatas: List[Dict] = None, document: Document = None):
+        """Add documents to the vector store, tracking them against document"""
         try:
             ids = [str(uuid.uuid4()) for _ in range(len(texts))]
-            
-            self.collection.add(
-                documents=texts,
-                embeddings=embeddings,
-                metadatas=metadatas or [{}] * len(texts),
-                ids=ids
-            )
+            self.backend.add(ids, texts, embeddings, metadatas)
+            if self.lexical is not None:
+                self.lexical.add(ids, texts, [(m or {}).get('doc_id') for m in metadatas or [{}] * len(ids)])
+            if document is not None and not self.is_shared:
+                EmbeddingMetadata.objects.bulk_create([
+                    EmbeddingMetadata(user_id=self.user_id, document=document, chunk_id=chunk_id)
+                    for chunk_id in ids
+                ])
+            self._invalidate_responses()
             logger.info(f"Added {len(texts)} documents to vector store")
             return ids
         except Exception as e:
             logger.error(f"Error adding documents: {e}")
             raise
     
-    def search(self, query_embedding: List[float], n_results: int = 3):
-        """Search for similar documents"""
+    def search(self, query_embedding: np.ndarray, n_results: int = 3, query_text: str = None,
+               doc_ids: Optional[List[int]] = None):
+        """Search for similar documents, restricted to doc_ids if given.
+
+        With hybrid search enabled and the query text given, vector and
+        BM25 candidates are fused by reciprocal rank; the fused results
+        carry negated RRF scores as distances, so lower is still better.
+        """
         try:
-            results = self.collection.query(
-                query_embeddings=[query_embedding],
-                n_results=n_results
-            )
-            return results
+            if doc_ids is not None:
+                doc_ids = [int(doc_id) for doc_id in doc_ids]
+            if self.lexical is None or not query_text:
+                return self.backend.search(query_embedding, n_results, doc_ids)
+            candidates = max(n_results, settings.HYBRID_CANDIDATES)
+            vector_results = self.backend.search(query_embedding, candidates, doc_ids)
+            lexical_hits = self.lexical.search(query_text, candidates, doc_ids)
+            return self._fuse(vector_results, lexical_hits, n_results)
         except Exception as e:
             logger.error(f"Error searching documents: {e}")
             return {'documents': [[]], 'metadatas': [[]], 'distances': [[]]}
     
+    def _fuse(self, vector_results: dict, lexical_hits: List[Tuple[str, float]], n_results: int) -> dict:
+        """Reciprocal rank fusion of vector results and BM25 hits"""
+        k = settings.HYBRID_RRF_K
+        records = {
+            chunk_id: (document, metadata)
+            for chunk_id, document, metadata in zip(
+                vector_results['ids'][0], vector_results['documents'][0], vector_results['metadatas'][0]
+            )
+        }
+        scores: Dict[str, float] = {}
+        for rank, chunk_id in enumerate(vector_results['ids'][0]):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank + 1)
+        for rank, (chunk_id, _) in enumerate(lexical_hits):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank + 1)
+        
+        top = sorted(scores, key=scores.get, reverse=True)[:n_results]
+        missing = [chunk_id for chunk_id in top if chunk_id not in records]
+        if missing:
+            # Lexical-only hits; ids the backend no longer has are dropped
+            fetched = self.backend.get(missing)
+            records.update(zip(fetched['ids'], zip(fetched['documents'], fetched['metadatas'])))
+            top = [chunk_id for chunk_id in top if chunk_id in records]
+        return {
+            'ids': [top],
+            'documents': [[records[chunk_id][0] for chunk_id in top]],
+            'metadatas': [[records[chunk_id][1] for chunk_id in top]],
+            'distances': [[-scores[chunk_id] for chunk_id in top]],
+        }
+    
+    def count(self) -> int:
+        """Number of chunks stored for the user"""
+        return self.backend.count()
+
+    def delete_documents(self, doc_ids: Iterable) -> int:
+        """Delete every chunk of the given documents"""
+        # doc_id is stored as an int in chunk metadata
+        doc_ids = [int(doc_id) for doc_id in doc_ids]
+        if not doc_ids:
+            return 0
+        deleted = self.backend.delete_documents(doc_ids)
+        if self.lexical is not None:
+            self.lexical.delete_documents(doc_ids)
+        if not self.is_shared:
+            EmbeddingMetadata.objects.filter(user_id=self.user_id, document_id__in=doc_ids).delete()
+        self._invalidate_responses()
+        logger.info(f"Deleted {deleted} chunks of documents {doc_ids} from {self.namespace}")
+        return deleted
+
+    def delete_document(self, doc_id) -> int:
+        """Delete every chunk of one document"""
+        return self.delete_documents([doc_id])
+
+    def delete_by_metadata(self, where: Dict) -> int:
+        """Delete chunks matching {'doc_id': id} or {'doc_id': [ids]}"""
+        if set(where) != {'doc_id'}:
+            raise ValueError('Only deletion by doc_id is supported')
+        doc_ids = where['doc_id']
+        if not isinstance(doc_ids, (list, tuple, set)):
+            doc_ids = [doc_ids]
+        return self.delete_documents(doc_ids)
+
+    def reindex(self, doc_ids: Optional[Iterable] = None) -> int:
+        """Drop the chunks of the user's documents and queue them for ingestion again.
+
+        Documents currently being processed are skipped. With the shared
+        corpus enabled, their contents are reset as well, see
+        _reset_shared_contents. Returns the number of documents queued.
+        """
+        documents = Document.objects.filter(user_id=self.user_id).exclude(
+            status=Document.STATUS_PROCESSING
+        )
+        if doc_ids is not None:
+            documents = documents.filter(id__in=[int(doc_id) for doc_id in doc_ids])
+        doc_ids = list(documents.values_list('id', flat=True))
+        self.delete_documents(doc_ids)
+        if settings.SHARED_CORPUS_ENABLED:
+            self._reset_shared_contents(doc_ids)
+        return Document.objects.filter(id__in=doc_ids).update(
+            status=Document.STATUS_PENDING,
+            processed=False,
+            progress=0,
+            chunk_count=0,
+            attempts=0,
+            error_message='',
+            updated_at=timezone.now()
+        )
+
+    def _reset_shared_contents(self, doc_ids: List[int]) -> int:
+        """Send the shared contents of the documents back to be indexed again.
+
+        A worker completes a document from indexed content without work,
+        so the content's chunks are dropped and it goes back to pending.
+        Content that a document is processing is left alone. Other
+        documents sharing a reset content are queued too: they wait for
+        it to be indexed and then complete from it. Returns the number of
+        contents reset.
+        """
+        contents = DocumentContent.objects.filter(documents__id__in=doc_ids).exclude(
+            status=DocumentContent.STATUS_PROCESSING
+        ).exclude(
+            documents__status=Document.STATUS_PROCESSING
+        )
+        content_ids = list(contents.values_list('id', flat=True).distinct())
+        if not content_ids:
+            return 0
+        reset = DocumentContent.objects.filter(id__in=content_ids).exclude(
+            status=DocumentContent.STATUS_PROCESSING
+        ).update(status=DocumentContent.STATUS_PENDING, chunk_count=0, updated_at=timezone.now())
+        VectorStoreService.shared(backend=self.backend_name).delete_documents(content_ids)
+
+        sharing = Document.objects.filter(content_id__in=content_ids).exclude(id__in=doc_ids)
+        response_cache = get_response_cache()
+        if response_cache is not None:
+            for user_id in set(sharing.values_list('user_id', flat=True)):
+                response_cache.invalidate(user_id)
+        sharing.exclude(status=Document.STATUS_PROCESSING).update(
+            status=Document.STATUS_PENDING,
+            processed=False,
+            progress=0,
+            updated_at=timezone.now()
+        )
+        logger.info(f"Reset shared contents {content_ids} for reindexing")
+        return reset
+
+    def find_orphans(self) -> List[str]:
+        """Ids of chunks that no longer belong to a document.
+
+        A chunk is orphaned when its document is gone, or when its
+        document finished ingestion and the chunk is not tracked in
+        EmbeddingMetadata (left behind by an interrupted attempt). In the
+        shared corpus a chunk is orphaned when no Document references its
+        content any more.
+        """
+        if self.is_shared:
+            content_ids = set(DocumentContent.objects.filter(
+                documents__isnull=False
+            ).values_list('id', flat=True))
+            return [
+                chunk_id for chunk_id, _, metadata in self.backend.entries()
+                if (metadata or {}).get('doc_id') is None or int(metadata['doc_id']) not in content_ids
+            ]
+
+        doc_ids = set(Document.objects.filter(user_id=self.user_id).values_list('id', flat=True))
+        tracked = {}
+        for doc_id, chunk_id in EmbeddingMetadata.objects.filter(
+                user_id=self.user_id,
+                document__status__in=[Document.STATUS_COMPLETED, Document.STATUS_FAILED]
+        ).values_list('document_id', 'chunk_id').iterator():
+            tracked.setdefault(doc_id, set()).add(chunk_id)
+
+        orphans = []
+        for chunk_id, _, metadata in self.backend.entries():
+            doc_id = (metadata or {}).get('doc_id')
+            doc_id = int(doc_id) if doc_id is not None else None
+            if doc_id not in doc_ids or (doc_id in tracked and chunk_id not in tracked[doc_id]):
+                orphans.append(chunk_id)
+        return orphans
+
+    def prune_orphans(self) -> int:
+        """Delete orphaned chunks; returns the number removed"""
+        orphans = self.find_orphans()
+        for start in range(0, len(orphans), 500):
+            self.backend.delete(orphans[start:start + 500])
+            if self.lexical is not None:
+                self.lexical.delete(orphans[start:start + 500])
+        if orphans:
+            self._invalidate_responses()
+            logger.info(f"Pruned {len(orphans)} orphaned chunks from {self.namespace}")
+        return len(orphans)
+
+    def compact(self) -> int:
+        """Reclaim the space of deleted chunks"""
+        if self.lexical is not None:
+            self.lexical.merge()
+        return self.backend.compact()
+    
+    def rebuild_lexical_index(self) -> int:
+        """Rebuild the BM25 index from the chunks in the vector store"""
+        if self.lexical is None:
+            return 0
+        directory = self.lexical.directory
+        lexical_index_pool.evict(directory)
+        self.lexical.drop()
+        self.lexical = self._open_lexical()
+        
+        count = 0
+        batch = []
+        for entry in self.backend.entries():
+            batch.append(entry)
+            if len(batch) >= 1000:
+                count += self._index_lexical(batch)
+                batch = []
+        if batch:
+            count += self._index_lexical(batch)
+        self.lexical.merge()
+        return count
+    
+    def _index_lexical(self, entries) -> int:
+        self.lexical.add(
+            [chunk_id for chunk_id, _, _ in entries],
+            [document for _, document, _ in entries],
+            [(metadata or {}).get('doc_id') for _, _, metadata in entries]
+        )
+        return len(entries)
+    
     def delete_collection(self):
         """Delete user's collection"""
         try:
-            self.client.delete_collection(name=self.collection_name)
-            logger.info(f"Deleted collection for user {self.user_id}")
+            self.backend.drop()
+            if self.lexical is not None:
+                lexical_index_pool.evict(self.lexical.directory)
+                self.lexical.drop()
+            self._invalidate_responses()
+            logger.info(f"Deleted collection {self.namespace}")
         except Exception as e:
-            logger.error(f"Error deleting collection: {e}")
\ No newline at end of file
+            logger.error(f"Error deleting collection: {e}")
@@ -1,3 +1,1361 @@
-from django.test import TestCase
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import QuerySet
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.urls import reverse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from groq import RateLimitError
+from pathlib import Path
+from typing import List
+from unittest import mock
+import httpx
+import io
+import json
+import multiprocessing
+import numpy as np
+import socket
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
 
-# Create your tests here.
+from . import views
+from .benchmarks.fixtures import FakeCrossEncoder, FakeEmbeddingService, StubLLMService
+from .benchmarks.llm_stub import start_stub
+from .models import ChatMessage, Document, DocumentContent, EmbeddingMetadata
+from .services import bulk_ingestion, corpus, embedding_server, ingestion, uploads
+from .services.chunker import StreamingChunker
+from .services.embedding_cache import EmbeddingCache
+from .services.embedding_server import EmbeddingClient, EmbeddingServer, MicroBatcher
+from .services.embeddings import EmbeddingService
+from .services.ingestion import IngestionService
+from .services import local_index
+from .services.lexical_index import LexicalIndex
+from .services.llm_limits import FairQueue, LLMOverloaded, RateLimiter
+from .services.llm_service import LLMService
+from .services.local_index import LocalIndex
+from .services.onnx_encoder import FastTokenizer, OnnxEncoder, cosine_drift, parity_sentences
+from .services.prompt_builder import ESTIMATE, TokenCounter
+from .services.query_embeddings import QueryEmbeddingCache, normalize_query
+from .services.reranker import Reranker
+from .services.response_cache import ResponseCache
+from .services.vector_store import VectorStoreService
+
+
+def _words(count: int, prefix: str = 'w') -> str:
+    return ' '.join(f'{prefix}{i}' for i in range(count))
+
+
+class StreamingChunkerTests(SimpleTestCase):
+    def test_offsets_point_into_the_source_across_pieces(self):
+        source = _words(1200) + '. ' + _words(300, 'x')
+        # Uneven pieces split words in half
+        pieces = [(1, source[i:i + 97]) for i in range(0, len(source), 97)]
+        chunks = list(StreamingChunker(chunk_size=100, overlap=20).chunks(pieces))
+
+        self.assertGreater(len(chunks), 10)
+        for i, chunk in enumerate(chunks):
+            self.assertEqual(chunk.index, i)
+            self.assertEqual(source[chunk.start:chunk.end].split(), chunk.text.split())
+        self.assertEqual(chunks[0].start, 0)
+        self.assertEqual(chunks[-1].end, len(source))
+
+    def test_overlap_repeats_the_tail_of_the_previous_chunk(self):
+        chunks = list(StreamingChunker(chunk_size=100, overlap=20).chunks([(1, _words(1000))]))
+        for previous, chunk in zip(chunks, chunks[1:]):
+            self.assertEqual(previous.text.split()[-20:], chunk.text.split()[:20])
+        covered = set(word for chunk in chunks for word in chunk.text.split())
+        self.assertEqual(covered, set(_words(1000).split()))
+
+    def test_page_spans_follow_words_across_piece_boundaries(self):
+        # 'spl' + 'it' is one word that began on page 1
+        pieces = [(1, 'one two spl'), (2, 'it three four'), (3, ' five six')]
+        chunks = list(StreamingChunker(chunk_size=4, overlap=1).chunks(pieces))
+
+        self.assertEqual([chunk.text for chunk in chunks], ['one two split three', 'three four five six'])
+        self.assertEqual([(chunk.page_start, chunk.page_end) for chunk in chunks], [(1, 2), (2, 3)])
+        self.assertEqual(''.join(text for _, text in pieces)[chunks[0].start:chunks[0].end],
+                         'one two split three')
+
+    def test_chunks_stay_within_max_tokens(self):
+        text = ' '.join('x' * (i % 13 + 1) for i in range(3000))
+        chunker = StreamingChunker(chunk_size=500, overlap=50, max_tokens=128,
+                                   token_counter=lambda word: len(word) // 3 + 1)
+        chunks = list(chunker.chunks([(1, text)]))
+
+        self.assertTrue(chunks)
+        for chunk in chunks:
+            self.assertLessEqual(chunk.token_count, 128)
+            self.assertEqual(chunk.token_count, sum(len(w) // 3 + 1 for w in chunk.text.split()))
+
+    def test_token_limited_chunks_advance_by_half_their_length(self):
+        # Production defaults on token-dense text: about 51 words fit in a
+        # chunk, fewer than the 50-word overlap would need to make progress
+        chunker = StreamingChunker(chunk_size=500, overlap=50, max_tokens=256,
+                                   token_counter=lambda word: 5)
+        chunks = list(chunker.chunks([(1, _words(2000))]))
+
+        self.assertLess(len(chunks), 2000 // 25 + 2)
+        for previous, chunk in zip(chunks, chunks[1:]):
+            length = len(previous.text.split())
+            first = int(previous.text.split()[0][1:])
+            self.assertGreaterEqual(int(chunk.text.split()[0][1:]) - first, length - length // 2)
+        self.assertEqual(chunks[-1].text.split()[-1], 'w1999')
+
+    def test_default_limit_leaves_room_for_special_tokens(self):
+        from tokenizers import Tokenizer, models, pre_tokenizers, processors
+        backend = Tokenizer(models.WordLevel({'[UNK]': 0, '[CLS]': 1, '[SEP]': 2}, unk_token='[UNK]'))
+        backend.pre_tokenizer = pre_tokenizers.Whitespace()
+        backend.post_processor = processors.TemplateProcessing(
+            single='[CLS] $A [SEP]', special_tokens=[('[CLS]', 1), ('[SEP]', 2)]
+        )
+        tokenizer = FastTokenizer(backend)
+        service = mock.Mock(max_seq_length=16, tokenizer=tokenizer,
+                            count_tokens=lambda text: len(tokenizer.tokenize(text)))
+        service.max_chunk_tokens = EmbeddingService.max_chunk_tokens.fget(service)
+        self.assertEqual(service.max_chunk_tokens, 14)
+
+        with override_settings(CHUNK_MAX_TOKENS=0):
+            chunker = IngestionService.build_chunker(service)
+        chunks = list(chunker.chunks([(1, _words(200))]))
+        # Embedded with [CLS] and [SEP], a full chunk still fits the model untruncated
+        self.assertEqual(max(len(backend.encode(chunk.text).ids) for chunk in chunks), 16)
+
+    def test_time_and_memory_scale_with_the_stream_not_the_document(self):
+        block = 'lorem ipsum dolor sit amet. ' * 5000
+
+        def chunk_count(blocks):
+            pieces = ((page, block) for page in range(1, blocks + 1))
+            return sum(1 for _ in StreamingChunker(chunk_size=500, overlap=50).chunks(pieces))
+
+        def timed(blocks):
+            start = time.perf_counter()
+            count = chunk_count(blocks)
+            return count, time.perf_counter() - start
+
+        def peak_memory(blocks):
+            tracemalloc.start()
+            try:
+                chunk_count(blocks)
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        small_count, small_seconds = timed(4)
+        large_count, large_seconds = timed(16)
+        self.assertAlmostEqual(large_count / small_count, 4, delta=0.1)
+        # Linear, with room for a noisy machine
+        self.assertLess(large_seconds, small_seconds * 8)
+        # Memory is bounded by a piece and a chunk, not by the whole input
+        self.assertLess(peak_memory(8), peak_memory(2) * 1.5)
+
+
+class EmbeddingCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # No in-memory LRU, so every lookup reads the table
+        self.cache = EmbeddingCache(f'{directory.name}/cache.sqlite3', 'test-model', lru_size=0,
+                                    max_entries=1000)
+
+    def put(self, texts):
+        self.cache.put_many(texts, np.ones((len(texts), 4), dtype=np.float32))
+
+    def test_evicts_least_recently_used_beyond_max_entries(self):
+        self.put([f'old {i}' for i in range(1000)])
+        self.assertIsNotNone(self.cache.get_many(['old 0'])[0])
+        self.put([f'new {i}' for i in range(500)])
+
+        self.assertEqual(self.cache.evict(), 500)
+        self.assertIsNotNone(self.cache.get_many(['old 0'])[0])
+        new = self.cache.get_many([f'new {i}' for i in range(500)])
+        old = self.cache.get_many([f'old {i}' for i in range(1000)])
+        self.assertTrue(all(vector is not None for vector in new))
+        self.assertEqual(sum(vector is None for vector in old), 500)
+
+    def test_memory_entries_do_not_hold_on_to_the_encoded_batch(self):
+        cache = EmbeddingCache(self.cache.path, 'test-model', lru_size=10)
+        batch = np.ones((8, 4), dtype=np.float32)
+        cache.put_many([f'text {i}' for i in range(8)], batch)
+        vector = cache.memory.get(cache.key('text 3'))
+        self.assertIsNone(vector.base)
+        self.assertEqual(vector.nbytes, 16)
+
+    def test_stores_trim_the_table_as_they_go(self):
+        for start in range(0, 3000, 250):
+            self.put([f'text {i}' for i in range(start, start + 250)])
+        count = self.cache._connection().execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+        self.assertLessEqual(count, 1000)
+
+
+class LocalIndexRefreshTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.rng = np.random.default_rng(0)
+        # Two instances on one directory stand in for two processes
+        self.writer = LocalIndex(directory.name, ann_threshold=1000)
+        for doc_id in range(6):
+            self.add(doc_id, 500)
+        self.reader = LocalIndex(directory.name, ann_threshold=1000)
+        self.reader.count()
+        self.directory = directory.name
+
+    def add(self, doc_id: int, count: int):
+        self.writer.add(
+            [f'{doc_id}-{self.rng.integers(1 << 62)}' for _ in range(count)], ['text'] * count,
+            self.rng.standard_normal((count, 16)).astype(np.float32), [{'doc_id': doc_id}] * count
+        )
+
+    def assert_matches_fresh_reader(self):
+        fresh = LocalIndex(self.directory, ann_threshold=1000)
+        self.assertEqual(self.reader.count(), fresh.count())
+        np.testing.assert_array_equal(self.reader._live, fresh._live)
+        np.testing.assert_array_equal(self.reader._doc_ids, fresh._doc_ids)
+        np.testing.assert_array_equal(self.reader._ivf[1], fresh._ivf[1])
+        np.testing.assert_array_equal(self.reader._ivf[2], fresh._ivf[2])
+
+    def test_deletions_do_not_reload_the_ivf_lists(self):
+        self.assertIsNotNone(self.reader._ivf)
+        self.writer.delete_documents([2])
+        with mock.patch.object(local_index.np, 'load', wraps=np.load) as load, \
+                mock.patch.object(local_index, '_nearest_centroids', wraps=local_index._nearest_centroids) as assign:
+            self.assertEqual(self.reader.count(), 2500)
+        load.assert_not_called()
+        assign.assert_not_called()
+        self.assert_matches_fresh_reader()
+
+    def test_new_rows_are_assigned_without_reassigning_old_ones(self):
+        self.add(6, 40)
+        with mock.patch.object(local_index, '_nearest_centroids', wraps=local_index._nearest_centroids) as assign:
+            self.assertEqual(self.reader.count(), 3040)
+        self.assertEqual(assign.call_count, 1)
+        self.assertEqual(len(assign.call_args[0][0]), 40)
+        self.assert_matches_fresh_reader()
+
+    def test_search_sees_rows_added_and_deleted_by_another_writer(self):
+        self.add(7, 10)
+        self.writer.delete_documents([0, 7])
+        self.writer.delete_documents([1])
+        self.assert_matches_fresh_reader()
+        result = self.reader.search(self.rng.standard_normal(16).astype(np.float32), n_results=50)
+        self.assertTrue(all(meta['doc_id'] not in (0, 1, 7) for meta in result['metadatas'][0]))
+
+    def test_search_interrupted_by_a_compaction_returns_the_rows_it_scored(self):
+        # Row 2500 is the first chunk of document 5; compaction moves it to row 2000
+        target = self.writer._conn().execute('SELECT id FROM chunks WHERE row = 2500').fetchone()[0]
+        query = self.reader._matrix[2500].copy()
+        dot = local_index._dot
+        compacted = []
+
+        def compacted_meanwhile(*args, **kwargs):
+            if not compacted:
+                compacted.append(True)
+                self.writer.delete_documents([0])
+                self.writer.compact()
+            return dot(*args, **kwargs)
+
+        with mock.patch.object(local_index, '_dot', side_effect=compacted_meanwhile) as scored:
+            result = self.reader.search(query, n_results=1)
+        self.assertEqual(scored.call_count, 2)
+        self.assertEqual(result['ids'][0], [target])
+        self.assertAlmostEqual(result['distances'][0][0], 0.0, places=3)
+
+    def test_compaction_starts_a_new_epoch(self):
+        self.writer.delete_documents([4, 5])
+        self.writer.compact()
+        self.add(8, 5)
+        self.assertEqual(self.reader.count(), 2005)
+        self.assert_matches_fresh_reader()
+
+
+class FailingLLMService(StubLLMService):
+    def complete(self, prompt, user_id=None):
+        raise RuntimeError('provider returned garbage')
+
+    async def stream_response(self, prompt, user_id=None):
+        yield 'partial'
+        raise RuntimeError('provider returned garbage')
+
+
+@override_settings(RESPONSE_CACHE_ENABLED=False)
+class LocalIndexStorageTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        rng = np.random.default_rng(0)
+        self.vectors = rng.standard_normal((2000, 64)).astype(np.float32)
+        # Near, but not on, stored vectors
+        self.queries = (self.vectors[rng.choice(2000, 20, replace=False)]
+                        + 0.5 * rng.standard_normal((20, 64)).astype(np.float32))
+        self.exact = self.build('exact')
+
+    def build(self, name: str, **options) -> LocalIndex:
+        # Brute force throughout, so only the storage mode differs
+        index = LocalIndex(self.directory / name, ann_threshold=10 ** 6, **options)
+        index.add([str(i) for i in range(2000)], ['text'] * 2000, self.vectors,
+                  [{'doc_id': i % 5} for i in range(2000)])
+        return index
+
+    def recall(self, index: LocalIndex, k: int = 10, doc_ids: List[int] = None) -> float:
+        found = 0
+        for query in self.queries:
+            expected = set(self.exact.search(query, k, doc_ids)['ids'][0])
+            found += len(expected & set(index.search(query, k, doc_ids)['ids'][0]))
+        return found / (k * len(self.queries))
+
+    def test_recall_of_compact_storage_against_exact_float32(self):
+        self.assertGreaterEqual(self.recall(self.build('f16', storage='float16')), 0.99)
+        self.assertGreaterEqual(self.recall(self.build('i8', storage='int8')), 0.95)
+        reranked = self.build('i8-rerank', storage='int8', rerank=4)
+        self.assertGreaterEqual(self.recall(reranked), 0.99)
+        # Re-scored against the float32 rows, distances are exact
+        expected, result = self.exact.search(self.queries[0], 5), reranked.search(self.queries[0], 5)
+        self.assertEqual(result['ids'], expected['ids'])
+        np.testing.assert_allclose(result['distances'][0], expected['distances'][0], rtol=1e-4)
+
+    def test_compact_converts_storage_and_back(self):
+        self.build('converted').delete_documents([0])
+        live = np.array([i % 5 != 0 for i in range(2000)])
+
+        converted = LocalIndex(self.directory / 'converted', ann_threshold=10 ** 6, storage='int8', rerank=4)
+        self.assertEqual(converted.compact(), 400)
+        self.assertTrue((self.directory / 'converted' / 'vectors.i8').exists())
+        self.assertTrue((self.directory / 'converted' / 'scales.f32').exists())
+        self.assertEqual(converted.count(), 1600)
+        self.assertEqual(converted._matrix.dtype, np.int8)
+        self.assertGreaterEqual(self.recall(converted, doc_ids=[1, 2, 3, 4]), 0.99)
+
+        # The float32 originals were kept, so converting back is lossless
+        restored = LocalIndex(self.directory / 'converted', ann_threshold=10 ** 6)
+        self.assertEqual(restored.compact(), 0)
+        self.assertFalse((self.directory / 'converted' / 'vectors.i8').exists())
+        self.assertFalse((self.directory / 'converted' / 'scales.f32').exists())
+        restored.count()
+        np.testing.assert_array_equal(np.asarray(restored._matrix), self.vectors[live])
+        ids = [chunk_id for chunk_id, _, _ in restored.entries()]
+        self.assertEqual(ids, [str(i) for i in range(2000) if live[i]])
+
+
+class RerankerTests(SimpleTestCase):
+    def setUp(self):
+        self.reranker = Reranker('stub-model')
+        self.model = mock.Mock(wraps=FakeCrossEncoder())
+        self.reranker._model = self.model
+        self.addCleanup(lambda: self.reranker._executor and self.reranker._executor.shutdown(wait=True))
+        texts = ['travel budget', 'expense report approval', 'network server', 'travel expense report']
+        self.results = {
+            'ids': [[f'c{i}' for i in range(len(texts))]],
+            'documents': [texts],
+            'metadatas': [[{'doc_id': 1}] * len(texts)],
+            'distances': [[0.1, 0.2, 0.3, 0.4]],
+        }
+
+    def test_best_chunks_first_and_cached_scores_skip_the_model(self):
+        first = self.reranker.rerank('Travel expense report?', self.results, 2, budget=5)
+        self.assertEqual(first['ids'], [['c3', 'c1']])
+        self.assertEqual(self.model.predict.call_count, 1)
+
+        # Same question in another form: every score comes from the cache
+        again = self.reranker.rerank('travel expense report', self.results, 2, budget=5)
+        self.assertEqual(again, first)
+        self.assertEqual(self.model.predict.call_count, 1)
+
+        # Only the new chunk is scored
+        grown = {key: [values[0] + [values[0][0]]] for key, values in self.results.items()}
+        grown['ids'] = [self.results['ids'][0] + ['c4']]
+        self.reranker.rerank('travel expense report', grown, 2, budget=5)
+        self.assertEqual(len(self.model.predict.call_args[0][0]), 1)
+
+    def test_over_budget_keeps_retrieval_order_and_fills_the_cache(self):
+        release = threading.Event()
+        slow = FakeCrossEncoder()
+
+        def predict(pairs, **kwargs):
+            release.wait(5)
+            return slow.predict(pairs, **kwargs)
+
+        self.model.predict.side_effect = predict
+        result = self.reranker.rerank('travel expense report', self.results, 2, budget=0.05)
+        self.assertEqual(result['ids'], [['c0', 'c1']])
+        self.assertEqual(result['distances'], [[0.1, 0.2]])
+
+        release.set()
+        self.reranker._executor.shutdown(wait=True)
+        self.assertIsNotNone(self.reranker.scores.get(('travel expense report', 'c3')))
+
+    def test_scoring_errors_keep_retrieval_order(self):
+        self.model.predict.side_effect = RuntimeError('out of memory')
+        result = self.reranker.rerank('travel expense report', self.results, 3, budget=5)
+        self.assertEqual(result['ids'], [['c0', 'c1', 'c2']])
+        self.assertEqual(len(self.reranker.scores), 0)
+
+
+class FailedChatTurnTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        self.client.force_login(self.user)
+        patches = [
+            mock.patch.object(views, 'retrieve_context',
+                              return_value=(np.ones(4, dtype=np.float32), ['some context'], ['c1'], [0.1])),
+            mock.patch.object(views, '_llm_service', FailingLLMService()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_failed_turn_is_not_saved(self):
+        response = self.client.post(reverse('chatbot:send_message'), {'message': 'hello?'})
+        self.assertEqual(response.status_code, 502)
+        self.assertIn('error', response.json())
+        self.assertFalse(ChatMessage.objects.exists())
+
+    async def test_failed_stream_is_not_saved(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.post(reverse('chatbot:stream_message'), {'message': 'hello?'})
+        body = ''.join([part.decode() async for part in response.streaming_content])
+        self.assertIn('event: error', body)
+        self.assertFalse(await ChatMessage.objects.aexists())
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = ResponseCache(f'{directory.name}/responses.sqlite3', similarity=0.95)
+        self.embedding = np.array([1.0, 0.0, 0.0, 0.0], dtype=np.float32)
+
+    def test_hit_needs_the_same_chunks_and_history(self):
+        first = [{'role': 'user', 'content': 'Which plans are there?'},
+                 {'role': 'assistant', 'content': 'Basic and Pro.'}]
+        other = [{'role': 'user', 'content': 'Which regions are there?'},
+                 {'role': 'assistant', 'content': 'EU and US.'}]
+        self.cache.put(1, self.embedding, ['a', 'b'], 'model', 'Pro costs more.', first)
+
+        nearby = np.array([0.99, 0.05, 0.0, 0.0], dtype=np.float32)
+        self.assertEqual(self.cache.get(1, nearby, ['b', 'a'], 'model', first), 'Pro costs more.')
+        # The same follow-up in another conversation
+        self.assertIsNone(self.cache.get(1, nearby, ['a', 'b'], 'model', other))
+        self.assertIsNone(self.cache.get(1, nearby, ['a', 'b'], 'model'))
+        self.assertIsNone(self.cache.get(1, nearby, ['a'], 'model', first))
+        self.assertIsNone(self.cache.get(2, nearby, ['a', 'b'], 'model', first))
+
+
+class CachedChatTurnTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.user = User.objects.create_user('alice', password='secret')
+        self.client.force_login(self.user)
+        cache = ResponseCache(f'{directory.name}/responses.sqlite3')
+        patches = [
+            mock.patch.object(views, 'retrieve_context',
+                              return_value=(np.ones(4, dtype=np.float32), ['some context'], ['c1'], [0.1])),
+            mock.patch.object(views, '_llm_service', StubLLMService()),
+            mock.patch.object(views, 'get_response_cache', return_value=cache),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def ask(self, message: str) -> dict:
+        response = self.client.post(reverse('chatbot:send_message'), {'message': message})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_follow_up_with_other_history_is_not_served_from_cache(self):
+        self.assertFalse(self.ask('and what about the second one?')['cached'])
+        # Same question and chunks, but now the first turn is history
+        self.assertFalse(self.ask('and what about the second one?')['cached'])
+
+    @override_settings(CHAT_HISTORY_TURNS=0)
+    def test_repeated_question_without_history_is_served_from_cache(self):
+        answer = self.ask('what is the refund policy?')
+        self.assertFalse(answer['cached'])
+        repeat = self.ask('what is the refund policy?')
+        self.assertTrue(repeat['cached'])
+        self.assertEqual(repeat['response'], answer['response'])
+
+
+class RecordingLLMService(StubLLMService):
+    def __init__(self):
+        super().__init__()
+        self.histories = []
+
+    def build_prompt(self, query, context, chat_history=None, scores=None):
+        self.histories.append(chat_history)
+        return super().build_prompt(query, context, chat_history, scores)
+
+
+class ChatHistoryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        self.client.force_login(self.user)
+        self.start = timezone.now() - timedelta(days=1)
+
+    def add(self, count: int, same_timestamp: bool = False) -> List[int]:
+        ids = []
+        for i in range(count):
+            msg = ChatMessage.objects.create(user=self.user, message=f'q{i}', response=f'a{i}')
+            timestamp = self.start if same_timestamp else self.start + timedelta(minutes=i)
+            ChatMessage.objects.filter(pk=msg.pk).update(timestamp=timestamp)
+            ids.append(msg.pk)
+        return ids
+
+    def test_prompt_history_is_the_latest_turns_in_order(self):
+        self.add(8)
+        llm = RecordingLLMService()
+        with mock.patch.object(views, 'retrieve_context',
+                               return_value=(np.ones(4, dtype=np.float32), ['some context'], ['c1'], [0.1])), \
+                mock.patch.object(views, '_llm_service', llm), \
+                override_settings(CHAT_HISTORY_TURNS=5, RESPONSE_CACHE_ENABLED=False):
+            response = self.client.post(reverse('chatbot:send_message'), {'message': 'next?'})
+        self.assertEqual(response.status_code, 200)
+        history = llm.histories[0]
+        self.assertEqual([turn['content'] for turn in history if turn['role'] == 'user'],
+                         ['q3', 'q4', 'q5', 'q6', 'q7'])
+
+    def test_cursor_round_trips(self):
+        msg = ChatMessage.objects.get(pk=self.add(1)[0])
+        self.assertEqual(views.decode_cursor(views.encode_cursor(msg)), (msg.timestamp, msg.pk))
+
+    @override_settings(CHAT_PAGE_SIZE=3)
+    def test_pages_cover_every_message_once_across_equal_timestamps(self):
+        self.add(7, same_timestamp=True)
+        page, cursor = views.chat_page(self.user)
+        seen = [msg.message for msg in page]
+        self.assertEqual(seen, ['q4', 'q5', 'q6'])
+        while cursor is not None:
+            response = self.client.get(reverse('chatbot:chat_history'), {'before': cursor})
+            self.assertEqual(response.status_code, 200)
+            body = response.json()
+            seen = [m['message'] for m in body['messages']] + seen
+            cursor = body['next_cursor']
+        self.assertEqual(seen, [f'q{i}' for i in range(7)])
+
+    def test_messages_before_a_cursor_break_ties_by_id(self):
+        ids = self.add(4, same_timestamp=True)
+        older = views.chat_messages_before(self.user, (self.start, ids[2]))
+        self.assertEqual([msg.pk for msg in older], [ids[1], ids[0]])
+
+    def test_invalid_cursor_is_rejected(self):
+        for params in ({}, {'before': 'garbage'}, {'before': 'yesterday,3'},
+                       {'before': f'{self.start.isoformat()},three'}):
+            response = self.client.get(reverse('chatbot:chat_history'), params)
+            self.assertEqual(response.status_code, 400, params)
+
+
+class QueryEmbeddingCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / 'queries.npz'
+
+    def test_normalize_query(self):
+        self.assertEqual(normalize_query('  Summarize   the\tPOLICY?! '), 'summarize the policy')
+        # NFKC folds the full-width form
+        self.assertEqual(normalize_query('ＳＵＭＭＡＲＩＺＥ.'), 'summarize')
+        self.assertEqual(normalize_query(' ?! '), '')
+
+    def test_loads_a_precomputed_table_for_its_model(self):
+        vectors = np.eye(2, 4, dtype=np.float32)
+        QueryEmbeddingCache.save(self.path, ['summarize', 'list the risks'], vectors, 'model-a')
+
+        cache = QueryEmbeddingCache()
+        self.assertEqual(cache.load(self.path, 'model-a'), 2)
+        np.testing.assert_array_equal(cache.get('list the risks'), vectors[1])
+        self.assertIsNone(cache.get('something else'))
+        stats = cache.stats()
+        self.assertEqual((stats['precomputed_entries'], stats['precomputed_hits'], stats['misses']), (2, 1, 1))
+
+    def test_ignores_a_table_from_another_model_or_a_missing_file(self):
+        QueryEmbeddingCache.save(self.path, ['summarize'], np.ones((1, 4), dtype=np.float32), 'model-a')
+        cache = QueryEmbeddingCache()
+        self.assertEqual(cache.load(self.path, 'model-b'), 0)
+        self.assertEqual(cache.load(self.path.with_name('missing.npz'), 'model-a'), 0)
+        self.assertIsNone(cache.get('summarize'))
+
+    def test_memory_is_bounded_lru(self):
+        cache = QueryEmbeddingCache(max_size=2)
+        for i, query in enumerate(['a', 'b']):
+            cache.put(query, np.full(4, i, dtype=np.float32))
+        cache.get('a')
+        cache.put('c', np.full(4, 2, dtype=np.float32))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache.stats()['memory_entries'], 2)
+
+
+class PrecomputeQueriesTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        self.user = User.objects.create_user('alice', password='secret')
+        service = FakeEmbeddingService(dimension=8)
+        service.model_id = 'fake-model'
+        patch = mock.patch('chatbot.management.commands.precompute_queries.EmbeddingService', return_value=service)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_embeds_listed_and_frequent_queries_once(self):
+        listed = self.directory / 'queries.txt'
+        listed.write_text('Summarize the policy?\nsummarize   the policy\n\nList the risks\n', encoding='utf-8')
+        for message in ['What is the budget?', 'what is the budget', 'Asked once', 'List the risks!']:
+            ChatMessage.objects.create(user=self.user, message=message, response='...')
+        output = self.directory / 'table.npz'
+
+        call_command('precompute_queries', file=[str(listed)], top=10, output=str(output), stdout=io.StringIO())
+        cache = QueryEmbeddingCache()
+        self.assertEqual(cache.load(output, 'fake-model'), 3)
+        self.assertEqual(sorted(cache.precomputed), ['list the risks', 'summarize the policy', 'what is the budget'])
+
+    def test_no_queries_is_an_error(self):
+        with self.assertRaises(CommandError):
+            call_command('precompute_queries', output=str(self.directory / 'table.npz'))
+
+
+@override_settings(METRICS_ENABLED=True)
+class MetricsAccessTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        self.staff = User.objects.create_user('admin', password='secret', is_staff=True)
+
+    @override_settings(METRICS_TOKEN='')
+    def test_without_a_token_only_staff_can_scrape(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_with_a_token_scrapes_must_send_it(self):
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 401)
+        response = self.client.get(reverse('metrics'), headers={'Authorization': 'Bearer s3cret'})
+        self.assertEqual(response.status_code, 200)
+
+
+class TokenCounterTests(SimpleTestCase):
+    def tokenizer(self):
+        from tokenizers import Tokenizer, models, pre_tokenizers
+        tokenizer = Tokenizer(models.WordPiece({'[UNK]': 0, 'token': 1, '##s': 2}, unk_token='[UNK]'))
+        tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+        return FastTokenizer(tokenizer)
+
+    def test_defaults_to_the_embedding_model_tokenizer(self):
+        with mock.patch('chatbot.services.embeddings.EmbeddingService') as service:
+            service.return_value.tokenizer = self.tokenizer()
+            self.assertEqual(TokenCounter('').count('tokens token'), 3)
+
+    def test_loads_a_tokenizer_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.tokenizer().backend_tokenizer.save(f'{directory}/tokenizer.json')
+            self.assertEqual(TokenCounter(f'{directory}/tokenizer.json').count('tokens token'), 3)
+
+    def test_estimate_does_not_undercount_non_latin_text(self):
+        counter = TokenCounter(ESTIMATE)
+        self.assertEqual(counter.count('a' * 40), 10)
+        # Three UTF-8 bytes per character, and usually at least a token each
+        self.assertGreaterEqual(counter.count('検索拡張生成の説明'), 9)
+
+
+class LexicalIndexRefreshTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.writer = LexicalIndex(self.directory, max_segments=4)
+        self.reader = LexicalIndex(self.directory, max_segments=4)
+        self.added = 0
+        for doc_id in range(3):
+            self.add(doc_id, 20)
+        self.reader.count()
+
+    def add(self, doc_id: int, count: int):
+        ids = [f'{doc_id}-{self.added + i}' for i in range(count)]
+        texts = [f'error code ERR-{i % 7} in module {doc_id} ' + 'word ' * (i % 5) for i in range(count)]
+        self.writer.add(ids, texts, [doc_id] * count)
+        self.added += count
+
+    def assert_matches_fresh_reader(self):
+        fresh = LexicalIndex(self.directory)
+        self.assertEqual(self.reader.count(), fresh.count())
+        np.testing.assert_array_equal(self.reader._live, fresh._live)
+        np.testing.assert_array_equal(self.reader._lengths[self.reader._live], fresh._lengths[fresh._live])
+        np.testing.assert_array_equal(self.reader._doc_ids[self.reader._live], fresh._doc_ids[fresh._live])
+        self.assertEqual(self.reader.search('ERR-3 module'), fresh.search('ERR-3 module'))
+
+    def test_reads_only_new_chunks_and_deletions(self):
+        self.add(3, 10)
+        self.writer.delete_documents([1])
+        self.assertEqual(self.reader.count(), 50)
+        self.assert_matches_fresh_reader()
+        self.assertTrue(all(not chunk_id.startswith('1-') for chunk_id, _ in self.reader.search('module', 100)))
+
+    def test_merge_purging_unseen_deletions_reloads(self):
+        self.writer.delete_documents([0])
+        self.writer.merge()
+        self.add(4, 5)
+        self.assertEqual(self.reader.count(), 45)
+        self.assert_matches_fresh_reader()
+
+
+@override_settings(SHARED_CORPUS_ENABLED=True)
+class ContentReleaseTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        self.vector_store = mock.Mock()
+        patches = [
+            mock.patch.object(corpus.VectorStoreService, 'shared', return_value=self.vector_store),
+            mock.patch.object(bulk_ingestion, 'VectorStoreService', mock.Mock()),
+            mock.patch.object(bulk_ingestion, 'EmbeddingService', mock.Mock()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_referenced_content_is_kept(self):
+        content = corpus.content_for_hash('a' * 64)
+        Document.objects.create(user=self.user, filename='a.txt', file='uploads/a.txt', file_size=1,
+                                content_hash=content.content_hash, content=content)
+        self.assertFalse(corpus.release_content(content.id))
+        self.assertTrue(DocumentContent.objects.filter(id=content.id).exists())
+        self.vector_store.delete_document.assert_not_called()
+
+    def test_unreferenced_content_is_dropped_with_its_chunks(self):
+        content = corpus.content_for_hash('a' * 64)
+        self.assertTrue(corpus.release_content(content.id))
+        self.assertFalse(DocumentContent.objects.filter(id=content.id).exists())
+        self.vector_store.delete_document.assert_called_once_with(content.id)
+
+    def test_bulk_ingestion_moves_files_off_a_released_content(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = f'{directory.name}/a.txt'
+        with open(path, 'w') as f:
+            f.write('some text')
+        ingestion = bulk_ingestion.BulkIngestion(self.user)
+        ingestion._accept({'path': path, 'content_hash': 'a' * 64, 'size': 9, 'pages': 1, 'seconds': 0.0,
+                           'chunks': [('some text', {})]}, {})
+        released = ingestion._unopened[0].content
+        # A user deletes their last document of it before this run opens its own
+        self.assertTrue(corpus.release_content(released.id))
+
+        with override_settings(MEDIA_ROOT=directory.name):
+            ingestion._open_documents()
+        doc = Document.objects.get()
+        self.assertNotEqual(doc.content_id, released.id)
+        self.assertEqual(doc.content.status, DocumentContent.STATUS_PROCESSING)
+        self.assertEqual(doc.status, Document.STATUS_PROCESSING)
+        self.assertEqual(len(ingestion._chunks), 1)
+
+
+def inline_pool(max_workers, mp_context, initializer, initargs):
+    """ProcessPoolExecutor stand-in: threads share the module, so its worker state is set once here"""
+    with mock.patch.object(bulk_ingestion.signal, 'signal'):
+        initializer(*initargs)
+    return ThreadPoolExecutor(max_workers)
+
+
+class BulkIngestionCheckpointTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        settings_override = override_settings(
+            VECTOR_STORE_BACKEND='local', SHARED_CORPUS_ENABLED=False, MEDIA_ROOT=f'{directory.name}/media',
+            LOCAL_INDEX_DIRECTORY=f'{directory.name}/local', LEXICAL_INDEX_DIRECTORY=f'{directory.name}/lexical',
+            CHUNK_SIZE=4, CHUNK_OVERLAP=1, CHUNK_MAX_TOKENS=0, INGESTION_STALE_SECONDS=60
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.embedding_service = FakeEmbeddingService(dimension=8)
+        self.embedding_service.tokenizer = None
+        patches = [
+            mock.patch.object(bulk_ingestion, 'EmbeddingService', return_value=self.embedding_service),
+            mock.patch.object(bulk_ingestion, 'ProcessPoolExecutor', inline_pool),
+            # Restored after the run sets them
+            mock.patch.object(bulk_ingestion, '_bulk_chunker', None),
+            mock.patch.object(bulk_ingestion, '_bulk_skip_hashes', frozenset()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def write(self, name: str, words: int = 12) -> Path:
+        path = self.directory / name
+        path.write_text(_words(words, name[0]), encoding='utf-8')
+        return path
+
+    def run_bulk(self, paths, batch_size: int = 1024) -> dict:
+        return bulk_ingestion.BulkIngestion(self.user, workers=1, batch_size=batch_size).run(paths)
+
+    def chunk_doc_ids(self) -> List[int]:
+        store = VectorStoreService(self.user.id)
+        return sorted(int(metadata['doc_id']) for _, _, metadata in store.backend.entries())
+
+    def test_checkpoint_skips_finished_and_queued_hashes_and_takes_over_the_rest(self):
+        old = timezone.now() - timedelta(seconds=120)
+
+        def document(content_hash, status, updated_at=None):
+            doc = Document.objects.create(user=self.user, filename=f'{content_hash[0]}.txt', file='uploads/x.txt',
+                                          file_size=1, content_hash=content_hash, status=status)
+            if updated_at is not None:
+                Document.objects.filter(id=doc.id).update(updated_at=updated_at)
+            return doc
+
+        document('a' * 64, Document.STATUS_COMPLETED)
+        document('a' * 64, Document.STATUS_FAILED)
+        document('b' * 64, Document.STATUS_PENDING)
+        failed = document('c' * 64, Document.STATUS_FAILED)
+        document('d' * 64, Document.STATUS_PROCESSING)
+        stale = document('e' * 64, Document.STATUS_PROCESSING, updated_at=old)
+
+        skip, takeover = bulk_ingestion.BulkIngestion(self.user)._checkpoint()
+        self.assertEqual(skip, {'a' * 64, 'b' * 64, 'd' * 64})
+        self.assertEqual({content_hash: doc.id for content_hash, doc in takeover.items()},
+                         {'c' * 64: failed.id, 'e' * 64: stale.id})
+
+    def test_rerun_skips_completed_files_and_takes_over_failed_ones(self):
+        first, second = self.write('a.txt'), self.write('b.txt')
+        self.assertEqual(self.run_bulk([first, second])['documents'], 2)
+        redo = Document.objects.get(filename='b.txt')
+        # Failed after some of its chunks were stored
+        Document.objects.filter(id=redo.id).update(status=Document.STATUS_FAILED, processed=False)
+
+        report = self.run_bulk([first, second, self.write('c.txt')])
+        self.assertEqual((report['skipped'], report['documents']), (1, 2))
+        self.assertEqual(Document.objects.count(), 3)
+        redo.refresh_from_db()
+        self.assertEqual((redo.status, redo.attempts), (Document.STATUS_COMPLETED, 2))
+        # The first attempt's chunks were replaced, not added to
+        self.assertEqual(self.chunk_doc_ids().count(redo.id), redo.chunk_count)
+        self.assertEqual(EmbeddingMetadata.objects.filter(document=redo).count(), redo.chunk_count)
+
+    def test_interrupted_run_fails_documents_in_flight_and_drops_their_chunks(self):
+        done, interrupted = self.write('a.txt', 6), self.write('b.txt', 60)
+        embed = self.embedding_service.generate_embeddings
+        calls = []
+
+        def generate_embeddings(texts):
+            calls.append(len(texts))
+            if len(calls) == 3:
+                raise KeyboardInterrupt
+            return embed(texts)
+
+        with mock.patch.object(self.embedding_service, 'generate_embeddings', generate_embeddings), \
+                self.assertRaises(KeyboardInterrupt):
+            self.run_bulk([done, interrupted], batch_size=4)
+
+        completed, failed = Document.objects.get(filename='a.txt'), Document.objects.get(filename='b.txt')
+        self.assertEqual(completed.status, Document.STATUS_COMPLETED)
+        self.assertEqual(failed.status, Document.STATUS_FAILED)
+        self.assertTrue(failed.error_message.startswith('Bulk ingestion interrupted: KeyboardInterrupt'))
+        self.assertEqual(self.chunk_doc_ids(), [completed.id] * completed.chunk_count)
+
+        self.assertEqual(self.run_bulk([done, interrupted])['documents'], 1)
+        failed.refresh_from_db()
+        self.assertEqual(failed.status, Document.STATUS_COMPLETED)
+        self.assertEqual(self.chunk_doc_ids().count(failed.id), failed.chunk_count)
+
+
+class OnnxDriftTests(SimpleTestCase):
+    """The exported ONNX models against the PyTorch one; run after manage.py export_onnx"""
+
+    def setUp(self):
+        self.directory = Path(settings.EMBEDDING_ONNX_DIRECTORY) / settings.EMBEDDING_MODEL
+        if not (self.directory / 'model.onnx').exists():
+            self.skipTest(f'No ONNX export at {self.directory}')
+        try:
+            from sentence_transformers import SentenceTransformer
+            model = SentenceTransformer(settings.EMBEDDING_MODEL, device='cpu')
+        except Exception as e:
+            self.skipTest(f'PyTorch model unavailable: {e}')
+        self.sentences = parity_sentences(50)
+        self.reference = model.encode(self.sentences, convert_to_numpy=True, show_progress_bar=False)
+
+    def test_float_export_matches_the_model(self):
+        encoder = OnnxEncoder(self.directory)
+        self.assertLess(cosine_drift(self.reference, encoder.encode(self.sentences)).max(), 1e-4)
+
+    def test_int8_export_stays_within_the_drift_limit(self):
+        encoder = OnnxEncoder(self.directory, quantized=True)
+        self.assertLess(cosine_drift(self.reference, encoder.encode(self.sentences)).max(), 0.01)
+
+
+class UploadSessionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.media_root = Path(directory.name)
+        settings_override = override_settings(MEDIA_ROOT=directory.name, SHARED_CORPUS_ENABLED=False)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_overlong_file_names_are_refused_up_front(self):
+        with self.assertRaises(uploads.UploadError):
+            uploads.open_session(self.user, 'a' * 252 + '.txt', 10)
+
+    def test_long_file_names_are_shortened_to_fit_the_file_column(self):
+        session = uploads.open_session(self.user, 'a' * 200 + '.txt', 5)
+        uploads.write_part(session, 0, io.BytesIO(b'hello'), 5)
+        name = Document.objects.get().file.name
+        self.assertLessEqual(len(name), Document._meta.get_field('file').max_length)
+        self.assertTrue(name.startswith('uploads/a') and name.endswith('.txt'))
+
+    def test_completing_never_replaces_a_file_stored_meanwhile(self):
+        (self.media_root / 'uploads').mkdir()
+        (self.media_root / 'uploads' / 'a.txt').write_bytes(b'other')
+        session = uploads.open_session(self.user, 'a.txt', 5)
+        available = uploads.default_storage.get_available_name
+        # The first name offered was free when checked, and taken before the move
+        with mock.patch.object(uploads.default_storage, 'get_available_name',
+                               side_effect=['uploads/a.txt', available('uploads/a.txt')]):
+            uploads.write_part(session, 0, io.BytesIO(b'hello'), 5)
+        self.assertEqual((self.media_root / 'uploads' / 'a.txt').read_bytes(), b'other')
+        doc = Document.objects.get()
+        self.assertNotEqual(doc.file.name, 'uploads/a.txt')
+        self.assertEqual((self.media_root / doc.file.name).read_bytes(), b'hello')
+        self.assertFalse(uploads.partial_path(session).exists())
+
+
+class FairQueueTests(SimpleTestCase):
+    def test_slots_go_round_robin_across_users(self):
+        queue = FairQueue(concurrency=1, max_waiting=10)
+        self.assertIsNone(queue._enqueue('holder', None))
+        granted = []
+        for user_id in ('heavy', 'heavy', 'heavy', 'light', 'other'):
+            queue._enqueue(user_id, lambda user_id=user_id: granted.append(user_id))
+        for _ in range(5):
+            queue.release()
+        self.assertEqual(granted, ['heavy', 'light', 'other', 'heavy', 'heavy'])
+        self.assertEqual(queue.stats(), {'active': 1, 'waiting': 0, 'users_waiting': 0})
+
+    def test_waiters_past_the_queue_size_are_turned_away(self):
+        queue = FairQueue(concurrency=1, max_waiting=1)
+        with queue.slot('a', timeout=1):
+            queue._enqueue('b', lambda: None)
+            with self.assertRaises(LLMOverloaded):
+                queue._enqueue('c', lambda: None)
+
+    def test_waiter_gives_up_at_its_deadline(self):
+        queue = FairQueue(concurrency=1, max_waiting=10)
+        with queue.slot('a', timeout=1):
+            with self.assertRaises(LLMOverloaded):
+                with queue.slot('b', timeout=0.05):
+                    pass
+            self.assertEqual(queue.stats()['waiting'], 0)
+
+
+def _drain_limiter(path: str, requests_per_minute: int, pause: float):
+    limiter = RateLimiter(path, requests_per_minute=requests_per_minute)
+    while not limiter.try_acquire():
+        pass
+    if pause:
+        limiter.pause(pause)
+
+
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = f'{directory.name}/llm_rate_limit.sqlite3'
+
+    def _in_other_process(self, requests_per_minute: int, pause: float = 0.0):
+        process = multiprocessing.get_context('fork').Process(
+            target=_drain_limiter, args=(self.path, requests_per_minute, pause)
+        )
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+
+    def test_buckets_drained_by_another_process_refill_over_time(self):
+        limiter = RateLimiter(self.path, requests_per_minute=60)
+        self._in_other_process(60)
+        self.assertGreater(limiter.try_acquire(), 0)
+        time.sleep(1.1)
+        self.assertEqual(limiter.try_acquire(), 0)
+        self.assertGreater(limiter.try_acquire(), 0)
+
+    def test_pause_holds_off_every_process(self):
+        limiter = RateLimiter(self.path, requests_per_minute=6000)
+        self._in_other_process(6000, pause=5.0)
+        time.sleep(0.1)
+        self.assertGreater(limiter.try_acquire(), 4.0)
+
+
+@override_settings(GROQ_API_KEY='stub', PROMPT_TOKENIZER=ESTIMATE, LLM_TOKENS_PER_MINUTE=0,
+                   LLM_BACKOFF_BASE=0.05, LLM_DEADLINE=10)
+class RetryAfterTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = f'{directory.name}/llm_rate_limit.sqlite3'
+
+    def test_rate_limited_call_is_retried_after_the_providers_retry_after(self):
+        server = start_stub(requests_per_minute=120, latency=0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        with override_settings(LLM_BASE_URL=server.url, LLM_REQUESTS_PER_MINUTE=0):
+            service = LLMService()
+            prompt = service.build_prompt('when are expense reports due?', ['within 30 days'])
+            # Empty the stub's bucket: its first answer is a 429 with retry-after 0.5s
+            with server.lock:
+                server._level, server._updated = 0.0, time.monotonic()
+            start = time.monotonic()
+            self.assertTrue(service.complete(prompt, user_id=1))
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+        self.assertEqual(server.stats['rate_limited'], 1)
+        self.assertEqual(server.stats['served'], 1)
+
+    async def test_streamed_retry_keeps_limiter_writes_off_the_event_loop(self):
+        server = start_stub(requests_per_minute=120, latency=0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        threads = []
+
+        def recorded(method):
+            def wrapper(*args):
+                threads.append(threading.get_ident())
+                return method(*args)
+            return wrapper
+
+        with override_settings(LLM_BASE_URL=server.url, LLM_REQUESTS_PER_MINUTE=6000,
+                               LLM_TOKENS_PER_MINUTE=10 ** 6, LLM_RATE_LIMIT_PATH=self.path):
+            service = LLMService()
+            service.limiter.refund = recorded(service.limiter.refund)
+            service.limiter.pause = recorded(service.limiter.pause)
+            prompt = service.build_prompt('when are expense reports due?', ['within 30 days'])
+            with server.lock:
+                server._level, server._updated = 0.0, time.monotonic()
+            answer = ''.join([token async for token in service.stream_response(prompt, user_id=1)])
+        self.assertTrue(answer)
+        self.assertEqual(server.stats['rate_limited'], 1)
+        # Refund and pause after the 429, and the final refund
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(threading.get_ident(), threads)
+
+    def test_retry_after_pauses_the_shared_limiter(self):
+        request = httpx.Request('POST', 'http://llm.invalid/openai/v1/chat/completions')
+        error = RateLimitError('Rate limit reached', body=None,
+                               response=httpx.Response(429, headers={'retry-after': '5'}, request=request))
+        with override_settings(LLM_REQUESTS_PER_MINUTE=6000, LLM_RATE_LIMIT_PATH=self.path):
+            service = LLMService()
+            delay = service._retry_delay(error, 0, time.monotonic() + 10)
+        self.assertGreaterEqual(delay, 5)
+        other_process = RateLimiter(self.path, requests_per_minute=6000)
+        self.assertGreater(other_process.try_acquire(), 4.5)
+
+    def test_retry_after_past_the_deadline_fails_fast(self):
+        request = httpx.Request('POST', 'http://llm.invalid/openai/v1/chat/completions')
+        error = RateLimitError('Rate limit reached', body=None,
+                               response=httpx.Response(429, headers={'retry-after': '30'}, request=request))
+        with override_settings(LLM_REQUESTS_PER_MINUTE=0):
+            service = LLMService()
+            with self.assertRaises(LLMOverloaded) as raised:
+                service._retry_delay(error, 0, time.monotonic() + 10)
+        self.assertEqual(raised.exception.retry_after, 30)
+
+
+class IngestionQueueTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=directory.name, SHARED_CORPUS_ENABLED=False)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def _document(self, name: str, **fields) -> Document:
+        return Document.objects.create(user=self.user, filename=name, file=f'uploads/{name}', file_size=1, **fields)
+
+    def test_concurrent_claims_never_share_a_document(self):
+        documents = [self._document(f'{i}.txt') for i in range(20)]
+        claimed, lock = [], threading.Lock()
+
+        def worker():
+            service = IngestionService()
+            try:
+                while (doc := service.claim_next()) is not None:
+                    with lock:
+                        claimed.append(doc.id)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertCountEqual(claimed, [doc.id for doc in documents])
+        self.assertFalse(Document.objects.exclude(status=Document.STATUS_PROCESSING).exists())
+        self.assertEqual(set(Document.objects.values_list('attempts', flat=True)), {1})
+
+    def test_claim_skips_a_document_claimed_since_it_was_listed(self):
+        first, second = self._document('a.txt'), self._document('b.txt')
+        service = IngestionService()
+        claim_update = QuerySet.update
+        raced = []
+
+        def taken_meanwhile(queryset, **fields):
+            if not raced:
+                # Another worker claims the first candidate between the listing and the claim
+                raced.append(first.id)
+                claim_update(Document.objects.filter(id=first.id), status=Document.STATUS_PROCESSING)
+            return claim_update(queryset, **fields)
+
+        with mock.patch.object(QuerySet, 'update', taken_meanwhile):
+            self.assertEqual(service.claim_next().id, second.id)
+        self.assertEqual(Document.objects.get(id=first.id).attempts, 0)
+
+    def test_stale_processing_documents_are_requeued_or_failed(self):
+        stale = self._document('stale.txt', status=Document.STATUS_PROCESSING, attempts=1)
+        exhausted = self._document('exhausted.txt', status=Document.STATUS_PROCESSING, attempts=3)
+        fresh = self._document('fresh.txt', status=Document.STATUS_PROCESSING, attempts=1)
+        Document.objects.filter(id__in=[stale.id, exhausted.id]).update(
+            updated_at=timezone.now() - timedelta(hours=1)
+        )
+        requeued = IngestionService(stale_seconds=60, max_attempts=3).requeue_stale()
+        self.assertEqual(requeued, 1)
+        self.assertEqual(Document.objects.get(id=stale.id).status, Document.STATUS_PENDING)
+        exhausted.refresh_from_db()
+        self.assertEqual(exhausted.status, Document.STATUS_FAILED)
+        self.assertTrue(exhausted.error_message)
+        self.assertEqual(Document.objects.get(id=fresh.id).status, Document.STATUS_PROCESSING)
+
+    def test_failing_document_ends_failed_with_its_error(self):
+        self._document('missing.txt')
+        service = IngestionService()
+        with mock.patch.object(ingestion, 'VectorStoreService') as vector_store:
+            self.assertTrue(service.run_once())
+        doc = Document.objects.get()
+        self.assertEqual(doc.status, Document.STATUS_FAILED)
+        self.assertIn('missing.txt', doc.error_message)
+        self.assertEqual(doc.attempts, 1)
+        # Anything indexed before the failure is removed
+        vector_store.return_value.delete_document.assert_called_with(doc.id)
+
+
+class FakeModelService:
+    """The parts of EmbeddingService the embedding server uses; vectors are [len(text), batch size]"""
+    model_name = 'fake-model'
+    dimension = 2
+    max_seq_length = 16
+
+    def __init__(self):
+        self.batches = []
+        self.fail = False
+
+    def encode(self, texts, normalize=None):
+        if self.fail:
+            raise ValueError('model exploded')
+        self.batches.append(len(texts))
+        return np.array([[len(text), len(texts)] for text in texts], dtype=np.float32)
+
+    def count_tokens(self, text):
+        return len(text.split())
+
+
+class EmbeddingServerTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.socket_path = f'{directory.name}/embeddings.sock'
+        self.service = FakeModelService()
+        self.server = self.start_server()
+
+    def start_server(self, max_wait_ms: float = 200.0) -> EmbeddingServer:
+        server = EmbeddingServer(self.socket_path, self.service, max_batch_size=64, max_wait_ms=max_wait_ms)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_messages_are_length_prefixed_json_with_a_payload(self):
+        left, right = socket.socketpair()
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+        embedding_server._send_message(left, {'shape': [1, 2]}, b'payload!')
+        self.assertEqual(right.recv(4), struct.pack('>I', len(b'{"shape": [1, 2]}')))
+        self.assertEqual(json.loads(right.recv(17)), {'shape': [1, 2]})
+        self.assertEqual(right.recv(8), b'payload!')
+
+    def test_concurrent_requests_are_encoded_in_one_batch(self):
+        results = {}
+
+        def request(i):
+            # Each thread holds its own connection, like separate workers
+            results[i] = EmbeddingClient(self.socket_path).encode(['x' * i] * (i % 3 + 1))
+
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.service.batches, [sum(i % 3 + 1 for i in range(8))])
+        for i, vectors in results.items():
+            self.assertEqual(vectors.shape, (i % 3 + 1, 2))
+            self.assertTrue((vectors[:, 0] == i).all())
+        self.assertEqual(EmbeddingClient(self.socket_path).info()['requests'], 8)
+
+    def test_model_errors_reach_the_client(self):
+        self.service.fail = True
+        with self.assertRaisesRegex(RuntimeError, 'model exploded'):
+            EmbeddingClient(self.socket_path).encode(['text'])
+
+    def test_client_reconnects_after_a_server_restart(self):
+        client = EmbeddingClient(self.socket_path)
+        self.assertEqual(client.info()['model'], 'fake-model')
+        self.server.shutdown()
+        self.server.server_close()
+        # The handler thread still holds the old connection; the restart drops it
+        client._local.sock.shutdown(socket.SHUT_RDWR)
+        self.start_server()
+        self.assertEqual(client.count_tokens(['a b c']), [3])
+
+    def test_service_falls_back_when_the_server_is_down(self):
+        client = EmbeddingClient(f'{self.socket_path}.missing')
+        service = mock.Mock(client=client)
+        self.assertIsNone(EmbeddingService._remote(service, client.encode, ['text']))
+
+
+class MicroBatcherTests(SimpleTestCase):
+    def test_batches_close_at_max_batch_size(self):
+        sizes = []
+        batcher = MicroBatcher(lambda texts: sizes.append(len(texts)) or np.zeros((len(texts), 1)),
+                               max_batch_size=4, max_wait_ms=500)
+        futures = [batcher.submit(['a', 'b']) for _ in range(3)]
+        for future in futures:
+            self.assertEqual(future.result(timeout=5).shape, (2, 1))
+        self.assertEqual(sizes, [4, 2])
+
+    def test_a_lone_request_waits_at_most_max_wait(self):
+        batcher = MicroBatcher(lambda texts: np.zeros((len(texts), 1)), max_batch_size=64, max_wait_ms=50)
+        start = time.monotonic()
+        batcher.submit(['a']).result(timeout=5)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual((batcher.batches, batcher.requests), (1, 1))
+
+
+@override_settings(VECTOR_STORE_BACKEND='local', SHARED_CORPUS_ENABLED=False, RESPONSE_CACHE_ENABLED=False,
+                   HYBRID_SEARCH_ENABLED=True)
+class VectorStoreMaintenanceTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(LOCAL_INDEX_DIRECTORY=f'{directory.name}/local',
+                                              LEXICAL_INDEX_DIRECTORY=f'{directory.name}/lexical')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.store = VectorStoreService(self.user.id)
+        self.rng = np.random.default_rng(0)
+
+    def document(self, name: str, status: str = Document.STATUS_COMPLETED) -> Document:
+        return Document.objects.create(user=self.user, filename=name, file=f'uploads/{name}', file_size=1,
+                                       status=status)
+
+    def add(self, doc: Document, count: int = 3, doc_id=None, tracked: bool = True) -> List[str]:
+        return self.store.add_documents(
+            [f'{doc.filename} chunk {i}' for i in range(count)],
+            self.rng.standard_normal((count, 8)).astype(np.float32),
+            [{'doc_id': doc.id if doc_id is None else doc_id}] * count,
+            document=doc if tracked else None
+        )
+
+    def chunk_doc_ids(self) -> List[int]:
+        return sorted(int(metadata['doc_id']) for _, _, metadata in self.store.backend.entries())
+
+    def test_delete_by_metadata_accepts_int_and_str_doc_ids(self):
+        a, b, c = self.document('a.txt'), self.document('b.txt'), self.document('c.txt')
+        self.add(a)
+        self.add(b)
+        # Stored with a str doc_id, deleted by int
+        self.add(c, doc_id=str(c.id))
+
+        self.assertEqual(self.store.delete_by_metadata({'doc_id': a.id}), 3)
+        self.assertEqual(self.store.delete_by_metadata({'doc_id': [str(b.id)]}), 3)
+        self.assertEqual(self.store.delete_by_metadata({'doc_id': c.id}), 3)
+        self.assertEqual(self.store.count(), 0)
+        self.assertFalse(EmbeddingMetadata.objects.exists())
+        self.assertEqual(self.store.search(self.rng.standard_normal(8), 5, query_text='chunk')['ids'], [[]])
+        with self.assertRaises(ValueError):
+            self.store.delete_by_metadata({'filename': 'a.txt'})
+
+    def test_prune_removes_chunks_of_deleted_documents_and_interrupted_attempts(self):
+        kept, deleted, retried = self.document('kept.txt'), self.document('gone.txt'), self.document('retried.txt')
+        kept_ids = self.add(kept)
+        self.add(deleted)
+        # An interrupted attempt left chunks that the completed attempt does not track
+        stale_ids = self.add(retried, tracked=False)
+        retried_ids = self.add(retried)
+        deleted.delete()
+
+        orphans = self.store.find_orphans()
+        self.assertEqual(len(orphans), 6)
+        self.assertTrue(set(stale_ids) <= set(orphans))
+        self.assertEqual(self.store.prune_orphans(), 6)
+        self.assertEqual(self.store.find_orphans(), [])
+        self.assertCountEqual([chunk_id for chunk_id, _, _ in self.store.backend.entries()], kept_ids + retried_ids)
+        self.assertEqual(self.store.compact(), 6)
+        self.assertEqual(self.store.count(), 6)
+
+    def test_reindex_drops_chunks_and_requeues_documents(self):
+        done, busy, other = (self.document('done.txt'), self.document('busy.txt', Document.STATUS_PROCESSING),
+                             self.document('other.txt'))
+        for doc in (done, busy, other):
+            self.add(doc)
+        Document.objects.filter(id=done.id).update(attempts=2, chunk_count=3, progress=100, processed=True)
+
+        self.assertEqual(self.store.reindex([done.id, busy.id]), 1)
+        done.refresh_from_db()
+        self.assertEqual((done.status, done.attempts, done.chunk_count, done.processed),
+                         (Document.STATUS_PENDING, 0, 0, False))
+        self.assertEqual(Document.objects.get(id=busy.id).status, Document.STATUS_PROCESSING)
+        self.assertEqual(self.chunk_doc_ids(), [busy.id] * 3 + [other.id] * 3)
+        self.assertFalse(EmbeddingMetadata.objects.filter(document=done).exists())
+
+    @override_settings(SHARED_CORPUS_ENABLED=True)
+    def test_reindex_in_shared_mode_resets_the_shared_content(self):
+        bob = User.objects.create_user('bob', password='secret')
+        reset, busy = (DocumentContent.objects.create(content_hash='a' * 64, status=DocumentContent.STATUS_COMPLETED,
+                                                      chunk_count=3),
+                       DocumentContent.objects.create(content_hash='b' * 64, status=DocumentContent.STATUS_COMPLETED,
+                                                      chunk_count=3))
+        mine, also_mine = self.document('mine.txt'), self.document('also-mine.txt')
+        Document.objects.filter(id=mine.id).update(content=reset, content_hash=reset.content_hash)
+        Document.objects.filter(id=also_mine.id).update(content=busy, content_hash=busy.content_hash)
+        sharing = Document.objects.create(user=bob, filename='same.txt', file='uploads/same.txt', file_size=1,
+                                          status=Document.STATUS_COMPLETED, processed=True, content=reset)
+        Document.objects.create(user=bob, filename='busy.txt', file='uploads/busy.txt', file_size=1,
+                                status=Document.STATUS_PROCESSING, content=busy)
+        shared = VectorStoreService.shared()
+        for content in (reset, busy):
+            shared.add_documents(['x', 'y', 'z'], self.rng.standard_normal((3, 8)).astype(np.float32),
+                                 [{'doc_id': content.id}] * 3)
+
+        self.assertEqual(self.store.reindex(), 2)
+        reset.refresh_from_db()
+        busy.refresh_from_db()
+        self.assertEqual((reset.status, reset.chunk_count), (DocumentContent.STATUS_PENDING, 0))
+        # Another document is indexing it
+        self.assertEqual(busy.status, DocumentContent.STATUS_COMPLETED)
+        self.assertEqual(sorted(int(m['doc_id']) for _, _, m in shared.backend.entries()), [busy.id] * 3)
+        self.assertEqual(Document.objects.get(id=sharing.id).status, Document.STATUS_PENDING)
+
+        # A worker re-embeds the content rather than completing from it
+        mine.refresh_from_db()
+        claimed = IngestionService()._claim_content(mine, mock.Mock())
+        self.assertEqual(claimed.id, reset.id)
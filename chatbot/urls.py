@@ -13,9 +13,18 @@ urlpatterns = [
     # Chat
     path('', views.chat_view, name='chat'),  # ← Changed from views.index to views.chat_view
     path('send-message/', views.send_message, name='send_message'),
+    path('stream-message/', views.stream_message, name='stream_message'),
+    path('chat-history/', views.chat_history, name='chat_history'),
     path('clear-history/', views.clear_chat_history, name='clear_history'),
     
     # Documents
     path('upload/', views.upload_document, name='upload'),
+    path('uploads/', views.start_upload, name='start_upload'),
+    path('uploads/<uuid:upload_id>/', views.upload_part, name='upload_part'),
     path('delete-document/<int:doc_id>/', views.delete_document, name='delete_document'),
+    path('document-status/<int:doc_id>/', views.document_status, name='document_status'),
+    
+    # Diagnostics
+    path('embedding-cache-stats/', views.embedding_cache_stats, name='embedding_cache_stats'),
+    path('response-cache-stats/', views.response_cache_stats, name='response_cache_stats'),
 ]
\ No newline at end of file
@@ -1,23 +1,42 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import login
 from django.contrib import messages
-from django.http import JsonResponse
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_http_methods
+from asgiref.sync import sync_to_async
 from .forms import DocumentUploadForm, UserRegistrationForm
-from .models import Document, ChatMessage
+from .models import Document, ChatMessage, UploadSession
 from .services.embeddings import EmbeddingService
-from .services.vector_store import VectorStoreService
+from .services.corpus import deduplicate, file_hash, remove_document, search_scope
+from .services.llm_limits import LLMError, LLMOverloaded
 from .services.llm_service import LLMService
-from .services.document_processor import DocumentProcessor
+from .services.reranker import get_reranker
+from .services.metrics import FIRST_TOKEN_SECONDS, RESPONSE_CACHE_LOOKUPS, Trace, registry
+from .services.response_cache import get_response_cache
+from .services.uploads import UploadError, abort_session, open_session, upload_state, write_part
+from datetime import datetime
+import asyncio
+import json
 import logging
-from chatbot.services.embeddings import EmbeddingService
-
-embedding_service = EmbeddingService()
-from chatbot.services.llm_service import LLMService
+import math
+import time
 
+# Services are built on first use so that importing the views (migrate,
+# collectstatic, admin, worker boot) does not load the embedding model
+_embedding_service = None
 _llm_service = None
 
+def get_embedding_service():
+    global _embedding_service
+    if _embedding_service is None:
+        _embedding_service = EmbeddingService()
+    return _embedding_service
+
 def get_llm_service():
     global _llm_service
     if _llm_service is None:
@@ -41,19 +60,107 @@ def register(request):
         form = UserRegistrationForm()
     return render(request, 'chatbot/register.html', {'form': form})
 
+def chat_messages_before(user, cursor=None):
+    """User's messages newest first, optionally older than a keyset cursor.
+
+    Served by the (user, timestamp, id) index, so fetching a page costs
+    the same however long the history is.
+    """
+    queryset = ChatMessage.objects.filter(user=user).only(
+        'id', 'message', 'response', 'timestamp'
+    ).order_by('-timestamp', '-id')
+    if cursor is not None:
+        timestamp, msg_id = cursor
+        queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=msg_id))
+    return queryset
+
+def encode_cursor(msg: ChatMessage) -> str:
+    return f"{msg.timestamp.isoformat()},{msg.id}"
+
+def decode_cursor(cursor: str):
+    timestamp, msg_id = cursor.rsplit(',', 1)
+    return datetime.fromisoformat(timestamp), int(msg_id)
+
+def chat_page(user, cursor=None):
+    """One page of messages in chronological order, and the cursor for the page before it"""
+    page = list(chat_messages_before(user, cursor)[:settings.CHAT_PAGE_SIZE + 1])
+    has_more = len(page) > settings.CHAT_PAGE_SIZE
+    page = page[:settings.CHAT_PAGE_SIZE][::-1]
+    return page, encode_cursor(page[0]) if has_more else None
+
+def history_for_prompt(recent_messages) -> list:
+    """LLM chat history from messages in chronological order"""
+    chat_history = []
+    for msg in recent_messages:
+        chat_history.append({"role": "user", "content": msg.message})
+        chat_history.append({"role": "assistant", "content": msg.response})
+    return chat_history
+
 @login_required(login_url='chatbot:register')
 def chat_view(request):
     """Main chat interface"""
-    messages_list = ChatMessage.objects.filter(user=request.user).order_by('timestamp')
+    messages_list, next_cursor = chat_page(request.user)
     documents = Document.objects.filter(user=request.user, processed=True)
     
     context = {
         'messages': messages_list,
+        'next_cursor': next_cursor,
         'documents': documents,
         'has_documents': documents.exists()
     }
     return render(request, 'chatbot/chat.html', context)
 
+@login_required
+def chat_history(request):
+    """Older chat messages for the chat page, keyset-paginated"""
+    try:
+        cursor = decode_cursor(request.GET['before'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    
+    page, next_cursor = chat_page(request.user, cursor)
+    return JsonResponse({
+        'messages': [{'message': msg.message, 'response': msg.response} for msg in page],
+        'next_cursor': next_cursor,
+    })
+
+def retrieve_context(user_id: int, query: str, trace: Trace = None):
+    """Embed the query; return the embedding and the user's most relevant chunks, their ids and distances"""
+    trace = trace or Trace('retrieve')
+    with trace.stage('embed'):
+        query_embedding = get_embedding_service().embed_query(query)
+    reranker = get_reranker()
+    with trace.stage('search'):
+        vector_store, doc_ids = search_scope(user_id)
+        n_results = settings.RERANK_CANDIDATES if reranker is not None else 3
+        search_results = vector_store.search(query_embedding, n_results=n_results, query_text=query, doc_ids=doc_ids)
+    if reranker is not None:
+        with trace.stage('rerank'):
+            search_results = reranker.rerank(
+                query, search_results, settings.RERANK_TOP_K, settings.RERANK_BUDGET_MS / 1000
+            )
+    context = search_results.get('documents', [[]])[0] if search_results and search_results.get('documents') else []
+    chunk_ids = search_results.get('ids', [[]])[0] if search_results and search_results.get('ids') else []
+    distances = search_results.get('distances', [[]])[0] if search_results and search_results.get('distances') else None
+    return query_embedding, context, chunk_ids, distances
+
+def lookup_cached_response(response_cache, user_id, query_embedding, chunk_ids, model, chat_history):
+    """Response cache lookup, counted in the metrics"""
+    response = response_cache.get(user_id, query_embedding, chunk_ids, model, chat_history)
+    RESPONSE_CACHE_LOOKUPS.inc(result='hit' if response is not None else 'miss')
+    return response
+
+def sse_event(event: str, data: dict) -> str:
+    """Format a server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def llm_error_response(error: LLMError) -> JsonResponse:
+    """HTTP error for an LLM call that failed, with Retry-After when known"""
+    response = JsonResponse({'error': str(error), 'retry_after': error.retry_after}, status=error.status)
+    if error.retry_after is not None:
+        response['Retry-After'] = str(max(1, math.ceil(error.retry_after)))
+    return response
+
 @login_required
 @require_http_methods(["POST"])
 def send_message(request):
@@ -63,100 +170,210 @@ def send_message(request):
     if not query:
         return JsonResponse({'error': 'Empty message'}, status=400)
     
+    trace = Trace('send_message', user_id=request.user.id)
     try:
-        # Initialize vector store for user
-        vector_store = VectorStoreService(request.user.id)
-        
-        # Generate query embedding
-        query_embedding = embedding_service.generate_embedding(query)
-        
         # Search for relevant documents
-        search_results = vector_store.search(query_embedding, n_results=3)
+        query_embedding, context, chunk_ids, distances = retrieve_context(request.user.id, query, trace)
         
-        # Extract context from search results
-        context = search_results.get('documents', [[]])[0] if search_results and search_results.get('documents') else []
+        # Build chat history from the most recent turns
+        with trace.stage('history'):
+            recent_messages = chat_messages_before(request.user)[:settings.CHAT_HISTORY_TURNS]
+            chat_history = history_for_prompt(reversed(list(recent_messages)))
         
-        # Build chat history
-        chat_history = []
-        recent_messages = ChatMessage.objects.filter(
-            user=request.user
-        ).order_by('timestamp')[:5]
-        
-        for msg in recent_messages:
-            chat_history.append({"role": "user", "content": msg.message})
-            chat_history.append({"role": "assistant", "content": msg.response})
+        # Reuse the answer to a near-identical question over the same chunks and history
+        llm_service = get_llm_service()
+        response_cache = get_response_cache()
+        response = None
+        if response_cache is not None:
+            with trace.stage('cache_lookup'):
+                response = lookup_cached_response(
+                    response_cache, request.user.id, query_embedding, chunk_ids, llm_service.model, chat_history
+                )
+        cached = response is not None
+        prompt = None
         
-        # Generate response
-        response = get_llm_service().generate_response(query, context, chat_history)
+        if not cached:
+            # Generate response
+            try:
+                with trace.stage('prompt'):
+                    prompt = llm_service.build_prompt(query, context, chat_history, scores=distances)
+                with trace.stage('llm'):
+                    response = llm_service.complete(prompt, user_id=request.user.id)
+                if response_cache is not None:
+                    with trace.stage('cache_store'):
+                        response_cache.put(request.user.id, query_embedding, chunk_ids, llm_service.model, response,
+                                           chat_history)
+            except LLMError as e:
+                # Nothing is saved: the client can ask again, after Retry-After if given
+                logger.warning(f"LLM call failed for user {request.user.id}: {e}")
+                trace.finish('llm_overloaded' if isinstance(e, LLMOverloaded) else 'llm_error',
+                             error=type(e).__name__)
+                return llm_error_response(e)
+            except Exception as e:
+                # Not saved either: a failed turn must not become history
+                logger.error(f"Error generating response: {e}")
+                trace.finish('llm_error', error=type(e).__name__)
+                return JsonResponse({'error': f"Sorry, I encountered an error: {str(e)}"}, status=502)
         
         # Save to database
-        ChatMessage.objects.create(
-            user=request.user,
-            message=query,
-            response=response
-        )
+        with trace.stage('save'):
+            ChatMessage.objects.create(
+                user=request.user,
+                message=query,
+                response=response
+            )
         
+        trace.finish(cached=cached, chunks=len(chunk_ids),
+                     prompt_tokens=prompt.prompt_tokens if prompt is not None else None)
         return JsonResponse({
             'response': response,
+            'cached': cached,
+            'prompt': prompt.report() if prompt is not None else None,
             'timestamp': 'Just now'
         })
     
     except Exception as e:
         logger.error(f"Error in send_message: {e}")
+        trace.finish('error', error=type(e).__name__)
         return JsonResponse({'error': str(e)}, status=500)
 
+@login_required
+@require_http_methods(["POST"])
+async def stream_message(request):
+    """Chat message submission with the response streamed as server-sent events.
+
+    Served under ASGI, the request holds no thread while waiting on the
+    LLM; embedding and vector search run in a worker thread.
+    """
+    query = request.POST.get('message', '').strip()
+    
+    if not query:
+        return JsonResponse({'error': 'Empty message'}, status=400)
+    
+    user = await request.auser()
+    
+    trace = Trace('stream_message', user_id=user.id)
+    
+    async def load_history():
+        with trace.stage('history'):
+            recent_messages = [
+                msg async for msg in chat_messages_before(user)[:settings.CHAT_HISTORY_TURNS]
+            ]
+            return history_for_prompt(reversed(recent_messages))
+    
+    async def events():
+        start = time.monotonic()
+        first_token = None
+        parts = []
+        try:
+            # thread_sensitive=False: concurrent chats must not queue
+            # behind each other on Django's single sync thread
+            (query_embedding, context, chunk_ids, distances), chat_history = await asyncio.gather(
+                sync_to_async(retrieve_context, thread_sensitive=False)(user.id, query, trace),
+                load_history()
+            )
+            llm_service = get_llm_service()
+            response_cache = get_response_cache()
+            cached = None
+            prompt = None
+            if response_cache is not None:
+                with trace.stage('cache_lookup'):
+                    cached = await sync_to_async(lookup_cached_response, thread_sensitive=False)(
+                        response_cache, user.id, query_embedding, chunk_ids, llm_service.model, chat_history
+                    )
+            
+            if cached is not None:
+                first_token = time.monotonic() - start
+                parts.append(cached)
+                yield sse_event('token', {'token': cached})
+            else:
+                # Token counting may load a tokenizer; keep it off the event loop
+                with trace.stage('prompt'):
+                    prompt = await sync_to_async(llm_service.build_prompt, thread_sensitive=False)(
+                        query, context, chat_history, scores=distances
+                    )
+                llm_start = time.monotonic()
+                async for token in llm_service.stream_response(prompt, user_id=user.id):
+                    if first_token is None:
+                        first_token = time.monotonic() - start
+                        trace.add('llm_first_token', time.monotonic() - llm_start)
+                    parts.append(token)
+                    yield sse_event('token', {'token': token})
+                trace.add('llm', time.monotonic() - llm_start)
+                if response_cache is not None:
+                    with trace.stage('cache_store'):
+                        await sync_to_async(response_cache.put, thread_sensitive=False)(
+                            user.id, query_embedding, chunk_ids, llm_service.model, ''.join(parts), chat_history
+                        )
+            
+            with trace.stage('save'):
+                await ChatMessage.objects.acreate(
+                    user=user,
+                    message=query,
+                    response=''.join(parts)
+                )
+        except (GeneratorExit, asyncio.CancelledError):
+            trace.finish('disconnected')
+            raise
+        except LLMError as e:
+            logger.warning(f"LLM call failed for user {user.id}: {e}")
+            trace.finish('llm_overloaded' if isinstance(e, LLMOverloaded) else 'llm_error',
+                         error=type(e).__name__)
+            yield sse_event('error', {'error': str(e), 'retry_after': e.retry_after})
+            return
+        except Exception as e:
+            logger.error(f"Error in stream_message: {e}")
+            trace.finish('error', error=type(e).__name__)
+            yield sse_event('error', {'error': str(e)})
+            return
+        
+        if first_token is not None and settings.METRICS_ENABLED:
+            FIRST_TOKEN_SECONDS.observe(first_token, pipeline='stream_message')
+        trace.finish(cached=cached is not None, chunks=len(chunk_ids),
+                     first_token_ms=round((first_token or 0) * 1000, 2),
+                     prompt_tokens=prompt.prompt_tokens if prompt is not None else None)
+        yield sse_event('done', {
+            'cached': cached is not None,
+            'prompt': prompt.report() if prompt is not None else None,
+            'timestamp': 'Just now'
+        })
+    
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx and similar proxies from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 @login_required
 def upload_document(request):
-    """Document upload and processing"""
+    """Document upload; processing happens in the ingestion worker"""
     if request.method == 'POST':
         form = DocumentUploadForm(request.POST, request.FILES)
         if form.is_valid():
             file = request.FILES['file']
+            trace = Trace('upload', user_id=request.user.id, file_size=file.size)
+            with trace.stage('hash'):
+                content_hash = file_hash(file)
+            with transaction.atomic():
+                with trace.stage('dedup'):
+                    content, stored = deduplicate(content_hash, file)
+
+                # Create document record; it starts out pending in the ingestion queue
+                with trace.stage('store'):
+                    doc = Document.objects.create(
+                        user=request.user,
+                        filename=file.name,
+                        file=stored,
+                        file_size=file.size,
+                        content_hash=content_hash,
+                        content=content
+                    )
+            trace.finish(document_id=doc.id, deduplicated=stored is not file)
             
-            # Create document record
-            doc = Document.objects.create(
-                user=request.user,
-                filename=file.name,
-                file=file,
-                file_size=file.size
+            messages.success(
+                request,
+                f'Document "{file.name}" uploaded and queued for processing.'
             )
-            
-            try:
-                processor = DocumentProcessor()
-                file_path = doc.file.path
-                
-                # Extract text based on file type
-                if file.name.lower().endswith('.pdf'):
-                    text = processor.extract_text_from_pdf(file_path)
-                else:
-                    text = processor.extract_text_from_txt(file_path)
-                
-                # Chunk text
-                chunks = processor.chunk_text(text)
-                
-                # Generate embeddings
-                embeddings = embedding_service.generate_embeddings(chunks)
-                
-                # Store in vector database
-                vector_store = VectorStoreService(request.user.id)
-                metadatas = [{'filename': file.name, 'doc_id': doc.id}] * len(chunks)
-                vector_store.add_documents(chunks, embeddings, metadatas)
-                
-                # Mark as processed
-                doc.processed = True
-                doc.save()
-                
-                messages.success(
-                    request, 
-                    f'Document "{file.name}" uploaded and processed successfully! '
-                    f'{len(chunks)} chunks created.'
-                )
-            
-            except Exception as e:
-                logger.error(f"Error processing document: {e}")
-                messages.error(request, f'Error processing document: {str(e)}')
-                doc.delete()
-            
             return redirect('chatbot:upload')
     else:
         form = DocumentUploadForm()
@@ -167,6 +384,62 @@ def upload_document(request):
         'documents': documents
     })
 
+@login_required
+@require_http_methods(["POST"])
+def start_upload(request):
+    """Open a resumable upload: JSON {"filename", "size"} -> upload state"""
+    try:
+        data = json.loads(request.body)
+        session = open_session(request.user, str(data['filename']), int(data['size']))
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'Expected JSON with filename and size'}, status=400)
+    except UploadError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    return JsonResponse(upload_state(session), status=201)
+
+@login_required
+@require_http_methods(["GET", "PUT", "DELETE"])
+def upload_part(request, upload_id):
+    """State of an upload (GET), its next part (PUT at Upload-Offset) or abort (DELETE)"""
+    try:
+        session = UploadSession.objects.get(id=upload_id, user=request.user)
+    except UploadSession.DoesNotExist:
+        return JsonResponse({'error': 'Upload not found'}, status=404)
+    
+    if request.method == 'DELETE':
+        abort_session(session)
+        return JsonResponse({'deleted': True})
+    if request.method == 'PUT':
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except (KeyError, ValueError):
+            return JsonResponse({'error': 'Upload-Offset and Content-Length headers are required'}, status=400)
+        try:
+            # Read from the request stream, never loading the part into memory
+            write_part(session, offset, request, length)
+        except UploadError as e:
+            session.refresh_from_db()
+            return JsonResponse({'error': str(e), **upload_state(session)}, status=e.status)
+    return JsonResponse(upload_state(session))
+
+@login_required
+def document_status(request, doc_id):
+    """Ingestion status of a document, polled by the upload page"""
+    try:
+        doc = Document.objects.get(id=doc_id, user=request.user)
+    except Document.DoesNotExist:
+        return JsonResponse({'error': 'Document not found'}, status=404)
+    
+    return JsonResponse({
+        'id': doc.id,
+        'status': doc.status,
+        'progress': doc.progress,
+        'processed': doc.processed,
+        'chunk_count': doc.chunk_count,
+        'error': doc.error_message,
+    })
+
 @login_required
 @require_http_methods(["POST"])
 def delete_document(request, doc_id):
@@ -175,15 +448,8 @@ def delete_document(request, doc_id):
         doc = Document.objects.get(id=doc_id, user=request.user)
         filename = doc.filename
         
-        # Remove from vector store if method exists
-        try:
-            vector_store = VectorStoreService(request.user.id)
-            if hasattr(vector_store, 'delete_by_metadata'):
-                vector_store.delete_by_metadata({'doc_id': str(doc.id)})
-        except Exception as e:
-            logger.warning(f"Could not delete from vector store: {e}")
-        
-        doc.delete()
+        # Remove its chunks unless another document shares them
+        remove_document(doc)
         messages.success(request, f'Document "{filename}" deleted successfully.')
     
     except Document.DoesNotExist:
@@ -194,6 +460,29 @@ def delete_document(request, doc_id):
     
     return redirect('chatbot:upload')
 
+def metrics(request):
+    """Prometheus scrape endpoint for this worker process"""
+    if not settings.METRICS_ENABLED:
+        return HttpResponse(status=404)
+    if settings.METRICS_TOKEN:
+        if request.headers.get('Authorization') != f'Bearer {settings.METRICS_TOKEN}':
+            return HttpResponse(status=401)
+    elif not (request.user.is_active and request.user.is_staff):
+        # Without a token, only staff may read the metrics
+        return HttpResponse(status=403)
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@staff_member_required
+def embedding_cache_stats(request):
+    """Embedding cache hit/miss counters for this worker process"""
+    return JsonResponse(get_embedding_service().cache_stats())
+
+@staff_member_required
+def response_cache_stats(request):
+    """Response cache hit/miss counters for this worker process"""
+    response_cache = get_response_cache()
+    return JsonResponse(response_cache.stats() if response_cache is not None else {})
+
 @login_required
 def logout_view(request):
     """User logout view"""
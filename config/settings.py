@@ -88,11 +88,161 @@ LOGOUT_REDIRECT_URL = 'chatbot:login'
 
 # RAG Settings
 CHROMA_PERSIST_DIRECTORY = BASE_DIR / 'docs' / 'chroma'
+# Open per-user collection handles kept by each process
+CHROMA_COLLECTION_CACHE_SIZE = int(os.getenv('CHROMA_COLLECTION_CACHE_SIZE', '256'))
+# Vector store backend: 'chroma' or 'local' (memory-mapped NumPy index)
+VECTOR_STORE_BACKEND = os.getenv('VECTOR_STORE_BACKEND', 'chroma')
+LOCAL_INDEX_DIRECTORY = BASE_DIR / 'docs' / 'local_index'
+LOCAL_INDEX_CACHE_SIZE = int(os.getenv('LOCAL_INDEX_CACHE_SIZE', '256'))
+# Corpus size from which the local backend searches an IVF index instead of brute force
+LOCAL_INDEX_ANN_THRESHOLD = int(os.getenv('LOCAL_INDEX_ANN_THRESHOLD', '20000'))
+LOCAL_INDEX_NPROBE = int(os.getenv('LOCAL_INDEX_NPROBE', '16'))
+# Dtype of the vectors the local backend scans: 'float32', 'float16' (half
+# the memory) or 'int8' (a quarter, one scale per vector). New indexes use
+# it; `manage.py vector_store compact` converts existing ones
+LOCAL_INDEX_STORAGE = os.getenv('LOCAL_INDEX_STORAGE', 'float32')
+# For float16/int8 indexes: keep the float32 vectors on disk and re-rank the
+# best RERANK x n_results quantized candidates against them (0 disables)
+LOCAL_INDEX_RERANK = int(os.getenv('LOCAL_INDEX_RERANK', '4'))
+# Hybrid retrieval: BM25 over a per-user inverted index, fused with vector
+# results by reciprocal rank (score = sum of 1 / (HYBRID_RRF_K + rank))
+HYBRID_SEARCH_ENABLED = os.getenv('HYBRID_SEARCH_ENABLED', 'True') == 'True'
+LEXICAL_INDEX_DIRECTORY = BASE_DIR / 'docs' / 'lexical_index'
+LEXICAL_INDEX_MAX_SEGMENTS = int(os.getenv('LEXICAL_INDEX_MAX_SEGMENTS', '8'))
+HYBRID_RRF_K = int(os.getenv('HYBRID_RRF_K', '60'))
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', '20'))
+BM25_K1 = float(os.getenv('BM25_K1', '1.2'))
+BM25_B = float(os.getenv('BM25_B', '0.75'))
+# Cross-encoder re-ranking: retrieve RERANK_CANDIDATES chunks, score them
+# against the query in one batch and send the best RERANK_TOP_K to the LLM.
+# Past RERANK_BUDGET_MS the retrieval order is kept
+RERANK_ENABLED = os.getenv('RERANK_ENABLED', 'False') == 'True'
+RERANK_MODEL = os.getenv('RERANK_MODEL', 'cross-encoder/ms-marco-MiniLM-L-6-v2')
+RERANK_CANDIDATES = int(os.getenv('RERANK_CANDIDATES', '30'))
+RERANK_TOP_K = int(os.getenv('RERANK_TOP_K', '3'))
+RERANK_BUDGET_MS = float(os.getenv('RERANK_BUDGET_MS', '150'))
+RERANK_MAX_LENGTH = int(os.getenv('RERANK_MAX_LENGTH', '256'))
+RERANK_CACHE_SIZE = int(os.getenv('RERANK_CACHE_SIZE', '20000'))
+RERANK_WORKERS = int(os.getenv('RERANK_WORKERS', '1'))
 GROQ_API_KEY = os.getenv('GROQ_API_KEY')
 LLM_MODEL = os.getenv('LLM_MODEL', 'llama-3.1-8b-instant')
+# LLM client: one keep-alive connection pool per process, a timeout per
+# attempt and up to LLM_MAX_RETRIES retries (jittered exponential backoff)
+# on 429s, 5xx and timeouts. Empty LLM_BASE_URL uses Groq's API; point it
+# at `manage.py llm_stub_server` for load tests
+LLM_BASE_URL = os.getenv('LLM_BASE_URL', '')
+LLM_MAX_TOKENS = int(os.getenv('LLM_MAX_TOKENS', '1024'))
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '20'))
+LLM_CONNECT_TIMEOUT = float(os.getenv('LLM_CONNECT_TIMEOUT', '5'))
+LLM_MAX_CONNECTIONS = int(os.getenv('LLM_MAX_CONNECTIONS', '16'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '3'))
+LLM_BACKOFF_BASE = float(os.getenv('LLM_BACKOFF_BASE', '0.5'))
+LLM_BACKOFF_MAX = float(os.getenv('LLM_BACKOFF_MAX', '8'))
+# Seconds a chat request may spend queueing, rate limited and retrying
+# before it fails with HTTP 503
+LLM_DEADLINE = float(os.getenv('LLM_DEADLINE', '30'))
+# LLM calls in flight per process, granted round-robin across users;
+# beyond LLM_QUEUE_SIZE waiting requests new ones are turned away at once
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', '8'))
+LLM_QUEUE_SIZE = int(os.getenv('LLM_QUEUE_SIZE', '64'))
+# The provider's limits for the account, enforced together by every
+# process on the host (0 disables)
+LLM_REQUESTS_PER_MINUTE = int(os.getenv('LLM_REQUESTS_PER_MINUTE', '0'))
+LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', '0'))
+LLM_RATE_LIMIT_PATH = BASE_DIR / 'docs' / 'llm_rate_limit.sqlite3'
 EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', '32'))
+EMBEDDING_NORMALIZE = os.getenv('EMBEDDING_NORMALIZE', 'False') == 'True'
+# Inference backend for the embedding model: 'torch', 'torch-int8' (dynamic
+# int8 quantization of the linear layers), 'onnx' or 'onnx-int8' (ONNX
+# Runtime over the export written by `manage.py export_onnx`)
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch')
+# Intra-op threads per process for the embedding model; 0 uses every core
+EMBEDDING_THREADS = int(os.getenv('EMBEDDING_THREADS', '0'))
+EMBEDDING_ONNX_DIRECTORY = BASE_DIR / 'docs' / 'onnx'
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 50
+# Token limit per chunk; 0 uses the embedding model's max sequence length
+# less the special tokens its tokenizer adds
+CHUNK_MAX_TOKENS = int(os.getenv('CHUNK_MAX_TOKENS', '0'))
+# Previous question/answer pairs sent to the LLM, and messages per chat page
+CHAT_HISTORY_TURNS = int(os.getenv('CHAT_HISTORY_TURNS', '5'))
+CHAT_PAGE_SIZE = int(os.getenv('CHAT_PAGE_SIZE', '50'))
+# Prompt token budget; history gets at most PROMPT_HISTORY_TOKENS of it
+PROMPT_MAX_TOKENS = int(os.getenv('PROMPT_MAX_TOKENS', '3000'))
+PROMPT_HISTORY_TOKENS = int(os.getenv('PROMPT_HISTORY_TOKENS', '800'))
+PROMPT_HISTORY_MESSAGE_TOKENS = int(os.getenv('PROMPT_HISTORY_MESSAGE_TOKENS', '300'))
+# Tokenizer counting prompt tokens: a tokenizer.json path or Hugging Face Hub id
+# (the LLM's own is most exact), empty for the embedding model's, or 'estimate'
+PROMPT_TOKENIZER = os.getenv('PROMPT_TOKENIZER', '')
+
+# Content-addressed embedding cache shared by all processes on the host
+EMBEDDING_CACHE_ENABLED = os.getenv('EMBEDDING_CACHE_ENABLED', 'True') == 'True'
+EMBEDDING_CACHE_PATH = BASE_DIR / 'docs' / 'embedding_cache.sqlite3'
+EMBEDDING_CACHE_LRU_SIZE = int(os.getenv('EMBEDDING_CACHE_LRU_SIZE', '10000'))
+# Vectors kept on disk (about 1.5KB each at 384 dimensions); least recently used go first
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', '200000'))
+
+# Query embeddings: normalized chat queries are kept in a per-process LRU,
+# and a table written by manage.py precompute_queries is loaded at startup
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv('QUERY_EMBEDDING_CACHE_SIZE', '2048'))
+QUERY_EMBEDDINGS_PATH = BASE_DIR / 'docs' / 'query_embeddings.npz'
+
+# Shared corpus: identical files (same sha256) are ingested once into a
+# single store and shared between their owners; retrieval is filtered by
+# the documents each user can access. Existing per-user documents move over
+# when reindexed (manage.py vector_store reindex)
+SHARED_CORPUS_ENABLED = os.getenv('SHARED_CORPUS_ENABLED', 'False') == 'True'
+# Resumable uploads in parts (services/uploads.py): largest file, part size
+# suggested to clients and largest part accepted. Sessions idle for longer
+# than UPLOAD_SESSION_TTL are removed by `manage.py expire_uploads`
+UPLOAD_MAX_SIZE = int(os.getenv('UPLOAD_MAX_SIZE', str(1024 * 1024 * 1024)))
+UPLOAD_PART_SIZE = int(os.getenv('UPLOAD_PART_SIZE', str(8 * 1024 * 1024)))
+UPLOAD_PART_MAX_SIZE = int(os.getenv('UPLOAD_PART_MAX_SIZE', str(64 * 1024 * 1024)))
+UPLOAD_SESSION_TTL = int(os.getenv('UPLOAD_SESSION_TTL', '86400'))
+
+# Semantic response cache: reuse an answer for a near-identical question
+# that retrieved the same chunks with the same model and chat history.
+# Off by default: answers are sampled, and with the cache on a repeated
+# question gets the stored answer instead of a fresh one
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'False') == 'True'
+RESPONSE_CACHE_PATH = BASE_DIR / 'docs' / 'response_cache.sqlite3'
+RESPONSE_CACHE_SIMILARITY = float(os.getenv('RESPONSE_CACHE_SIMILARITY', '0.95'))
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '86400'))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '50000'))
+
+# Request metrics: per-stage timings exposed on /metrics (Prometheus text
+# format) and logged as one JSON line per request on the chatbot.trace logger.
+# With METRICS_TOKEN set, scrapes must send "Authorization: Bearer <token>";
+# without it, /metrics is only served to logged-in staff users
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'trace': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'chatbot.trace': {'handlers': ['trace'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
+# Shared embedding server (manage.py embedding_server); empty runs the model in-process
+EMBEDDING_SERVER_SOCKET = os.getenv('EMBEDDING_SERVER_SOCKET', '')
+EMBEDDING_SERVER_MAX_BATCH = int(os.getenv('EMBEDDING_SERVER_MAX_BATCH', '64'))
+EMBEDDING_SERVER_MAX_WAIT_MS = float(os.getenv('EMBEDDING_SERVER_MAX_WAIT_MS', '5'))
+
+# Background ingestion (manage.py ingest_worker)
+INGESTION_POLL_INTERVAL = float(os.getenv('INGESTION_POLL_INTERVAL', '2'))
+INGESTION_STALE_SECONDS = int(os.getenv('INGESTION_STALE_SECONDS', '900'))
+INGESTION_MAX_ATTEMPTS = int(os.getenv('INGESTION_MAX_ATTEMPTS', '3'))
+INGESTION_BATCH_SIZE = int(os.getenv('INGESTION_BATCH_SIZE', '64'))
+# Seconds between heartbeats of a job while pages are extracted; keep well under the stale limit
+INGESTION_HEARTBEAT_SECONDS = float(os.getenv('INGESTION_HEARTBEAT_SECONDS', '30'))
+# Process-pool size for extracting large PDFs (1 disables the pool)
+PDF_EXTRACTION_WORKERS = int(os.getenv('PDF_EXTRACTION_WORKERS', '2'))
 
 # ============================================
 # PRODUCTION SETTINGS
@@ -0,0 +1,37 @@
+"""Gunicorn settings; picked up automatically from the working directory.
+
+Set GUNICORN_PRELOAD=True to import the app and load the embedding model
+once in the master process before workers are forked, so workers start
+instantly and share the model's memory pages copy-on-write.
+"""
+import gc
+import os
+
+preload_app = os.getenv('GUNICORN_PRELOAD', 'False') == 'True'
+
+
+def when_ready(server):
+    # Runs in the master after the app is preloaded and before any fork
+    if not preload_app:
+        return
+    from chatbot.services.embeddings import EmbeddingService
+    # Only load the weights: running a forward pass here would start
+    # torch's thread pool, which does not survive fork
+    EmbeddingService().warm_up()
+    from chatbot.services.reranker import get_reranker
+    reranker = get_reranker()
+    if reranker is not None:
+        reranker.warm_up()
+    # Keep the garbage collector from touching (and so copying) the
+    # preloaded objects' pages in every worker
+    gc.freeze()
+    server.log.info('Embedding model preloaded before fork')
+
+
+def post_worker_init(worker):
+    # Without preload, load the precomputed query embeddings as the worker
+    # starts rather than on its first chat request; the model stays lazy
+    if preload_app:
+        return
+    from chatbot.services.embeddings import EmbeddingService
+    EmbeddingService()